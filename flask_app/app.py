@@ -1,14 +1,19 @@
 # -*- coding: UTF-8 -*-
 __author__ = 'woodie, jiaying.lu'
 
-from flask import Flask, request, make_response
+from flask import Flask, Response, request, make_response
 import json
 import os
 from numpy import log
 
-from log2rawsenz import collect_senz_lists
-from raw2refine import refine_senz_prob_list
-from prob2multi import prob2muti, prob2muti_quick
+from log2rawsenz import iter_senz_lists, iter_session_senz_lists, collect_senz_columns, collect_senz_lists_batch
+from log2rawsenz import align_timestamps, ALIGN_MODES, ALIGN_MODE_DEFAULT
+from raw2refine import refine_senz_prob_list, refine_senz_prob_windows, refine_senz_prob_pyramid, SCALE_PYRAMID
+from raw2refine import refine_senz_prob_stream, FILL_STRATEGIES, FILL_STRATEGY_DEFAULT, MAX_GAP_DEFAULT, NOT_PROB_KEYS
+from raw2refine import get_bucket_cache_stats
+from behavior_collector import collect_behaviors, COLLECT_STRATEGIES, COLLECT_STRATEGY_DEFAULT
+from label_vocab import label_vocab, encode_prob_dict, decode_prob_dict
+from prob2multi import prob2muti_top_k, prob2muti_quick, prob2muti_beam, BEAM_WIDTH_DEFAULT
 from config import *
 
 import bugsnag
@@ -38,6 +43,10 @@ bugsnag.configure(
 
 app = Flask(__name__)
 
+STREAM_CHUNK_SIZE = 256  # senz tuples serialized per chunk of a streaming response
+PROB2MULTI_KEYS = ['motion', 'location', 'sound']  # prob dict keys of a prob2multi senz
+COLUMNAR_MIMETYPE = 'application/vnd.senz.columnar+json'
+
 # Attach Bugsnag to Flask's exception handler
 handle_exceptions(app)
 
@@ -60,6 +69,7 @@ def init_before_first_request():
 
 
 @app.route('/log2rawsenz/', methods=['POST'])
+@app.route('/log2rawsenz/session/', methods=['POST'])
 def senzCollectorAPI():
 
     x_request_id = get_X_request_Id(request)
@@ -67,6 +77,13 @@ def senzCollectorAPI():
                 % (x_request_id, request.remote_addr, request.remote_user))
     result = {'code': 1, 'message': ''}
 
+    # sessions live in memory of the stateful worker, see config.STATEFUL_WORKER
+    session_api = request.url_rule.rule == '/log2rawsenz/session/'
+    if session_api:
+        error_response = _refuse_stateless_worker(x_request_id, 'log2rawsenz session')
+        if error_response is not None:
+            return error_response
+
     # params JSON validate
     try:
         incoming_data = json.loads(request.data)
@@ -84,19 +101,168 @@ def senzCollectorAPI():
             result['code'] = 103
             return make_response(json.dumps(result), 400)
 
+    if session_api != ('session_id' in incoming_data):
+        logger.error('<%s>, [log2rawsenz] [Input Error] session_id should be sent to /log2rawsenz/session/ only'
+                     % (x_request_id))
+        result['message'] = 'session_id error: sessions are served by /log2rawsenz/session/ with session_id'
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    if incoming_data.get('align_mode', ALIGN_MODE_DEFAULT) not in ALIGN_MODES:
+        logger.error('<%s>, [log2rawsenz] [Input Error] align_mode=%s should in %s'
+                     % (x_request_id, incoming_data['align_mode'], sorted(ALIGN_MODES)))
+        result['message'] = 'align_mode error'
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
     logger.info('<%s>, [log2rawsenz] valid request with params=%s' % (x_request_id, incoming_data))
 
+    mimetype = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson', COLUMNAR_MIMETYPE],
+                                                   default='application/json')
+    if mimetype == COLUMNAR_MIMETYPE and session_api:
+        logger.error('<%s>, [log2rawsenz] [Input Error] columnar result is not supported in session' % (x_request_id))
+        result['message'] = 'columnar result error: not supported with session_id'
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    try:
+        if mimetype == COLUMNAR_MIMETYPE:
+            result['result'] = collect_senz_columns(incoming_data)
+            result['code'] = 0
+            result['message'] = 'success'
+        elif session_api:
+            senz_tuples = iter_session_senz_lists(incoming_data['session_id'], incoming_data)
+        else:
+            senz_tuples = iter_senz_lists(incoming_data)
+    except Exception, e:
+        logger.exception('<%s>, [log2rawsenz] [Exception] generate result error: %s' % (x_request_id, str(e)))
+        result['code'] = 1
+        result['message'] = '500 Internal Error'
+        return make_response(json.dumps(result), 500)
+
+    if mimetype == COLUMNAR_MIMETYPE:
+        logger.info('<%s>, [log2rawsenz] success! columnar result of %s primary nodes'
+                    % (x_request_id, len(result['result']['primary'])))
+        return Response(json.dumps(result), mimetype=mimetype)
+
+    return Response(_stream_senz_tuples(senz_tuples, mimetype == 'application/x-ndjson', x_request_id),
+                    mimetype=mimetype)
+
+
+def _stream_senz_tuples(senz_tuples, ndjson, x_request_id):
+    """Serialize senz tuples chunk by chunk for a streaming response
+
+    Default output is the usual {'code':, 'message':, 'result': [...]} JSON object,
+    with ndjson every senz tuple is one JSON line instead.
+    """
+    if not ndjson:
+        yield '{"code": 0, "message": "success", "result": ['
+
+    chunk = []
+    count = 0
+    for senz_tuple in senz_tuples:
+        if ndjson:
+            chunk.append(json.dumps(senz_tuple) + '\n')
+        else:
+            chunk.append((', ' if count else '') + json.dumps(senz_tuple))
+        count += 1
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+
+    if not ndjson:
+        chunk.append(']}')
+    yield ''.join(chunk)
+
+    logger.info('<%s>, [log2rawsenz] success! streamed %s senz tuples' % (x_request_id, count))
+
+
+@app.route('/log2rawsenz/batch/', methods=['POST'])
+def senzCollectorBatchAPI():
+
+    x_request_id = get_X_request_Id(request)
+    logger.info('<%s>, [log2rawsenz batch] request from ip:%s, ua:%s'
+                % (x_request_id, request.remote_addr, request.remote_user))
+    result = {'code': 1, 'message': ''}
+
+    # params JSON validate
     try:
-        result['result'] = collect_senz_lists(incoming_data)
+        incoming_data = json.loads(request.data)
+    except ValueError, err_msg:
+        logger.error('<%s>, [log2rawsenz batch] [ValueError] err_msg: %s, params=%s' % (x_request_id, err_msg, request.data))
+        result['message'] = 'Unvalid params: NOT a JSON Object'
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    # params key checking
+    try:
+        jobs = incoming_data['jobs']
+    except (KeyError, TypeError), err_msg:
+        logger.error("<%s>, [log2rawsenz batch] [KeyError] can't find key=%s" % (x_request_id, err_msg))
+        result['message'] = "Params content Error: cant't find key=jobs"
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+    if not isinstance(jobs, list):
+        result['message'] = 'Params content Error: jobs should be a list'
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    try:
+        result['result'] = collect_senz_lists_batch(jobs)
         result['code'] = 0
         result['message'] = 'success'
     except Exception, e:
-        logger.exception('<%s>, [log2rawsenz] [Exception] generate result error: %s' % (x_request_id, str(e)))
+        logger.exception('<%s>, [log2rawsenz batch] [Exception] generate result error: %s' % (x_request_id, str(e)))
         result['code'] = 1
         result['message'] = '500 Internal Error'
         return make_response(json.dumps(result), 500)
 
-    logger.info('<%s>, [log2rawsenz] success! result: %s' % (x_request_id, result['result']))
+    logger.info('<%s>, [log2rawsenz batch] success! job codes: %s'
+                % (x_request_id, [job_result['code'] for job_result in result['result']]))
+    return json.dumps(result)
+
+
+@app.route('/log2rawsenz/numeric/', methods=['POST'])
+def senzTimestampAlignAPI():
+
+    x_request_id = get_X_request_Id(request)
+    logger.info('<%s>, [log2rawsenz numeric] request from ip:%s, ua:%s'
+                % (x_request_id, request.remote_addr, request.remote_user))
+    result = {'code': 1, 'message': ''}
+
+    # params JSON validate
+    try:
+        incoming_data = json.loads(request.data)
+    except ValueError, err_msg:
+        logger.error('<%s>, [log2rawsenz numeric] [ValueError] err_msg: %s, params=%s' % (x_request_id, err_msg, request.data))
+        result['message'] = 'Unvalid params: NOT a JSON Object'
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    # params key checking
+    try:
+        var_filter = incoming_data['filter']
+        primary_timestamps = incoming_data['primary']
+        secondary_timestamps = incoming_data['secondary']
+    except (KeyError, TypeError), err_msg:
+        logger.error("<%s>, [log2rawsenz numeric] [KeyError] can't find key=%s" % (x_request_id, err_msg))
+        result['message'] = "Params Contents Error: Can't find keys ['filter', 'primary', 'secondary']"
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    try:
+        secondary_aligned = align_timestamps(primary_timestamps, secondary_timestamps, var_filter)
+        result['result'] = dict((key, {'matched': matched.tolist(), 'distance': distance.tolist()})
+                                for key, (matched, distance) in secondary_aligned.iteritems())
+        result['code'] = 0
+        result['message'] = 'success'
+    except Exception, e:
+        logger.exception('<%s>, [log2rawsenz numeric] [Exception] generate result error: %s' % (x_request_id, str(e)))
+        result['code'] = 1
+        result['message'] = '500 Internal Error'
+        return make_response(json.dumps(result), 500)
+
+    logger.info('<%s>, [log2rawsenz numeric] success! %s primary timestamps' % (x_request_id, len(primary_timestamps)))
     return json.dumps(result)
 
 
@@ -108,6 +274,51 @@ def get_X_request_Id(request):
     return x_request_id
 
 
+def _refuse_stateless_worker(x_request_id, api_name):
+    """Return an error response if a stateful API is served by a stateless worker, else None
+
+    Stateful APIs keep per user state in one process, nginx should route them
+    to the single stateful worker, see gunicorn_stateful_conf.py.
+    """
+    if STATEFUL_WORKER:
+        return None
+    logger.error('<%s>, [%s] [Deploy Error] stateful API served by a stateless worker, check nginx routing'
+                 % (x_request_id, api_name))
+    result = {'code': 1, 'message': 'stateful API should be routed to the stateful worker'}
+    return make_response(json.dumps(result), 500)
+
+
+def _get_refine_params(incoming_data):
+    """Return (max_gap, fill_strategy, timezone_offset) of a raw2refine request, raise ValueError if unvalid
+    """
+    max_gap = incoming_data.get('maxGap', MAX_GAP_DEFAULT)
+    fill_strategy = incoming_data.get('fillStrategy', FILL_STRATEGY_DEFAULT)
+    timezone_offset = incoming_data.get('timezoneOffset')
+    if not isinstance(max_gap, int) or max_gap < 0:
+        raise ValueError('maxGap=%s should be a non-negative int' % (max_gap,))
+    if fill_strategy not in FILL_STRATEGIES:
+        raise ValueError('fillStrategy=%s should in %s' % (fill_strategy, sorted(FILL_STRATEGIES)))
+    if timezone_offset is not None and not isinstance(timezone_offset, int):
+        raise ValueError('timezoneOffset=%s should be an int of minutes' % (timezone_offset,))
+    return max_gap, fill_strategy, timezone_offset
+
+
+def _map_senz_prob_dicts(data, map_prob_dict):
+    """Apply map_prob_dict on every prob dict of senz in data, data is a senz or a list / dict of them
+    """
+    if isinstance(data, list):
+        return [_map_senz_prob_dicts(elem, map_prob_dict) for elem in data]
+    if 'timestamp' in data:
+        return dict((key, value if key in NOT_PROB_KEYS else map_prob_dict(value)) for key, value in data.iteritems())
+    return dict((key, _map_senz_prob_dicts(value, map_prob_dict)) for key, value in data.iteritems())
+
+
+@app.route('/labels/', methods=['GET'])
+def labelVocabAPI():
+    result = {'code': 0, 'message': 'success', 'result': label_vocab.stable_labels()}
+    return json.dumps(result)
+
+
 @app.route('/raw2refine/', methods=['POST'])
 def behaviorCollectorAPI():
 
@@ -129,20 +340,51 @@ def behaviorCollectorAPI():
     try:
         scale_type  = incoming_data['scaleType']
         senz_list   = incoming_data['senzList']
-        start_scale_value = incoming_data['startScaleValue']
-        end_scale_value = incoming_data['endScaleValue']
-    except KeyError, err_msg:
+        if 'windows' in incoming_data:
+            scale_windows = [(window[0], window[1]) for window in incoming_data['windows']]
+        else:
+            scale_windows = None
+            start_scale_value = incoming_data['startScaleValue']
+            end_scale_value = incoming_data['endScaleValue']
+    except (KeyError, TypeError, IndexError), err_msg:
         logger.error('<%s>, [raw2refine] [KeyError] err_msg: %s, params=%s' % (x_request_id, err_msg, incoming_data))
         result['message'] = "Params Contents Error: Can't find keys " \
-                            "['scaleType', 'senzList', 'startScaleValue', 'endScaleValue']"
+                            "['scaleType', 'senzList', 'startScaleValue', 'endScaleValue'] or ['scaleType', 'senzList', 'windows']"
         result['code'] = 103
         return make_response(json.dumps(result), 400)
 
+    if scale_type == SCALE_PYRAMID and scale_windows is not None:
+        logger.error('<%s>, [raw2refine] [ParamsError] windows with scaleType %s' % (x_request_id, scale_type))
+        result['message'] = "Params Contents Error: scaleType '%s' only accepts 'startScaleValue' and 'endScaleValue'" % (SCALE_PYRAMID)
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    label_codes = incoming_data.get('labelCodes', False)
     try:
-        result['result'] = refine_senz_prob_list(scale_type, start_scale_value, end_scale_value, senz_list)
+        max_gap, fill_strategy, timezone_offset = _get_refine_params(incoming_data)
+        if label_codes:
+            senz_list = _map_senz_prob_dicts(senz_list, decode_prob_dict)
+    except ValueError, err_msg:
+        logger.error('<%s>, [raw2refine] [Input Error] %s' % (x_request_id, err_msg))
+        result['message'] = 'Params Contents Error: %s' % (err_msg)
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    try:
+        if scale_type == SCALE_PYRAMID:
+            result['result'] = refine_senz_prob_pyramid(start_scale_value, end_scale_value, senz_list,
+                                                        max_gap, fill_strategy, timezone_offset)
+        elif scale_windows is None:
+            result['result'] = refine_senz_prob_list(scale_type, start_scale_value, end_scale_value, senz_list,
+                                                     max_gap, fill_strategy, timezone_offset)
+        else:
+            result['result'] = refine_senz_prob_windows(scale_type, scale_windows, senz_list,
+                                                        max_gap, fill_strategy, timezone_offset)
+        if label_codes:
+            result['result'] = _map_senz_prob_dicts(result['result'], encode_prob_dict)
         result['code'] = 0
         result['message'] = 'success'
-        logger.info('<%s>, [raw2refine] success!' % (x_request_id))
+        logger.info('<%s>, [raw2refine] success! bucket cache: %s' % (x_request_id, get_bucket_cache_stats()))
         return json.dumps(result)
 
     except Exception, e:
@@ -152,6 +394,125 @@ def behaviorCollectorAPI():
         return make_response(json.dumps(result), 500)
 
 
+@app.route('/raw2refine/cache/', methods=['GET'])
+def bucketCacheStatsAPI():
+    result = {'code': 0, 'message': 'success', 'result': get_bucket_cache_stats()}
+    return json.dumps(result)
+
+
+@app.route('/raw2refine/stream/', methods=['POST'])
+def behaviorCollectorStreamAPI():
+
+    x_request_id = get_X_request_Id(request)
+
+    logger.info('<%s>, [raw2refine stream] request from ip:%s, ua:%s' % (x_request_id, request.remote_addr, request.remote_user))
+    result = {'code': 1, 'message': ''}
+
+    # rings live in memory of the stateful worker, see config.STATEFUL_WORKER
+    error_response = _refuse_stateless_worker(x_request_id, 'raw2refine stream')
+    if error_response is not None:
+        return error_response
+
+    # params JSON validate
+    try:
+        incoming_data = json.loads(request.data)
+    except ValueError, err_msg:
+        logger.error('<%s>, [raw2refine stream] [ValueError] err_msg: %s, params=%s' % (x_request_id, err_msg, request.data))
+        result['message'] = 'Unvalid params: NOT a JSON Object'
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    # params key checking
+    try:
+        user_id = incoming_data['userId']
+        scale_type = incoming_data['scaleType']
+        start_scale_value = incoming_data['startScaleValue']
+        end_scale_value = incoming_data['endScaleValue']
+        senz_list = incoming_data.get('senzList', [])
+    except (KeyError, TypeError), err_msg:
+        logger.error('<%s>, [raw2refine stream] [KeyError] err_msg: %s, params=%s' % (x_request_id, err_msg, incoming_data))
+        result['message'] = "Params Contents Error: Can't find keys " \
+                            "['userId', 'scaleType', 'startScaleValue', 'endScaleValue']"
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    label_codes = incoming_data.get('labelCodes', False)
+    try:
+        max_gap, fill_strategy, timezone_offset = _get_refine_params(incoming_data)
+        if label_codes:
+            senz_list = _map_senz_prob_dicts(senz_list, decode_prob_dict)
+    except ValueError, err_msg:
+        logger.error('<%s>, [raw2refine stream] [Input Error] %s' % (x_request_id, err_msg))
+        result['message'] = 'Params Contents Error: %s' % (err_msg)
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    try:
+        result['result'] = refine_senz_prob_stream(user_id, scale_type, start_scale_value, end_scale_value, senz_list,
+                                                   max_gap, fill_strategy, timezone_offset)
+        if label_codes:
+            result['result'] = _map_senz_prob_dicts(result['result'], encode_prob_dict)
+        result['code'] = 0
+        result['message'] = 'success'
+        logger.info('<%s>, [raw2refine stream] success! userId: %s' % (x_request_id, user_id))
+        return json.dumps(result)
+
+    except Exception, e:
+        logger.error('<%s>, [raw2refine stream] [Exception] generate result error: %s' % (x_request_id, str(e)))
+        result['code'] = 1
+        result['message'] = '500 Internal Error'
+        return make_response(json.dumps(result), 500)
+
+
+@app.route('/behaviorcollector/', methods=['POST'])
+def behaviorAggregatorAPI():
+
+    x_request_id = get_X_request_Id(request)
+
+    logger.info('<%s>, [behaviorcollector] request from ip:%s, ua:%s' % (x_request_id, request.remote_addr, request.remote_user))
+    result = {'code': 1, 'message': ''}
+
+    # params JSON validate
+    try:
+        incoming_data = json.loads(request.data)
+    except ValueError, err_msg:
+        logger.error('<%s>, [behaviorcollector] [ValueError] err_msg: %s, params=%s' % (x_request_id, err_msg, request.data))
+        result['message'] = 'Unvalid params: NOT a JSON Object'
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    # params key checking
+    try:
+        senz_tuple_lists = incoming_data['senzLists']
+        strategy = incoming_data.get('strategy', COLLECT_STRATEGY_DEFAULT)
+    except (KeyError, TypeError), err_msg:
+        logger.error('<%s>, [behaviorcollector] [KeyError] err_msg: %s, params=%s' % (x_request_id, err_msg, incoming_data))
+        result['message'] = "Params Contents Error: Can't find keys ['senzLists']"
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    if strategy not in COLLECT_STRATEGIES or not isinstance(senz_tuple_lists, list) \
+            or not all(isinstance(senz_tuple_list, list) and senz_tuple_list for senz_tuple_list in senz_tuple_lists):
+        logger.error('<%s>, [behaviorcollector] [Input Error] strategy=%s should in %s, senzLists should be non-empty lists'
+                     % (x_request_id, strategy, sorted(COLLECT_STRATEGIES)))
+        result['message'] = 'Params Contents Error: strategy or senzLists error'
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    try:
+        result['result'] = collect_behaviors(senz_tuple_lists, strategy)
+        result['code'] = 0
+        result['message'] = 'success'
+        logger.info('<%s>, [behaviorcollector] success! %s senz lists' % (x_request_id, len(senz_tuple_lists)))
+        return json.dumps(result)
+
+    except Exception, e:
+        logger.error('<%s>, [behaviorcollector] [Exception] generate result error: %s' % (x_request_id, str(e)))
+        result['code'] = 1
+        result['message'] = '500 Internal Error'
+        return make_response(json.dumps(result), 500)
+
+
 @app.route('/prob2multi/', methods=['POST'])
 def senzListConverter():
     result = {'code':1, 'message':''}
@@ -173,12 +534,30 @@ def senzListConverter():
         prob_senzlist = params['probSenzList']
         strategy = params['strategy']
         mutiSenzList_max_num = params.get('mutiMaxNum', 3)
+        beam_width = params.get('beamWidth', BEAM_WIDTH_DEFAULT)
     except KeyError, err_msg:
         logger.error("<%s>, [prob2mulit] [KeyError] can't find key=%s in params=%s" % (x_request_id, err_msg, params))
         result['message'] = "Params content Error: cant't find key=%s" % (err_msg)
         result['code'] = 103
         return make_response(json.dumps(result), 400)
 
+    if not isinstance(beam_width, int) or beam_width < 1:
+        logger.error('<%s>, [prob2multi] [Input Error] beamWidth=%s should be a positive int' % (x_request_id, beam_width))
+        result['message'] = 'Params content Error: beamWidth should be a positive int'
+        result['code'] = 103
+        return make_response(json.dumps(result), 400)
+
+    label_codes = params.get('labelCodes', False)
+    if label_codes:
+        try:
+            prob_senzlist = [dict(elem, **dict((key, decode_prob_dict(elem[key])) for key in PROB2MULTI_KEYS if key in elem))
+                             for elem in prob_senzlist]
+        except ValueError, err_msg:
+            logger.error('<%s>, [prob2multi] [Input Error] %s' % (x_request_id, err_msg))
+            result['message'] = 'Params content Error: %s' % (err_msg)
+            result['code'] = 103
+            return make_response(json.dumps(result), 400)
+
     logger.info('<%s>, [prob2multi] valid params - prob_senzlist:%s, strategy:%s, mutiSenzList_max_num:%s'
                 % (x_request_id, prob_senzlist, strategy, mutiSenzList_max_num))
 
@@ -186,21 +565,32 @@ def senzListConverter():
     if strategy == 'SELECT_MAX_PROB':
         result['code'] = 0
         result['message'] = 'success'
-        muti_senzlist = prob2muti(prob_senzlist, log(1e-30))
-        muti_senzlist = sorted(muti_senzlist, key=lambda elem: elem['prob'], reverse=True)
-        result['result'] = muti_senzlist[:mutiSenzList_max_num]
-    if strategy == 'SELECT_MAX_N_PROB':
+        result['result'] = prob2muti_top_k(prob_senzlist, mutiSenzList_max_num, log(1e-30))
+    elif strategy == 'SELECT_MAX_N_PROB':
         result['code'] = 0
         result['message'] = 'success'
         muti_senzlist = prob2muti_quick(prob_senzlist, mutiSenzList_max_num, log(1e-30))
         result['result'] = muti_senzlist
+    elif strategy == 'SELECT_BEAM_SEARCH':
+        result['code'] = 0
+        result['message'] = 'success'
+        search_stats = {}
+        result['result'] = prob2muti_beam(prob_senzlist, beam_width, log(1e-30), search_stats)[:mutiSenzList_max_num]
+        logger.info('<%s>, [prob2multi] beam search pruned %s partial senz lists' % (x_request_id, search_stats.get('pruned', 0)))
     else:
-        logger.error('<%s>, [prob2multi] [Input Error] strategy=%s should in ["SELECT_MAX_PROB", "SELECT_MAX_N_PROB"]'
+        logger.error('<%s>, [prob2multi] [Input Error] strategy=%s should in '
+                     '["SELECT_MAX_PROB", "SELECT_MAX_N_PROB", "SELECT_BEAM_SEARCH"]'
                       % (x_request_id, strategy))
         result['message'] = 'strategy error'
         result['code'] = 103
         return make_response(json.dumps(result), 400)
 
+    if label_codes:
+        for muti_senz in result['result']:
+            muti_senz['senzList'] = [dict(senz, **dict((key, label_vocab.encode_wire(senz[key]))
+                                                       for key in PROB2MULTI_KEYS if key in senz))
+                                     for senz in muti_senz['senzList']]
+
     logger.info('<%s>, [prob2multi] success! strategy:%s, code:%s, result:%s'
                 %(x_request_id, strategy, result['code'], result['result']))
     return json.dumps(result)
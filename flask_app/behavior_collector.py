@@ -0,0 +1,122 @@
+# -*- coding: UTF-8 -*-
+
+"""Reduce senz tuples of one scale bucket into a general senz tuple"""
+
+__author__ = ['MeoWoodie', 'jiaying.lu']
+
+__all__ = ['COLLECT_STRATEGIES', 'BehaviorCollector', 'collect_behaviors']
+
+import numpy as np
+
+from label_vocab import label_vocab, get_prob_matrix
+
+
+COLLECT_STRATEGY_DEFAULT = 'first'
+
+
+def _collect_first(prob_matrix, present_matrix, starts, lengths):
+    return prob_matrix[starts], present_matrix[starts]
+
+
+def _collect_mode(prob_matrix, present_matrix, starts, lengths):
+    # every senz tuple votes for its most probable label
+    group_ids = np.repeat(np.arange(len(starts)), lengths)
+    winners = np.where(present_matrix, prob_matrix, -np.inf).argmax(axis=1)
+    votes = np.zeros((len(starts), prob_matrix.shape[1]), dtype=np.float64)
+    np.add.at(votes, (group_ids, winners), present_matrix.any(axis=1))
+    return votes / lengths[:, np.newaxis], votes > 0
+
+
+def _collect_mean(prob_matrix, present_matrix, starts, lengths):
+    return (np.add.reduceat(prob_matrix, starts, axis=0) / lengths[:, np.newaxis],
+            np.logical_or.reduceat(present_matrix, starts, axis=0))
+
+
+def _collect_max_prob(prob_matrix, present_matrix, starts, lengths):
+    # the senz tuple holding the most probable label, the first one if tied
+    row_maxes = np.where(present_matrix, prob_matrix, -np.inf).max(axis=1)
+    group_maxes = np.repeat(np.maximum.reduceat(row_maxes, starts), lengths)
+    rows = np.arange(len(row_maxes))
+    rows = np.minimum.reduceat(np.where(row_maxes == group_maxes, rows, len(rows)), starts)
+    return prob_matrix[rows], present_matrix[rows]
+
+
+# strategies reducing the probs of every group of senz tuples,
+# (prob_matrix, present_matrix, starts, lengths) -> (group_probs, group_presents)
+COLLECT_STRATEGIES = {
+    'first': _collect_first,
+    'mode': _collect_mode,
+    'mean': _collect_mean,
+    'max_prob': _collect_max_prob,
+}
+
+
+def collect_behaviors(senz_tuple_lists, strategy=COLLECT_STRATEGY_DEFAULT):
+    """Reduce every list of senz tuples into a general senz tuple
+
+    All senz tuples of the batch are stacked into one label-by-tuple matrix
+    per prob key, every list is then reduced as a slice of the matrix.
+
+    first: probs of the first senz tuple
+    mode: share of senz tuples whose most probable label is each label
+    mean: arithmetic average of probs, missing labels count as 0
+    max_prob: probs of the senz tuple holding the most probable label
+
+    Parameters
+    ----------
+    senz_tuple_lists: list, shape(1, g)
+      elems are non-empty list of senz tuples, senz tuples are dict,
+      contains timestamp and prob_lists such as motionProb, soundProb,
+      a prob_list missing in a senz tuple counts as empty
+    strategy: string, default COLLECT_STRATEGY_DEFAULT
+      must in COLLECT_STRATEGIES
+
+    Returns
+    -------
+    general_senz_tuples: list, shape(1, g)
+      elems are dict, contains prob_lists and the average timestamp
+    """
+    collect = COLLECT_STRATEGIES[strategy]
+    if not senz_tuple_lists:
+        return []
+
+    lengths = np.array([len(senz_tuple_list) for senz_tuple_list in senz_tuple_lists], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    senz_tuples = [senz_tuple for senz_tuple_list in senz_tuple_lists for senz_tuple in senz_tuple_list]
+
+    timestamps = np.array([senz_tuple['timestamp'] for senz_tuple in senz_tuples], dtype=np.int64)
+    general_senz_tuples = [{'timestamp': timestamp}
+                           for timestamp in (np.add.reduceat(timestamps, starts) // lengths).tolist()]
+
+    # only prob dicts are reduced, other fields such as objectId are dropped
+    vocab = label_vocab.local()
+    prob_keys = []
+    for senz_tuple in senz_tuples:
+        prob_keys.extend(key for key, value in senz_tuple.iteritems() if isinstance(value, dict) and key not in prob_keys)
+    for key in prob_keys:
+        label_codes, prob_matrix, present_matrix = get_prob_matrix([senz_tuple.get(key, {}) for senz_tuple in senz_tuples],
+                                                                   vocab)
+        if not len(label_codes):
+            for general_senz_tuple in general_senz_tuples:
+                general_senz_tuple[key] = {}
+            continue
+        group_probs, group_presents = collect(prob_matrix, present_matrix, starts, lengths)
+        labels = [vocab.decode(code) for code in label_codes.tolist()]
+        for general_senz_tuple, probs, presents in zip(general_senz_tuples, group_probs.tolist(), group_presents.tolist()):
+            general_senz_tuple[key] = dict((label, prob) for label, prob, present in zip(labels, probs, presents)
+                                           if present)
+
+    return general_senz_tuples
+
+
+def BehaviorCollector(input_data, strategy=COLLECT_STRATEGY_DEFAULT):
+    '''
+    Behavior Collector
+
+    It's used for getting a general senz tuple from a senz list.
+    Senz from the list has the same scale value.
+    We assumed that they have a general attribute cause of being generated at same time.
+
+    :return: A general senz tuple, with timestamp and every prob list of senz, see collect_behaviors.
+    '''
+    return collect_behaviors([input_data], strategy)[0]
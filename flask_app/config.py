@@ -1,6 +1,6 @@
 __author__ = 'jiaying.lu'
 
-__all__ = ["LOGENTRIES_TOKEN", "BUGSNAG_TOKEN", "APP_ENV"]
+__all__ = ["LOGENTRIES_TOKEN", "BUGSNAG_TOKEN", "APP_ENV", "STATEFUL_WORKER"]
 import os
 
 # Settings
@@ -38,3 +38,7 @@ finally:
     else:
         LOGENTRIES_TOKEN = LOGENTRIES_LOCAL_TOKEN
         BUGSNAG_TOKEN = BUGSNAG_LOCAL_TOKEN
+
+# APIs keeping per user state in memory must be served by one process only,
+# see gunicorn_stateful_conf.py. A process not started by gunicorn is alone.
+STATEFUL_WORKER = os.environ.get("STATEFUL_WORKER", "1") == "1"
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""Process-wide vocabulary of senz labels with integer codes"""
+
+__author__ = 'jiaying.lu'
+__all__ = ['STARTUP_LABELS', 'RUNTIME_LABEL_CAPACITY', 'LabelVocab', 'LocalLabelVocab', 'label_vocab', 'encode_prob_dict',
+           'decode_prob_dict', 'get_prob_matrix']
+
+import itertools
+import threading
+
+import numpy as np
+
+
+# labels interned at startup, their codes are list positions and the same
+# in every worker process, so only append new labels at the end
+STARTUP_LABELS = [
+    # motion
+    'Riding', 'Walking', 'Running', 'Driving', 'Sitting',
+    # location
+    'restaurant', 'resident', 'school',
+    # sound
+    'talk', 'sing', 'shot',
+]
+RUNTIME_LABEL_CAPACITY = 4096  # max labels interned after startup per process, see LocalLabelVocab
+
+
+class LabelVocab(object):
+    """Append-only mapping between labels and integer codes
+
+    Labels first seen at runtime get the next free code, which is only
+    valid in the current worker process. Codes below stable_size come
+    from the startup labels and can be sent over the wire.
+
+    Parameters
+    ----------
+    labels: list
+      labels interned at startup
+    max_size: int or None
+      max number of labels, new labels beyond it are not interned,
+      None means no limit
+    """
+
+    def __init__(self, labels=(), max_size=None):
+        self._labels = []
+        self._codes = {}
+        self._lock = threading.Lock()
+        self.max_size = None
+        for label in labels:
+            self.encode(label)
+        self.stable_size = len(self._labels)
+        self.max_size = max_size
+
+    def __len__(self):
+        return len(self._labels)
+
+    def __contains__(self, label):
+        return label in self._codes
+
+    def encode(self, label):
+        """Return code of label, intern label if it is new
+
+        Return None if label is new and the vocabulary is full, see LocalLabelVocab.
+        """
+        code = self._codes.get(label)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(label)
+                if code is None:
+                    if self.max_size is not None and len(self._labels) >= self.max_size:
+                        return None
+                    code = len(self._labels)
+                    self._labels.append(label)
+                    self._codes[label] = code
+        return code
+
+    def decode(self, code):
+        return self._labels[code]
+
+    def stable_labels(self):
+        """Return labels whose codes are shared by all worker processes, indexed by code
+        """
+        return self._labels[:self.stable_size]
+
+    def encode_wire(self, label):
+        """Return code of label if it is stable, otherwise label itself
+        """
+        code = self._codes.get(label)
+        if code is None or code >= self.stable_size:
+            return label
+        return code
+
+    def decode_wire(self, key):
+        """Return label of a wire key, a stable code or a label
+
+        Raise ValueError if key is a code out of stable codes.
+        """
+        if isinstance(key, (int, long)) or (isinstance(key, basestring) and key.isdigit()):
+            code = int(key)
+            if code >= self.stable_size:
+                raise ValueError('label code=%s should be less than %s' % (key, self.stable_size))
+            return self._labels[code]
+        return key
+
+    def local(self):
+        """Return a LocalLabelVocab on top of this vocabulary, for one request
+        """
+        return LocalLabelVocab(self)
+
+
+class LocalLabelVocab(object):
+    """Label codes of one request on top of a shared LabelVocab
+
+    Labels the shared vocabulary has no room for get negative codes, which
+    are only valid in this object, so they never leave the request.
+
+    Parameters
+    ----------
+    vocab: LabelVocab
+    """
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+        self._labels = []
+        self._codes = {}
+
+    def encode(self, label):
+        code = self.vocab.encode(label)
+        if code is None:
+            code = self._codes.get(label)
+            if code is None:
+                self._labels.append(label)
+                code = -len(self._labels)
+                self._codes[label] = code
+        return code
+
+    def __len__(self):
+        """Return number of labels with local codes
+        """
+        return len(self._labels)
+
+    def decode(self, code):
+        if code < 0:
+            return self._labels[-code - 1]
+        return self.vocab.decode(code)
+
+
+label_vocab = LabelVocab(STARTUP_LABELS, max_size=len(STARTUP_LABELS) + RUNTIME_LABEL_CAPACITY)
+
+
+def encode_prob_dict(prob_dict):
+    """Replace stable labels of prob_dict by their codes
+    """
+    return dict((label_vocab.encode_wire(label), prob) for label, prob in prob_dict.iteritems())
+
+
+def decode_prob_dict(prob_dict):
+    """Replace label codes of prob_dict by their labels, raise ValueError for unknown codes
+    """
+    return dict((label_vocab.decode_wire(key), prob) for key, prob in prob_dict.iteritems())
+
+
+def get_prob_matrix(prob_list, vocab):
+    """Intern labels of prob_list into columns of a dense matrix
+
+    Parameters
+    ----------
+    prob_list: array_like, shape(1, n)
+      elems are dict, with string keys and float values
+    vocab: LabelVocab or LocalLabelVocab
+      encodes the labels, use a LocalLabelVocab unless all labels are known
+
+    Returns
+    -------
+    label_codes: np.ndarray, shape(l,), int64
+      code in vocab of the label of each column, in order of first appearance
+    prob_matrix: np.ndarray, shape(n, l), float64
+      prob_matrix[i, j] is prob_list[i][label of column j], 0 if missing
+    present_matrix: np.ndarray, shape(n, l), bool
+      present_matrix[i, j] is True if prob_list[i] has label of column j
+    """
+    label_columns = {}
+    columns = [label_columns.setdefault(label, len(label_columns))
+               for label in itertools.chain.from_iterable(prob_list)]
+    values = list(itertools.chain.from_iterable(elem.itervalues() for elem in prob_list))
+    rows = np.repeat(np.arange(len(prob_list)), [len(elem) for elem in prob_list])
+    labels = sorted(label_columns, key=label_columns.get)
+
+    # every distinct label is encoded once
+    label_codes = np.array([vocab.encode(label) for label in labels], dtype=np.int64)
+    prob_matrix = np.zeros((len(prob_list), len(labels)), dtype=np.float64)
+    prob_matrix[rows, columns] = values
+    present_matrix = np.zeros((len(prob_list), len(labels)), dtype=bool)
+    present_matrix[rows, columns] = True
+
+    return label_codes, prob_matrix, present_matrix
@@ -3,13 +3,40 @@
 """Align time sequences by length and time distribution"""
 
 __author__ = 'jiaying.lu'
-__all__ = ['generate_sequences_measures', 'collect_senz_lists', 'choose_primary_key']
+__all__ = ['generate_sequences_measures', 'collect_senz_lists', 'choose_primary_key', 'ALIGN_MODES', 'align_timestamps',
+           'align_senz_lists', 'iter_senz_lists', 'collect_senz_columns', 'collect_senz_lists_batch',
+           'iter_session_senz_lists']
 
+import bisect
+import json
 import logging
+import multiprocessing
+import os
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
+from lru_store import LRUStore
+
 logger = logging.getLogger('logentries')
 TIME_SEG_NUM = 3
+ALIGN_MODE_DEFAULT = 'merge'
+# every gunicorn worker has its own pool, so the cores are shared out among workers
+BATCH_POOL_SIZE = int(os.environ.get('BATCH_POOL_SIZE',
+                                     max(1, multiprocessing.cpu_count() // int(os.environ.get('GUNICORN_WORKERS', 1)))))
+ALIGN_THREAD_POOL_SIZE = multiprocessing.cpu_count()
+ALIGN_THREAD_MIN_NODES = 4096  # primary nodes needed before numpy alignment goes to the thread pool
+
+SESSION_CAPACITY = 1024  # max sessions kept per worker process
+SESSION_MAX_EVENTS = 20000  # max indexed nodes per secondary key of a session
+SESSION_MAX_TOTAL_EVENTS = 1000000  # max indexed nodes of all sessions per worker process
+
+_batch_pool = None  # created lazily, once per worker process
+_align_thread_pool = None  # (pid, pool), created lazily, once per process
+_sessions = LRUStore(SESSION_CAPACITY, weigh=lambda session: _get_session_events(session),
+                     max_weight=SESSION_MAX_TOTAL_EVENTS)
+_sessions_lock = threading.Lock()  # so a session is created once by concurrent requests
 
 
 def _get_sequence_length(sequence):
@@ -74,17 +101,15 @@ def _get_time_distribution(sequence, time_seq_start,
     time_dis: float
       measure of time distribution
     """
-    sequence_time_slice = lambda sequence, start, end: filter(lambda e: e >= start and e < end, sequence)
-
-    time_dis = 1  # cause time_dis = TT seg_dis(i)
-    time_slice_nodes = [(time_seq_start + i * time_seg_len, time_seq_start + (i + 1) * time_seg_len)
-                        for i in xrange(time_seg_num)]
+    if time_seg_len <= 0:
+        return 0
 
-    for start, end in time_slice_nodes:
-        sequence_seg = sequence_time_slice(sequence, start, end)
-        time_dis *= len(sequence_seg)
+    # count every segment with one searchsorted pass, cause time_dis = TT seg_dis(i)
+    sequence = np.sort(np.asarray(sequence))
+    time_slice_nodes = time_seq_start + np.arange(time_seg_num + 1) * time_seg_len
+    seg_dis = np.diff(np.searchsorted(sequence, time_slice_nodes, side='left'))
 
-    return time_dis
+    return int(np.prod(seg_dis))
 
 
 def generate_sequences_measures(sequence_list):
@@ -98,21 +123,19 @@ def generate_sequences_measures(sequence_list):
 
     Returns
     -------
-    measures: array_like, shape(m, 3)
+    measures: np.ndarray, shape(m, 3)
       Measures of m time sequence,
       each time sequence has 3 measures - length, time length, time dis
     """
-    measures = []
+    measures = np.zeros((len(sequence_list), 3), dtype=np.int64)
 
     time_seq_start, time_seg_len = _get_time_distribution_params(sequence_list)
 
-    for sequence in sequence_list:
-        sequence_length = _get_sequence_length(sequence)
-        sequence_time_len = _get_sequence_time_length(sequence)
-        sequence_time_dis = _get_time_distribution(sequence, time_seq_start, time_seg_len)
-        measures.append([sequence_length, sequence_time_len, sequence_time_dis])
+    for index, sequence in enumerate(sequence_list):
+        measures[index, 0] = _get_sequence_length(sequence)
+        measures[index, 1] = _get_sequence_time_length(sequence)
+        measures[index, 2] = _get_time_distribution(sequence, time_seq_start, time_seg_len)
 
-    measures = np.array(measures)
     return measures
 
 
@@ -129,39 +152,26 @@ def choose_primary_key(timelines):
     Returns
     -------
     primary_key: string, must be one key of data
-      primary_key during to best measures
+      primary_key during to best measures, '' if no key is measurable
     """
-    data_shallow = timelines.copy()  # Use data.copy to avoid change data's attributes
-
     # filter empty list of data
-    sequence_list_keys = filter(lambda e: len(data_shallow[e]) > 0, data_shallow.keys())
-    sequence_list_values = filter(lambda e: len(e) > 0, data_shallow.values())
+    sequence_list_keys = [key for key, sequence in timelines.iteritems() if len(sequence) > 0]
+    if not sequence_list_keys:
+        return ''
 
     # generate measures
-    sequence_list = []
-    for sequence in sequence_list_values:
-        sequence = [elem['timestamp'] for elem in sequence]
-        sequence_list.append(sequence)
-    sequence_list = np.array(sequence_list)
-    measures = generate_sequences_measures(sequence_list)
-
-    # find the best measure
-    measures_reduced = []
-    for measure_list in measures:
-        mul_measure = reduce(lambda x, y: x * y, measure_list)
-        measures_reduced.append(mul_measure)
-    if max(measures_reduced) == 0:  # 乘法的指标容易产生最大为0的结果
-        measures_reduced = []
-        for measure_list in measures:
-            mul_measure = reduce(lambda x, y: x + y, measure_list)
-            measures_reduced.append(mul_measure)
-    if max(measures_reduced) == 0:  # 如果加法的指标还是0，就返回空结果
+    sequence_list = [np.array([elem['timestamp'] for elem in timelines[key]]) for key in sequence_list_keys]
+    measures = generate_sequences_measures(sequence_list).astype(np.float64)
+
+    # find the best measure, all keys are scored at once
+    measures_reduced = measures.prod(axis=1)
+    if measures_reduced.max() == 0:  # 乘法的指标容易产生最大为0的结果
+        measures_reduced = measures.sum(axis=1)
+    if measures_reduced.max() == 0:  # 如果加法的指标还是0，就返回空结果
         return ''
-    best_measure = max(measures_reduced)
 
     # get primary key
-    primary_key = sequence_list_keys[measures_reduced.index(best_measure)]
-    # data['primaryKey'] = primary_key  # will change input param
+    primary_key = sequence_list_keys[int(np.argmax(measures_reduced))]
 
     return primary_key
 
@@ -248,86 +258,685 @@ def _generate_senz_collected(primary_sequence, secondary_sequences, var_filter):
     """
     senz_collected = []
     for primary_key, primary_value in primary_sequence.iteritems():
-        for node in primary_value:
+        primary_value = np.asarray(primary_value, dtype=np.int64)
+        secondary_aligned = align_timestamps(primary_value, secondary_sequences, var_filter)
+
+        for index, node in enumerate(primary_value.tolist()):
             senz_collected_elem = {}
             senz_collected_elem[primary_key] = {'timestamp': node}
-            for secondary_key, secondary_value in secondary_sequences.iteritems():
-                # handle empty case
-                if len(secondary_value) < 1:
-                    nearest_node = {
-                        "objectId": "counterfeitObjectId",
-                        "userRawdataId": "counterfeitRawdataId",
-                        "timestamp": node
-                    }
-                    senz_collected_elem[secondary_key] = nearest_node
-                    continue
-
-                nearest_node = {'timestamp': _find_nearest_node(node, secondary_value)}
-                if (node - nearest_node['timestamp']) ** 2 > var_filter:
-                    nearest_node = {
-                        "objectId": "counterfeitObjectId",
-                        "userRawdataId": "counterfeitRawdataId",
-                        "timestamp": node
-                    }
-                senz_collected_elem[secondary_key] = nearest_node
-
+            for secondary_key, (matched, distance) in secondary_aligned.iteritems():
+                if matched[index] < 0:
+                    senz_collected_elem[secondary_key] = _counterfeit_node(node)
+                else:
+                    senz_collected_elem[secondary_key] = {'timestamp': node + int(distance[index])}
             senz_collected.append(senz_collected_elem)
 
     return senz_collected
 
 
+def _counterfeit_node(timestamp):
+    """Return a counterfeit node standing for a missing secondary node
+    """
+    return {
+        "objectId": "counterfeitObjectId",
+        "userRawdataId": "counterfeitRawdataId",
+        "timestamp": timestamp
+    }
+
+
+def _is_sorted(node_list):
+    """Return True if node_list is in timestamp order, checked in one pass
+
+    Parameters
+    ----------
+    node_list: array_like, shape(1, n)
+      elems in node_list are dict, must have a key 'timestamp'
+
+    Returns
+    -------
+    is_sorted: bool
+    """
+    for index in xrange(len(node_list) - 1):
+        if node_list[index]['timestamp'] > node_list[index+1]['timestamp']:
+            return False
+    return True
+
+
+def _index_timeline(node_list, presorted=False):
+    """Sort node_list by timestamp once, for repeated nearest node lookups
+
+    Nodes sharing a timestamp only keep the first one of node_list,
+    which is the node _find_nearest_timestamp would return.
+
+    Parameters
+    ----------
+    node_list: array_like, shape(1, n)
+      elems in node_list are dict, must have a key 'timestamp'
+    presorted: bool, default False
+      node_list is known to be in timestamp order, skip sorting
+
+    Returns
+    -------
+    timestamps: list, shape(1, m)
+      sorted unique timestamps, m <= n
+    positions: list, shape(1, m)
+      positions[i] is the index in node_list of the node with timestamps[i]
+    """
+    if presorted:
+        order = xrange(len(node_list))
+    else:
+        order = sorted(xrange(len(node_list)), key=lambda i: node_list[i]['timestamp'])
+
+    timestamps = []
+    positions = []
+    for position in order:
+        timestamp = node_list[position]['timestamp']
+        if timestamps and timestamps[-1] == timestamp:
+            continue
+        timestamps.append(timestamp)
+        positions.append(position)
+
+    return timestamps, positions
+
+
+def _nearest_around(timestamps, index, primary_timestamp):
+    """Return index of the most nearest timestamp, given its insertion point
+
+    On a tie the earlier timestamp wins, same as _find_nearest_timestamp.
+
+    Parameters
+    ----------
+    timestamps: list, shape(1, m)
+      assert len(timestamps) > 0
+      sorted unique timestamps
+    index: int
+      index of the first timestamp >= primary_timestamp, m if there is none
+    primary_timestamp: timestamp
+
+    Returns
+    -------
+    index: int
+      index in timestamps
+    """
+    if index == 0:
+        return 0
+    if index == len(timestamps):
+        return index - 1
+
+    if primary_timestamp - timestamps[index-1] <= timestamps[index] - primary_timestamp:
+        return index - 1
+    return index
+
+
+def _bisect_nearest(timestamps, primary_timestamp):
+    """Return index of the most nearest timestamp with binary search
+
+    Parameters
+    ----------
+    timestamps: list, shape(1, m)
+      assert len(timestamps) > 0
+      sorted unique timestamps
+    primary_timestamp: timestamp
+
+    Returns
+    -------
+    index: int
+      index in timestamps
+    """
+    return _nearest_around(timestamps, bisect.bisect_left(timestamps, primary_timestamp), primary_timestamp)
+
+
+def _align_bisect(primary_timestamps, timeline_index, var_filter):
+    """Align primary timestamps with one indexed secondary timeline
+
+    Parameters
+    ----------
+    primary_timestamps: array_like, shape(1, p)
+    timeline_index: tuple, (timestamps, positions)
+      result of _index_timeline
+    var_filter: float
+      matched node's variance should less than var_filter
+
+    Returns
+    -------
+    matched: list, shape(1, p)
+      index in secondary node_list of each primary timestamp's nearest node,
+      -1 if there is no node or the nearest one is filtered
+    """
+    timestamps, positions = timeline_index
+    if len(timestamps) < 1:
+        return [-1] * len(primary_timestamps)
+
+    matched = []
+    for primary_timestamp in primary_timestamps:
+        index = _bisect_nearest(timestamps, primary_timestamp)
+        if (primary_timestamp - timestamps[index]) ** 2 > var_filter:
+            matched.append(-1)
+        else:
+            matched.append(positions[index])
+
+    return matched
+
+
+def _align_numpy(primary_timestamps, timeline_index, var_filter):
+    """Align primary timestamps with one indexed secondary timeline, vectorized
+
+    Same result as _align_bisect, but every primary timestamp is resolved
+    by a single np.searchsorted call on int64 arrays.
+
+    Parameters
+    ----------
+    primary_timestamps: array_like, shape(1, p)
+    timeline_index: tuple, (timestamps, positions)
+      result of _index_timeline
+    var_filter: float
+      matched node's variance should less than var_filter
+
+    Returns
+    -------
+    matched: np.ndarray, shape(p,), int64
+      index in secondary node_list of each primary timestamp's nearest node,
+      -1 if there is no node or the nearest one is filtered
+    """
+    primary_timestamps = np.asarray(primary_timestamps, dtype=np.int64)
+    timestamps, positions = timeline_index
+    if len(timestamps) < 1:
+        return np.full(len(primary_timestamps), -1, dtype=np.int64)
+
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.int64)
+
+    right = np.searchsorted(timestamps, primary_timestamps, side='left')
+    left = np.clip(right - 1, 0, len(timestamps) - 1)
+    right = np.clip(right, 0, len(timestamps) - 1)
+    nearest = np.where(primary_timestamps - timestamps[left] <= timestamps[right] - primary_timestamps, left, right)
+
+    distance = (primary_timestamps - timestamps[nearest]).astype(np.float64)
+    matched = positions[nearest]
+    matched[distance ** 2 > var_filter] = -1
+
+    return matched
+
+
+def _align_merge(primary_timestamps, timeline_index, var_filter):
+    """Align sorted primary timestamps with one indexed secondary timeline
+
+    Two-pointer merge join, O(P+M) without any sorting, so
+    primary_timestamps must be in ascending order.
+
+    Parameters
+    ----------
+    primary_timestamps: array_like, shape(1, p)
+      in ascending order
+    timeline_index: tuple, (timestamps, positions)
+      result of _index_timeline
+    var_filter: float
+      matched node's variance should less than var_filter
+
+    Returns
+    -------
+    matched: list, shape(1, p)
+      index in secondary node_list of each primary timestamp's nearest node,
+      -1 if there is no node or the nearest one is filtered
+    """
+    timestamps, positions = timeline_index
+    if len(timestamps) < 1:
+        return [-1] * len(primary_timestamps)
+
+    matched = []
+    right = 0
+    for primary_timestamp in primary_timestamps:
+        while right < len(timestamps) and timestamps[right] < primary_timestamp:
+            right += 1
+        index = _nearest_around(timestamps, right, primary_timestamp)
+        if (primary_timestamp - timestamps[index]) ** 2 > var_filter:
+            matched.append(-1)
+        else:
+            matched.append(positions[index])
+
+    return matched
+
+
+ALIGN_MODES = {
+    'bisect': _align_bisect,
+    'numpy': _align_numpy,
+    'merge': _align_merge,
+}
+
+
+def _index_timestamps(timestamps):
+    """Sort pure timestamps once, vectorized version of _index_timeline
+
+    Parameters
+    ----------
+    timestamps: array_like, shape(1, n)
+      pure integer(timestamp)
+
+    Returns
+    -------
+    timestamps: np.ndarray, shape(m,), int64
+      sorted unique timestamps, m <= n
+    positions: np.ndarray, shape(m,), int64
+      positions[i] is the index in input timestamps of the first timestamps[i]
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    order = np.argsort(timestamps, kind='mergesort')
+    sorted_timestamps = timestamps[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_timestamps[1:] != sorted_timestamps[:-1]
+    return sorted_timestamps[first], order[first]
+
+
+def align_timestamps(primary_timestamps, secondary_timestamps, var_filter):
+    """Align pure integer timelines, without any node dict
+
+    Fast path for callers that only need timestamps, every secondary
+    timeline is aligned with one np.searchsorted call.
+
+    Parameters
+    ----------
+    primary_timestamps: array_like, shape(1, p)
+      pure integer(timestamp)
+    secondary_timestamps: dict, {'key0':, 'key1':, ...}
+      values are array_like, pure integer(timestamp)
+    var_filter: float
+      matched timestamp's variance should less than var_filter
+
+    Returns
+    -------
+    secondary_aligned: dict, {'key0': (matched, distance), ...}
+      matched: np.ndarray, shape(p,), int64
+        index in the secondary timestamps nearest to each primary timestamp,
+        -1 if there is none or it is filtered
+      distance: np.ndarray, shape(p,), int64
+        matched timestamp - primary timestamp, 0 where matched is -1
+    """
+    primary_timestamps = np.asarray(primary_timestamps, dtype=np.int64)
+
+    secondary_aligned = {}
+    for key, timestamps in secondary_timestamps.iteritems():
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        matched = _align_numpy(primary_timestamps, _index_timestamps(timestamps), var_filter)
+        distance = np.zeros(len(primary_timestamps), dtype=np.int64)
+        found = matched >= 0
+        distance[found] = timestamps[matched[found]] - primary_timestamps[found]
+        secondary_aligned[key] = (matched, distance)
+
+    return secondary_aligned
+
+
+def _align_numpy_task(task):
+    """Index and align one secondary timeline in numpy mode
+
+    Apart from reading timestamps out of node dicts, the work is done by
+    NumPy kernels which release the GIL, so tasks can share a thread pool.
+
+    Parameters
+    ----------
+    task: tuple, (primary_timestamps, node_list, var_filter)
+
+    Returns
+    -------
+    matched: np.ndarray, shape(p,), int64
+      see _align_numpy
+    """
+    primary_timestamps, node_list, var_filter = task
+    timestamps = [node['timestamp'] for node in node_list]
+    return _align_numpy(primary_timestamps, _index_timestamps(timestamps), var_filter)
+
+
+def _get_align_thread_pool():
+    """Return the align thread pool of the current process
+
+    A forked process, like a batch pool process, inherits the pool but not
+    its threads, so it gets a pool of its own.
+    """
+    global _align_thread_pool
+
+    pid = os.getpid()
+    if _align_thread_pool is None or _align_thread_pool[0] != pid:
+        _align_thread_pool = (pid, ThreadPool(ALIGN_THREAD_POOL_SIZE))
+    return _align_thread_pool[1]
+
+
+def align_senz_lists(data):
+    """Choose primary key and align every secondary timeline with it
+
+    Every secondary timeline is indexed once, then each primary node finds
+    its nearest secondary node with the engine named by data['align_mode']:
+      'bisect': binary search per primary node, O((P+M) log M)
+      'numpy': one np.searchsorted call per secondary key, keys run in parallel
+               on a shared thread pool of ALIGN_THREAD_POOL_SIZE for large requests
+      'merge': two-pointer merge join, O(P+M), the default;
+               falls back to 'bisect' unless every timeline is already sorted
+
+    Parameters
+    ----------
+    data: dict, {'filter':, 'primaryKey':, 'timelines':{'key0':, 'key1':, ...}, 'align_mode':}
+      raw log data from API request, 'align_mode' is optional
+
+    Returns
+    -------
+    primary_key: string
+    secondary_matched: dict, {'key0':, 'key1':, ...}
+      values are array_like, shape(1, p), index in the secondary timeline
+      matched by each primary node, -1 for a counterfeit node
+    """
+    align_mode = data.get('align_mode', ALIGN_MODE_DEFAULT)
+
+    # Step 1: choose data's primary key
+    primary_key = choose_primary_key(data['timelines'])
+    if not primary_key:
+        primary_key = data['primary_key']
+    logger.info('[Choose PK] primary_key: %s' % (primary_key))
+
+    # Step 2: align secondary sequences with primary sequence
+    primary_timestamps = [p_nodes['timestamp'] for p_nodes in data['timelines'][primary_key]]
+    secondary_keys = [key for key in sorted(data['timelines']) if key != primary_key]
+
+    if align_mode == 'numpy':
+        primary_timestamps = np.asarray(primary_timestamps, dtype=np.int64)
+        tasks = [(primary_timestamps, data['timelines'][key], data['filter']) for key in secondary_keys]
+        if len(tasks) > 1 and ALIGN_THREAD_POOL_SIZE > 1 and len(primary_timestamps) >= ALIGN_THREAD_MIN_NODES:
+            matched_list = _get_align_thread_pool().map(_align_numpy_task, tasks)
+        else:
+            matched_list = [_align_numpy_task(task) for task in tasks]
+        return primary_key, dict(zip(secondary_keys, matched_list))
+
+    presorted = False
+    if align_mode == 'merge':
+        presorted = all(_is_sorted(node_list) for node_list in data['timelines'].itervalues())
+        if not presorted:
+            logger.info('[Align] timelines are not sorted, fall back to bisect')
+            align_mode = 'bisect'
+    align = ALIGN_MODES[align_mode]
+
+    secondary_matched = {}
+    for key in secondary_keys:
+        secondary_matched[key] = align(primary_timestamps, _index_timeline(data['timelines'][key], presorted), data['filter'])
+
+    return primary_key, secondary_matched
+
+
+def _generate_senz_tuples(timelines, primary_key, secondary_matched):
+    """Yield senz tuples one by one from aligned timelines
+
+    Parameters
+    ----------
+    timelines: dict, {'key0':, 'key1:, 'key2':, ...}
+    primary_key: string
+    secondary_matched: dict
+      result of align_senz_lists
+
+    Yields
+    ------
+    senz_collected_elem: dict, a senz tuple
+    """
+    for index, p_nodes in enumerate(timelines[primary_key]):
+        senz_collected_elem = {primary_key: p_nodes}
+        for secondary_key, matched in secondary_matched.iteritems():
+            if matched[index] < 0:
+                senz_collected_elem[secondary_key] = _counterfeit_node(p_nodes['timestamp'])
+            else:
+                senz_collected_elem[secondary_key] = timelines[secondary_key][matched[index]]
+        yield senz_collected_elem
+
+
+def iter_senz_lists(data):
+    """Return an iterator of senz tuples according to primary_key
+
+    Alignment runs before this function returns, so invalid data raises here
+    rather than halfway through the iteration; the senz tuples themselves
+    are only built while iterating.
+
+    Parameters
+    ----------
+    data: dict, {'filter':, 'primaryKey':, 'timelines':{'key0':, 'key1':, ...}, 'align_mode':}
+      raw log data from API request, 'align_mode' is optional
+
+    Returns
+    -------
+    senz_tuples: generator of dict
+    """
+    primary_key, secondary_matched = align_senz_lists(data)
+    return _generate_senz_tuples(data['timelines'], primary_key, secondary_matched)
+
+
+def collect_senz_columns(data):
+    """Collect senz lists in compact columnar form
+
+    Instead of repeating node dicts in every senz tuple, secondary nodes are
+    referred to by their index in the input timeline, -1 stands for a
+    counterfeit node whose timestamp is the primary node's one.
+
+    Parameters
+    ----------
+    data: dict, {'filter':, 'primaryKey':, 'timelines':{'key0':, 'key1':, ...}, 'align_mode':}
+      raw log data from API request, 'align_mode' is optional
+
+    Returns
+    -------
+    senz_columns: dict, {'primaryKey':, 'primary': [{}, {}], 'matched': {'key0': [], ...}}
+      'matched' values are int32 index lists, same length as 'primary'
+    """
+    primary_key, secondary_matched = align_senz_lists(data)
+
+    matched_columns = {}
+    for key, matched in secondary_matched.iteritems():
+        matched_columns[key] = np.asarray(matched, dtype=np.int32).tolist()
+
+    return {
+        'primaryKey': primary_key,
+        'primary': data['timelines'][primary_key],
+        'matched': matched_columns,
+    }
+
+
 def collect_senz_lists(data):
     """Collect senz lists according to primary_key
 
-    Wrapper of _generate_senz_collected, additional add some preprocess.
+    Wrapper of iter_senz_lists.
 
     Parameters
     ----------
-    data: dict, {'filter':, 'primaryKey':, 'timelines':{'key0':, 'key1':, ...}}
-      raw log data from API request
+    data: dict, {'filter':, 'primaryKey':, 'timelines':{'key0':, 'key1':, ...}, 'align_mode':}
+      raw log data from API request, 'align_mode' is optional
 
     Returns
     -------
     senz_collected: list, [{}, {}, {}]
       elem of senz_collected is a senz tuple
     """
-    # Step 1: choose data's primary key
-    if not choose_primary_key(data['timelines']):
-        primary_key = data['primary_key']
+    return list(iter_senz_lists(data))
+
+
+def _collect_senz_lists_job(job):
+    """Run collect_senz_lists on one batch job, errors are returned as codes
+
+    Parameters
+    ----------
+    job: dict, {'filter':, 'primary_key':, 'timelines':, 'align_mode':}
+      same as collect_senz_lists's data
+
+    Returns
+    -------
+    job_result: dict, {'code':, 'message':, 'result':, 'error':}
+      'result' only exists when code is 0, 'error' is the traceback when code is 1
+    """
+    if not isinstance(job, dict):
+        return {'code': 103, 'message': 'Unvalid params: NOT a JSON Object'}
+    for key in ['filter', 'timelines']:
+        if key not in job:
+            return {'code': 103, 'message': "Params content Error: cant't find key=%s" % (key)}
+    if job.get('align_mode', ALIGN_MODE_DEFAULT) not in ALIGN_MODES:
+        return {'code': 103, 'message': 'align_mode error'}
+
+    try:
+        return {'code': 0, 'message': 'success', 'result': collect_senz_lists(job)}
+    except Exception:
+        # pool processes can't log, the Logentries sender thread doesn't survive fork
+        return {'code': 1, 'message': '500 Internal Error', 'error': traceback.format_exc()}
+
+
+def collect_senz_lists_batch(jobs):
+    """Collect senz lists of many jobs, fanned out over a process pool
+
+    The pool has BATCH_POOL_SIZE processes and is kept for the life of the
+    calling process. A bad job only fails itself, see _collect_senz_lists_job,
+    its error is logged here in the calling process.
+
+    Parameters
+    ----------
+    jobs: list, [{'filter':, 'primary_key':, 'timelines':}, ...]
+      elems are same as collect_senz_lists's data
+
+    Returns
+    -------
+    job_results: list, [{'code':, 'message':, 'result':}, ...]
+      in the same order as jobs
+    """
+    global _batch_pool
+
+    if len(jobs) < 2 or BATCH_POOL_SIZE < 2:
+        job_results = [_collect_senz_lists_job(job) for job in jobs]
     else:
-        primary_key = choose_primary_key(data['timelines'])
-    logger.info('[Choose PK] primary_key: %s' % (primary_key))
+        if _batch_pool is None:
+            _batch_pool = multiprocessing.Pool(BATCH_POOL_SIZE)
+        job_results = _batch_pool.map(_collect_senz_lists_job, jobs)
 
-    # Step 2: generate senz_collected
-    # primary_sequence = {primary_key: data['timelines'][primary_key]}
-    secondary_sequences = {}
-    for key in data['timelines']:
-        if key != primary_key:
-            secondary_sequences[key] = data['timelines'][key]
+    for index, job_result in enumerate(job_results):
+        error = job_result.pop('error', None)
+        if error is not None:
+            logger.error('[Batch] job %s generate result error: %s' % (index, error))
+    return job_results
 
-    # process sequences
-    senz_collected = []
-    for p_nodes in data['timelines'][primary_key]:
-        senz_collected_elem = {primary_key: p_nodes}
-        for secondary_key, secondary_value in secondary_sequences.iteritems():
-            # handle empty case
-            if len(secondary_value) < 1:
-                nearest_node = {
-                    "objectId": "counterfeitObjectId",
-                    "userRawdataId": "counterfeitRawdataId",
-                    "timestamp": p_nodes['timestamp']
-                }
-                senz_collected_elem[secondary_key] = nearest_node
-                continue
-
-            nearest_node = _find_nearest_timestamp(p_nodes['timestamp'], secondary_value)
-            if (p_nodes['timestamp'] - nearest_node['timestamp']) ** 2 > data['filter']:
-                nearest_node = {
-                    "objectId": "counterfeitObjectId",
-                    "userRawdataId": "counterfeitRawdataId",
-                    "timestamp": p_nodes['timestamp']
-                }
-            senz_collected_elem[secondary_key] = nearest_node
-        senz_collected.append(senz_collected_elem)
 
-    return senz_collected
+def _extend_timeline_index(timeline_index, node_list, max_events=SESSION_MAX_EVENTS, min_timestamp=None):
+    """Insert nodes into a session's sorted timeline index, in place
+
+    Nodes are kept as compact JSON strings. Already indexed timestamps keep
+    their first node, so re-uploaded nodes are ignored. Only the newest
+    max_events nodes at or after min_timestamp are kept.
+
+    Parameters
+    ----------
+    timeline_index: tuple, (timestamps, nodes)
+      timestamps are sorted unique, nodes[i] is the JSON of node with timestamps[i]
+    node_list: array_like, shape(1, n)
+      elems in node_list are dict, must have a key 'timestamp'
+    max_events: int, default SESSION_MAX_EVENTS
+    min_timestamp: timestamp or None
+      older nodes are dropped, None keeps them
+    """
+    timestamps, nodes = timeline_index
+    for node in sorted(node_list, key=lambda e: e['timestamp']):
+        timestamp = node['timestamp']
+        if min_timestamp is not None and timestamp < min_timestamp:
+            continue
+        if not timestamps or timestamp > timestamps[-1]:
+            timestamps.append(timestamp)
+            nodes.append(json.dumps(node, separators=(',', ':')))
+            continue
+        index = bisect.bisect_left(timestamps, timestamp)
+        if timestamps[index] != timestamp:
+            timestamps.insert(index, timestamp)
+            nodes.insert(index, json.dumps(node, separators=(',', ':')))
+
+    drop_num = len(timestamps) - max_events
+    if min_timestamp is not None:
+        drop_num = max(drop_num, bisect.bisect_left(timestamps, min_timestamp))
+    if drop_num > 0:
+        del timestamps[:drop_num]
+        del nodes[:drop_num]
+
+
+def _get_session_events(session):
+    """Return number of indexed nodes of a session
+    """
+    return sum(len(timestamps) for timestamps, _ in session['timelines'].itervalues())
+
+
+def iter_session_senz_lists(session_id, data):
+    """Return an iterator of senz tuples of newly arrived primary nodes only
+
+    A session keeps, for one user or device, the primary key chosen by its
+    first request, a sorted index of every secondary timeline, and the
+    latest aligned primary timestamp. New secondary nodes are merged into
+    the index, then only primary nodes after that timestamp are aligned.
+
+    A node farther than sqrt(filter) before that timestamp can't be matched
+    by a later primary node, so it is dropped from the index, using the
+    largest filter the session has seen. Sessions live in a LRUStore of
+    SESSION_CAPACITY sessions and SESSION_MAX_TOTAL_EVENTS indexed nodes.
+
+    The store is per process, so every request of a session must be served
+    by the same process, see the /log2rawsenz/session/ API. Requests of a
+    session are served one at a time by its lock.
+
+    Parameters
+    ----------
+    session_id: string, user or device id
+    data: dict, {'filter':, 'primaryKey':, 'timelines':{'key0':, 'key1':, ...}}
+      raw log data from API request
+
+    Returns
+    -------
+    senz_tuples: generator of dict
+    """
+    with _sessions_lock:
+        session = _sessions.get(session_id)
+        if session is None:
+            primary_key = choose_primary_key(data['timelines'])
+            if not primary_key:
+                primary_key = data['primary_key']
+            session = {'lock': threading.Lock(), 'primary_key': primary_key, 'watermark': None, 'max_filter': 0,
+                       'timelines': {}}
+            _sessions.put(session_id, session)
+
+    with session['lock']:
+        return _update_session(session_id, session, data)
+
+
+def _update_session(session_id, session, data):
+    """Merge a request into its session and align its new primary nodes, see iter_session_senz_lists
+    """
+    primary_key = session['primary_key']
+    session['max_filter'] = max(session['max_filter'], data['filter'])
+    logger.info('[Session] session_id: %s, primary_key: %s' % (session_id, primary_key))
+
+    # Step 1: merge new secondary nodes into session index
+    min_timestamp = _get_session_min_timestamp(session)
+    for key, node_list in data['timelines'].iteritems():
+        if key != primary_key:
+            _extend_timeline_index(session['timelines'].setdefault(key, ([], [])), node_list,
+                                   min_timestamp=min_timestamp)
+
+    # Step 2: align newly arrived primary nodes only, decode matched nodes only
+    watermark = session['watermark']
+    primary_nodes = [p_nodes for p_nodes in data['timelines'].get(primary_key, [])
+                     if watermark is None or p_nodes['timestamp'] > watermark]
+    primary_timestamps = [p_nodes['timestamp'] for p_nodes in primary_nodes]
+
+    timelines = {primary_key: primary_nodes}
+    secondary_matched = {}
+    for key, (timestamps, nodes) in session['timelines'].iteritems():
+        secondary_matched[key] = _align_bisect(primary_timestamps, (timestamps, xrange(len(nodes))), data['filter'])
+        timelines[key] = dict((index, json.loads(nodes[index])) for index in set(secondary_matched[key]) if index >= 0)
+
+    # Step 3: drop nodes no later primary node can match, then re-weigh session
+    if primary_timestamps:
+        session['watermark'] = max(primary_timestamps)
+        min_timestamp = _get_session_min_timestamp(session)
+        for timeline_index in session['timelines'].itervalues():
+            _extend_timeline_index(timeline_index, [], min_timestamp=min_timestamp)
+    _sessions.put(session_id, session)
+
+    return _generate_senz_tuples(timelines, primary_key, secondary_matched)
+
+
+def _get_session_min_timestamp(session):
+    """Return timestamp before which no node can be matched by a later primary node, None if unknown
+    """
+    if session['watermark'] is None:
+        return None
+    return session['watermark'] - session['max_filter'] ** 0.5
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""Bounded in-process store evicting least recently used and idle keys"""
+
+__author__ = 'jiaying.lu'
+__all__ = ['LRUStore']
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUStore(object):
+    """Bounded key-value store, evicts the least recently used key when full
+
+    State lives in one worker process only, so every gunicorn worker
+    keeps its own store.
+
+    Parameters
+    ----------
+    capacity: int
+      max number of keys kept
+    max_idle: float or None
+      seconds a key is kept without being get or put, None means forever
+    weigh: callable or None
+      weight of a value, taken on put, so a value changed in place
+      should be put again
+    max_weight: float or None
+      max total weight of values kept, needs weigh
+    """
+
+    def __init__(self, capacity, max_idle=None, weigh=None, max_weight=None):
+        self.capacity = capacity
+        self.max_idle = max_idle
+        self.weigh = weigh
+        self.max_weight = max_weight
+        self.weight = 0
+        self._items = OrderedDict()  # key -> (value, last access time, weight), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _remove(self, key):
+        value, _, weight = self._items.pop(key)
+        self.weight -= weight
+        return value
+
+    def _evict_idle(self, now):
+        if self.max_idle is None:
+            return
+        while self._items:
+            key, (_, accessed, _) = next(self._items.iteritems())
+            if now - accessed <= self.max_idle:
+                break
+            self._remove(key)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """Return value of key and mark it as most recently used
+        """
+        with self._lock:
+            now = time.time()
+            self._evict_idle(now)
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value, _, weight = self._items.pop(key)
+            self._items[key] = (value, now, weight)
+            return value
+
+    def put(self, key, value):
+        """Set value of key, evict idle keys and least recently used keys beyond capacity or max_weight
+
+        The key just put is kept even if its own weight is over max_weight.
+        """
+        with self._lock:
+            now = time.time()
+            self._evict_idle(now)
+            if key in self._items:
+                self._remove(key)
+            weight = self.weigh(value) if self.weigh is not None else 0
+            self._items[key] = (value, now, weight)
+            self.weight += weight
+            while len(self._items) > self.capacity or \
+                    (self.max_weight is not None and self.weight > self.max_weight and len(self._items) > 1):
+                self._remove(next(self._items.iterkeys()))
+
+    def pop(self, key, default=None):
+        """Remove key and return its value
+        """
+        with self._lock:
+            if key not in self._items:
+                return default
+            return self._remove(key)
+
+    def clear(self):
+        """Remove all keys and reset hit and miss counters
+        """
+        with self._lock:
+            self._items.clear()
+            self.weight = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return size, capacity and hit / miss counters of get(), and total weight if weighed
+        """
+        stats = {'size': len(self._items), 'capacity': self.capacity, 'hits': self.hits, 'misses': self.misses}
+        if self.weigh is not None:
+            stats['weight'] = self.weight
+        return stats
@@ -2,11 +2,34 @@
 
 __author__ = 'jiaying.lu'
 
+import heapq
+import numpy as np
 from numpy import log
 import logging
 
+from label_vocab import label_vocab
+
 logger = logging.getLogger('logentries')
 
+BEAM_WIDTH_DEFAULT = 10  # partial senz lists kept by prob2muti_beam()
+SUFFIX_BOUND_TOLERANCE = 1e-9  # slack of suffix bound pruning against float rounding
+
+def _get_log_probs(prob_dict, vocab):
+    """
+    Intern labels of a prob dict, see label_vocab
+
+    Args:
+        prob_dict: dict, with label keys and float values
+        vocab: LocalLabelVocab
+    Returns:
+        codes: np.ndarray, label codes in iteration order of prob_dict
+        log_probs: np.ndarray, log of probs
+    """
+    codes = np.array([vocab.encode(label) for label in prob_dict.iterkeys()], dtype=np.int64)
+    log_probs = log(np.array(prob_dict.values(), dtype=np.float64))
+    return codes, log_probs
+
+
 def _probSenz_zip(probSenzList_elem, prob_lower_bound):
     """
     Zip one elem of probSenzList
@@ -18,55 +41,108 @@ def _probSenz_zip(probSenzList_elem, prob_lower_bound):
         senzList_elem_candidate: list, like [[], [], []]
 
     """
-    motions = probSenzList_elem['motion']
-    locations = probSenzList_elem['location']
-    sounds = probSenzList_elem['sound']
-    senzList_elem_candidate = [{'motion':motion_key, 'location':location_key, 'sound':sound_key, 'prob':log(motion_prob)+log(location_prob)+log(sound_prob)}
-                               for (motion_key, motion_prob) in motions.iteritems()
-                               for (location_key, location_prob) in locations.iteritems()
-                               for (sound_key, sound_prob) in sounds.iteritems()
-                               if log(motion_prob)+log(location_prob)+log(sound_prob) > prob_lower_bound
+    vocab = label_vocab.local()
+    motion_codes, motion_log_probs = _get_log_probs(probSenzList_elem['motion'], vocab)
+    location_codes, location_log_probs = _get_log_probs(probSenzList_elem['location'], vocab)
+    sound_codes, sound_log_probs = _get_log_probs(probSenzList_elem['sound'], vocab)
+
+    # log prob of every (motion, location, sound), motion varies slowest
+    log_probs = (motion_log_probs[:, np.newaxis, np.newaxis] + location_log_probs[np.newaxis, :, np.newaxis]
+                 + sound_log_probs[np.newaxis, np.newaxis, :])
+    motion_indexes, location_indexes, sound_indexes = np.nonzero(log_probs > prob_lower_bound)
+
+    decode = vocab.decode
+    senzList_elem_candidate = [{'motion': decode(motion_code), 'location': decode(location_code),
+                                'sound': decode(sound_code), 'prob': prob}
+                               for motion_code, location_code, sound_code, prob
+                               in zip(motion_codes[motion_indexes].tolist(), location_codes[location_indexes].tolist(),
+                                      sound_codes[sound_indexes].tolist(),
+                                      log_probs[motion_indexes, location_indexes, sound_indexes].tolist())
                               ]
     return senzList_elem_candidate
 
 
-def _ziped2muti(probSenzList_zip, prob_lower_bound):
+def _get_suffix_bounds(probSenzList_zip):
+    """
+    Max log prob of the remaining senz list after every elem
+
+    Args:
+        probSenzList_zip: list, zipped probSenzList
+    Returns:
+        suffix_bounds: list, suffix_bounds[i] is the max prob sum of elems i..end,
+                     len(probSenzList_zip) + 1 items, -inf after an elem without candidate
+    """
+    suffix_bounds = [0.0] * (len(probSenzList_zip) + 1)
+    for index in xrange(len(probSenzList_zip) - 1, -1, -1):
+        best_prob = max(elem['prob'] for elem in probSenzList_zip[index]) if probSenzList_zip[index] else -np.inf
+        suffix_bounds[index] = suffix_bounds[index + 1] + best_prob
+    return suffix_bounds
+
+
+def _unlink_senz_list(node):
+    """
+    Build the senz list of a partial senz list node of _ziped2muti() or _fold_k_best()
+
+    Args:
+        node: tuple, (last candidate, parent node), None for the empty senz list
+    Returns:
+        senzList: list, candidates from the first elem to the last
+    """
+    senzList = []
+    while node is not None:
+        elem, node = node
+        senzList.append(elem)
+    senzList.reverse()
+    return senzList
+
+
+def _ziped2muti(probSenzList_zip, prob_lower_bound, beam_width=None, stats=None):
     """
     Convert ziped prob list to muti list
 
+    A partial senz list is pruned once its prob plus the best prob of the
+    remaining elems can't exceed prob_lower_bound, since no completion of it
+    would be returned.
+
     Args:
         probSenzList_zip: list, zipped probSenzList
         prob_lower_bound: float
+        beam_width: int or None, max number of partial senz lists kept after
+                     every elem, the most probable ones. None keeps all of them
+        stats: dict or None, if given, 'pruned' is set to the number of
+                     partial senz lists pruned by prob_lower_bound
     Returns:
         mutiSenzList
     """
-    # TODO: use collections.deque to replace list if faster removal needed
-    logger.debug('[_ziped2muti] probSenzList_zip: ', len(probSenzList_zip))
-    before_stack = [{'senzList':[e], 'prob':e['prob']} for e in probSenzList_zip[0]]
-    after_stack = []
+    logger.debug('[_ziped2muti] probSenzList_zip: %s', len(probSenzList_zip))
+    suffix_bounds = _get_suffix_bounds(probSenzList_zip)
+    # suffix bounds are summed in another order than senz list probs
+    suffix_lower_bound = prob_lower_bound - SUFFIX_BOUND_TOLERANCE
+
+    # a partial senz list is (prob, node), node is (last candidate, parent node)
+    # and shared by all the partial senz lists extending it
+    frontier = [(e['prob'], (e, None)) for e in probSenzList_zip[0]
+                if e['prob'] + suffix_bounds[1] > suffix_lower_bound]
+    pruned = len(probSenzList_zip[0]) - len(frontier)
+    if beam_width is not None and len(frontier) > beam_width:
+        frontier = heapq.nlargest(beam_width, frontier, key=lambda partial: partial[0])
 
     for index in range(1, len(probSenzList_zip)):
-        #print('0 before_stack ', len(before_stack))
-        #print('0 after_stack ', len(after_stack))
-        while before_stack != []:
-            stack_elem = before_stack.pop(0)
-            for elem in probSenzList_zip[index]:
-                after_stack_elem = {}
-                after_stack_elem['senzList'] = stack_elem['senzList'] + [elem]
-                after_stack_elem['prob'] = stack_elem['prob'] + elem['prob']
-                if after_stack_elem['prob'] > prob_lower_bound:
-                    after_stack.append(after_stack_elem)
-        #print('1 before_stack ', len(before_stack))
-        #print('1 after_stack ', len(after_stack))
-        before_stack = after_stack
-        after_stack = []
-        #print('2 before_stack ', len(before_stack))
-        #print('2 after_stack ', len(after_stack))
-
-    return before_stack
-
-
-def prob2muti(probSenzList, prob_lower_bound=log(1e-30)):
+        # score every expansion first, only kept ones get a node
+        expansions = [(prob + elem['prob'], node, elem) for prob, node in frontier for elem in probSenzList_zip[index]]
+        kept_expansions = [expansion for expansion in expansions if expansion[0] > prob_lower_bound
+                           and expansion[0] + suffix_bounds[index + 1] > suffix_lower_bound]
+        pruned += len(expansions) - len(kept_expansions)
+        if beam_width is not None and len(kept_expansions) > beam_width:
+            kept_expansions = heapq.nlargest(beam_width, kept_expansions, key=lambda expansion: expansion[0])
+        frontier = [(prob, (elem, node)) for prob, node, elem in kept_expansions]
+
+    if stats is not None:
+        stats['pruned'] = pruned
+    return [{'senzList': _unlink_senz_list(node), 'prob': prob} for prob, node in frontier]
+
+
+def prob2muti(probSenzList, prob_lower_bound=log(1e-30), stats=None):
     """
     Convert probSenzList to mutiSenzList
 
@@ -74,6 +150,7 @@ def prob2muti(probSenzList, prob_lower_bound=log(1e-30)):
         probSenzList: list
         prob_lower_bound: float, should return senz list whose probability is
                      greater than lower_bound
+        stats: dict or None, gets the pruning stats of _ziped2muti()
     Returns:
         mutiSenzList: list, and its prob has been log(prob)
     """
@@ -83,49 +160,167 @@ def prob2muti(probSenzList, prob_lower_bound=log(1e-30)):
     probSenzList_zip = [_probSenz_zip(elem, prob_lower_bound) for elem in probSenzList]
     #logger.debug(probSenzList_zip) # DONE
 
-    mutiSenzList = _ziped2muti(probSenzList_zip, prob_lower_bound)
+    mutiSenzList = _ziped2muti(probSenzList_zip, prob_lower_bound, stats=stats)
     #logger.debug(mutiSenzList)
 
     return mutiSenzList
 
 
+def prob2muti_beam(probSenzList, beam_width=BEAM_WIDTH_DEFAULT, prob_lower_bound=log(1e-30), stats=None):
+    """
+    Convert probSenzList to mutiSenzList by beam search
+
+    Only the beam_width most probable partial senz lists are extended by the
+    next elem, so cost grows linearly with len(probSenzList) instead of
+    exponentially. The result may miss senz lists of prob2muti() whose
+    prefixes fell out of the beam.
+
+    Args:
+        probSenzList: list
+        beam_width: int, max number of senz lists kept after every elem
+        prob_lower_bound: float, should return senz list whose probability is
+                     greater than lower_bound
+        stats: dict or None, gets the pruning stats of _ziped2muti()
+    Returns:
+        mutiSenzList: list, at most beam_width senz lists, sorted by prob in decreasing order,
+                     and its prob has been log(prob)
+    """
+    if probSenzList == []:
+        return []
+
+    probSenzList_zip = [_probSenz_zip(elem, prob_lower_bound) for elem in probSenzList]
+    mutiSenzList = _ziped2muti(probSenzList_zip, prob_lower_bound, beam_width, stats)
+
+    return sorted(mutiSenzList, key=lambda elem: elem['prob'], reverse=True)
+
+
+def _fold_k_best(score_lists, top_k, prob_lower_bound):
+    """
+    Top top_k combinations of one score per list, folding the lists left to right
+
+    A combination of the top_k extends a prefix of the top_k prefixes, so
+    only top_k partial sums are kept after every list, and only which
+    combinations tied with the last one are returned may differ from a full
+    enumeration. The next ones are
+    merged from the kept partials and the top_k scores of the list by a
+    heap, best first, ties in order of their original indexes. A partial
+    sum <= prob_lower_bound is dropped with the ones after it in its row,
+    since they can only be smaller.
+
+    Args:
+        score_lists: list, elems are list of float scores
+        top_k: int, max number of combinations returned
+        prob_lower_bound: float, every prefix sum of a returned combination,
+                     summed left to right, is greater than lower_bound
+    Returns:
+        k_best: list, elems are (total, node) sorted by total in decreasing order,
+                     node is (original index, parent node), see _unlink_senz_list
+    """
+    if not score_lists or top_k <= 0:
+        return []
+
+    # partials are (total, rank, node), best first, rank orders their
+    # original indexes lexicographically to break ties
+    partials = [(0.0, 0, None)]
+    for scores in score_lists:
+        candidates = heapq.nsmallest(top_k, xrange(len(scores)), key=lambda index: (-scores[index], index))
+
+        def make_expansion(row, column):
+            total, rank, _ = partials[row]
+            index = candidates[column]
+            return (-(total + scores[index]), rank, index, row, column)
+
+        heap = [make_expansion(row, 0) for row in xrange(len(partials))] if candidates else []
+        heapq.heapify(heap)
+        expansions = []
+        while heap:
+            expansion = heapq.heappop(heap)
+            if -expansion[0] <= prob_lower_bound:
+                # later expansions of every row left are no better
+                break
+            # rounded totals of an expansion and the next one in its row may
+            # tie, so all expansions of the last total kept are popped
+            if len(expansions) >= top_k and expansion[0] != expansions[-1][0]:
+                break
+            expansions.append(expansion)
+            row, column = expansion[3], expansion[4]
+            if column + 1 < len(candidates):
+                heapq.heappush(heap, make_expansion(row, column + 1))
+        expansions.sort()
+        del expansions[top_k:]
+
+        ranks = sorted(xrange(len(expansions)), key=lambda position: expansions[position][1:3])
+        ranked = [0] * len(expansions)
+        for rank, position in enumerate(ranks):
+            ranked[position] = rank
+        partials = [(-neg_total, ranked[position], (index, partials[row][2]))
+                    for position, (neg_total, _, index, row, _) in enumerate(expansions)]
+        if not partials:
+            return []
+
+    return [(total, node) for total, _, node in partials]
+
+
+def prob2muti_top_k(probSenzList, top_k, prob_lower_bound=log(1e-30)):
+    """
+    Convert probSenzList to the top_k most probable senz lists of mutiSenzList
+
+    Same result as sorting prob2muti() by prob and keeping top_k, up to which
+    senz lists tied with the last one are kept, but only top_k partial senz
+    lists are built after every elem, see _fold_k_best.
+
+    Args:
+        probSenzList: list
+        top_k: int, max number of senz lists returned
+        prob_lower_bound: float, should return senz list whose probability is
+                     greater than lower_bound
+    Returns:
+        mutiSenzList: list, sorted by prob in decreasing order, and its prob has been log(prob)
+    """
+    if probSenzList == []:
+        return []
+
+    probSenzList_zip = [_probSenz_zip(elem, prob_lower_bound) for elem in probSenzList]
+    score_lists = [[candidate['prob'] for candidate in candidates] for candidates in probSenzList_zip]
+
+    mutiSenzList = [{'senzList': [candidates[index] for candidates, index in zip(probSenzList_zip, _unlink_senz_list(node))],
+                     'prob': total}
+                    for total, node in _fold_k_best(score_lists, top_k, prob_lower_bound)]
+
+    return mutiSenzList
+
+
 def _probSenz_zip_top_N(probSenzList_elem, top_N, prob_lower_bound):
     """
     Zip one elem of probSenzList, for quick version
 
+    Only the top_N most probable (motion, location, sound) of the elem are
+    built, see _fold_k_best. probSenzList_elem is not modified.
+
     Args:
         probSenzList_elem: dict, one elem of probSenzList
-        top_N:
+        top_N: int, max number of candidates returned
         prob_lower_bound: float, should return senz list whose probability is
                      greater than lower_bound
     Returns:
-        senzList_elem_candidates: list, like [{}, {}, {}]
+        senzList_elem_candidates: list, like [{}, {}, {}], sorted by prob in decreasing order
 
     """
+    keys = [key for key in ['motion', 'location', 'sound'] if key in probSenzList_elem]
+    other_items = [(key, value) for key, value in probSenzList_elem.iteritems() if key not in keys]
+    labels = [probSenzList_elem[key].keys() for key in keys]
+    score_lists = [log(np.array(probSenzList_elem[key].values(), dtype=np.float64)).tolist() for key in keys]
+
+    # totals come best first, so the first one <= lower_bound ends the candidates
     senzList_elem_candidates = []
-    probSenzList_elem_processed = {}
-    dict_sorted = lambda dt: sorted(dt.iteritems(), key=lambda d: d[1], reverse=True)  # func for sort(dict)
-
-    other_keys = []
-    for key, value in probSenzList_elem.iteritems():
-        if key in ['motion', 'location', 'sound']:
-            probSenzList_elem_processed[key] = dict_sorted(value)
-        else:
-            other_keys.append(key)
-
-    for i in xrange(top_N):
-        senzList_elem_candidate = {'prob': 0.0}
-        for key, value in probSenzList_elem_processed.iteritems():
-            senzList_elem_candidate[key] = value[i if i<len(value) else len(value)-1][0]
-            prob_value = value[i if i<len(value) else len(value)-1][1]
-            if prob_value == 0:
-                prob_value = (1e-128)  # log must accept value > 0
-            senzList_elem_candidate['prob'] += log(prob_value)
-        # TODO: 看要不要加timestamp
-        for key in other_keys:
-            senzList_elem_candidate[key] = probSenzList_elem[key]
-        if senzList_elem_candidate['prob'] > prob_lower_bound:
-            senzList_elem_candidates.append(senzList_elem_candidate)
+    for total, node in _fold_k_best(score_lists, top_N, -np.inf):
+        if total <= prob_lower_bound:
+            break
+        senzList_elem_candidate = dict(other_items)
+        senzList_elem_candidate.update((key, key_labels[index]) for key, key_labels, index
+                                       in zip(keys, labels, _unlink_senz_list(node)))
+        senzList_elem_candidate['prob'] = total
+        senzList_elem_candidates.append(senzList_elem_candidate)
 
     return senzList_elem_candidates
 
@@ -134,24 +329,29 @@ def _ziped2muti_top_N(probSenzList_zip, top_N, prob_lower_bound):
     """
     Convert ziped prob list to muti list, for quick version
 
+    The joint top_N senz lists are drawn from the per elem top_N candidates,
+    since a senz list using any other candidate of an elem is beaten by
+    top_N senz lists differing in that elem only. Elems without candidate
+    are skipped, candidates are copied instead of modified.
+
     Args:
         probSenzList_zip: list, zipped probSenzList
-        top_N: 只算最大的top_N个
+        top_N: int, max number of senz lists returned
         prob_lower_bound: float
     Returns:
-        mutiSenzList
+        mutiSenzList: list, sorted by prob in decreasing order
     """
-    mutiSenzList = []
+    probSenzList_zip = [elem for elem in probSenzList_zip if elem]
+    score_lists = [[candidate['prob'] for candidate in elem] for elem in probSenzList_zip]
 
-    for i in xrange(top_N):
-        mutiSenzList_elem = {'prob':0.0, 'senzList':[]}
-        for elem in probSenzList_zip:
-            if len(elem) <= i:
-                continue
-            mutiSenzList_elem['prob'] += elem[i].pop('prob')
-            mutiSenzList_elem['senzList'].append(elem[i])
-        if len(mutiSenzList_elem["senzList"]) > 0:
-            mutiSenzList.append(mutiSenzList_elem)
+    mutiSenzList = []
+    for total, node in _fold_k_best(score_lists, top_N, -np.inf):
+        senzList = []
+        for elem, index in zip(probSenzList_zip, _unlink_senz_list(node)):
+            senz = dict(elem[index])
+            del senz['prob']
+            senzList.append(senz)
+        mutiSenzList.append({'prob': total, 'senzList': senzList})
 
     return mutiSenzList
 
@@ -161,14 +361,16 @@ def prob2muti_quick(probSenzList, top_N, prob_lower_bound=log(1e-30)):
     Convert probSenzList to mutiSenList quickly.
 
     Because prob2mut() which calculate every potential result cost too much resource.
+    Returns the top_N most probable senz lists built from candidates of every
+    elem whose prob is greater than lower_bound, best first.
 
     Args:
         probSenzList: list
         top_N: 只算最大的top_N个
-        prob_lower_bound: float, should return senz list whose probability is
-                     greater than lower_bound
+        prob_lower_bound: float, every candidate of an elem should have
+                     probability greater than lower_bound
     Returns:
-        mutiSenzList: list, and its prob has been log(prob)
+        mutiSenzList: list, sorted by prob in decreasing order, and its prob has been log(prob)
     """
     if probSenzList == []:
         return []
@@ -2,8 +2,15 @@
 
 __author__ = ['MeoWoodie', 'jiaying.lu']
 
-__all__ = ['BehaviorCollector', 'refine_senz_prob_list']
+__all__ = ['FILL_STRATEGIES', 'refine_senz_prob_list', 'refine_senz_prob_windows', 'refine_senz_prob_pyramid',
+           'refine_senz_prob_stream', 'get_bucket_cache_stats']
 
+import threading
+
+import numpy as np
+
+from label_vocab import label_vocab, get_prob_matrix
+from lru_store import LRUStore
 
 # configs
 MAX_SCALE_VALUE = {
@@ -13,78 +20,27 @@ MAX_SCALE_VALUE = {
     'perHourScale': 23
 }
 K_WEIGHT_DEFAULT = 0.5  # default value for _collect_probs() param k_weight
+MAX_GAP_DEFAULT = 1  # default max continuous blank buckets filled in a window
+FILL_STRATEGY_DEFAULT = 'linear'  # default strategy filling blank buckets, see FILL_STRATEGIES
+SCALE_MINUTES = {
+    'perMinScale': 1,
+    'tenMinScale': 10,
+    'halfHourScale': 30,
+    'perHourScale': 60
+}
+SCALE_PYRAMID = 'pyramid'  # scale_type asking for all scale types refined from perMinScale
+NOT_PROB_KEYS = ['timestamp', 'senzId', 'tenMinScale', 'halfHourScale', 'perHourScale', 'perMinScale']
+RING_CAPACITY = 1024  # max users kept per worker process
+RING_MAX_IDLE = 24 * 3600  # seconds before the day ring of an idle user is evicted
+RING_MAX_TOTAL_CELLS = 8 * 1024 * 1024  # max slots x label columns of all rings per worker process, ~16 bytes each
+RING_MIN_COLUMNS = 4  # label columns allocated when a prob key first comes into a ring
 
-# def CountStrategy(sensor_type_list):
-#     # Calculate the new senz's motion type
-#     # The new senz's motion type is much more than other type in senzes' motion type in list.
-#     _sensor_type = ''
-#     sensor_type_count = {}
-#     # - calculate the count of every type in list.
-#     for sensor_type in sensor_type_list:
-#         if sensor_type in sensor_type_count.keys():
-#             sensor_type_count[sensor_type] += 1
-#         else:
-#             sensor_type_count[sensor_type] = 0
-#     # - select the largest count.
-#     max_count = 0
-#     for type in sensor_type_count.keys():
-#         if sensor_type_count[type] >= max_count:
-#             max_count = sensor_type_count[type]
-#             _sensor_type = type
-#
-#     print 'The largest type is', type, '. the count of it is', max_count
-#     return _sensor_type
-
-def FirstStrategy(sensor_type_list):
-    return sensor_type_list[0]
-
-def BehaviorCollector(input_data):
-    '''
-    Behavior Collector
-
-    It's used for getting a general senz tuple from a senz list.
-    Senz from the list has the same scale value.
-    We assumed that they have a general attribute cause of being generated at same time.
-
-    :return: A general senz tuple, with motion type, sound type and poi type.
-    '''
-    # Extract the information from senz list
-    timestamp_list   = []
-    motion_prob_list = []
-    poi_prob1_list   = []
-    poi_prob2_list   = []
-    sound_prob_list  = []
-    for senz_tuple in input_data:
-        timestamp_list.append(senz_tuple['timestamp'])
-        motion_prob_list.append(senz_tuple['motionProb'])
-        poi_prob1_list.append(senz_tuple['poiProbLv1'])
-        poi_prob2_list.append(senz_tuple['poiProbLv2'])
-        sound_prob_list.append(senz_tuple['soundProb'])
-
-    # Calculate the new senz's timestamp
-    # It is the average of senzes' timestamp in list.
-    _timestamp = 0
-    for timestamp in timestamp_list:
-        _timestamp += timestamp
-    _timestamp /= len(timestamp_list)
-
-    # Calculate every sensor's type.
-    _motion_prob = FirstStrategy(motion_prob_list)
-    _poi_prob1   = FirstStrategy(poi_prob1_list)
-    _poi_prob2   = FirstStrategy(poi_prob2_list)
-    _sound_prob  = FirstStrategy(sound_prob_list)
-
-    result = {
-        'motionProb': _motion_prob,
-        'poiProbLv1': _poi_prob1,
-        'poiProbLv2': _poi_prob2,
-        'soundProb': _sound_prob,
-        'timestamp': _timestamp
-    }
-    print 'The new senz tuple is'
-    print result
+BUCKET_CACHE_CAPACITY = 8192  # max bucket partial aggregates kept per worker process
 
-    return result
+_rings = LRUStore(RING_CAPACITY, max_idle=RING_MAX_IDLE, weigh=lambda ring: _get_ring_cells(ring),
+                  max_weight=RING_MAX_TOTAL_CELLS)
+_rings_lock = threading.Lock()  # so a ring is created once by concurrent requests
+_bucket_cache = LRUStore(BUCKET_CACHE_CAPACITY)
 
 
 def _get_arithmetic_average(prob_list):
@@ -156,6 +112,242 @@ def _collect_probs(cur_prob_list, other_prob_list, k_weight=K_WEIGHT_DEFAULT):
     return _get_arithmetic_average(prob_list)
 
 
+def _combine_bucket_probs(bucket_sums, bucket_counts, k_weight=K_WEIGHT_DEFAULT):
+    """Combine probs of every bucket with the prior of all buckets
+
+    Dense version of calling _collect_probs(bucket probs, all probs, k_weight)
+    for each bucket, the prior is computed only once.
+
+    Parameters
+    ----------
+    bucket_sums: np.ndarray, shape(b, l)
+      per-bucket label prob sums
+    bucket_counts: np.ndarray, shape(b,)
+      per-bucket senz number, all > 0
+    k_weight: float, limit [0, 1]
+      weight for bucket probs, see _collect_probs
+
+    Returns
+    -------
+    bucket_probs: np.ndarray, shape(b, l)
+    """
+    if k_weight < 0 or k_weight > 1:
+        k_weight = K_WEIGHT_DEFAULT
+
+    bucket_counts = np.asarray(bucket_counts, dtype=np.float64)
+    prior = bucket_sums.sum(axis=0) / bucket_counts.sum()
+
+    return k_weight * bucket_sums / bucket_counts[:, np.newaxis] + (1 - k_weight) * prior
+
+
+def _get_scale_values(scale_type, senz_prob_list, timezone_offset=None):
+    """Return scale value of every senz
+
+    Parameters
+    ----------
+    scale_type: string
+      must in ['perMinScale', 'tenMinScale', 'halfHourScale', 'perHourScale']
+    senz_prob_list: list, shape(1, n)
+      elems are dict, contains timestamp in milliseconds, or scale_type key
+    timezone_offset: int or None
+      minutes of local time ahead of UTC, if None scale values are read from
+      senz_prob_list[index][scale_type], otherwise derived from timestamp
+
+    Returns
+    -------
+    scale_values: np.ndarray, shape(n,), int64
+    """
+    if timezone_offset is None:
+        return np.asarray([elem[scale_type] for elem in senz_prob_list], dtype=np.int64)
+
+    timestamps = np.asarray([elem['timestamp'] for elem in senz_prob_list], dtype=np.int64)
+    minutes_of_day = (timestamps // 60000 + int(timezone_offset)) % (MAX_SCALE_VALUE['perMinScale'] + 1)
+    return minutes_of_day // SCALE_MINUTES[scale_type]
+
+
+def _get_bucket_aggregates(senz_prob_list, prob_keys, bucket_positions, vocab):
+    """Sum probs and timestamps of senz of every bucket
+
+    Parameters
+    ----------
+    senz_prob_list: list, shape(1, n)
+    prob_keys: list
+    bucket_positions: list, shape(1, b)
+      elems are non-empty list of indexes in senz_prob_list
+    vocab: LocalLabelVocab
+      encodes the labels
+
+    Returns
+    -------
+    aggregates: list, shape(1, b)
+      elems are dict, {'timestamp_sum':, 'probs': {prob_key: (label_codes, sums, presents)}}
+      label_codes are codes in vocab of labels appeared in the bucket
+    """
+    positions = [position for elem_positions in bucket_positions for position in elem_positions]
+    rows = np.repeat(np.arange(len(bucket_positions)), [len(elem_positions) for elem_positions in bucket_positions])
+    aggregates = [{'timestamp_sum': sum(senz_prob_list[position]['timestamp'] for position in elem_positions),
+                   'probs': {}}
+                  for elem_positions in bucket_positions]
+
+    for key in prob_keys:
+        label_codes, prob_matrix, present_matrix = get_prob_matrix([senz_prob_list[position][key] for position in positions],
+                                                                   vocab)
+        sums = np.zeros((len(bucket_positions), len(label_codes)), dtype=np.float64)
+        np.add.at(sums, rows, prob_matrix)
+        presents = np.zeros((len(bucket_positions), len(label_codes)), dtype=np.int64)
+        np.add.at(presents, rows, present_matrix)
+        for aggregate, bucket_sums, bucket_presents in zip(aggregates, sums, presents):
+            columns = np.flatnonzero(bucket_presents)
+            aggregate['probs'][key] = (label_codes[columns], bucket_sums[columns], bucket_presents[columns])
+
+    return aggregates
+
+
+def _get_bucket_statistics(scale_type, senz_prob_list, timezone_offset=None):
+    """Group senz_prob_list by scale value into per-bucket sufficient statistics
+
+    Any window of buckets can be refined from these statistics without
+    visiting senz_prob_list again, see _refine_window. Partial aggregates of
+    every bucket are kept in a LRUStore of BUCKET_CACHE_CAPACITY per worker
+    process, keyed by scale value and the set of (senzId, timestamp), so
+    buckets shared by sliding windows are only summed once.
+
+    Parameters
+    ----------
+    scale_type: string
+      must in ['perMinScale', 'tenMinScale', 'halfHourScale', 'perHourScale']
+    senz_prob_list: list, shape(1, n)
+      elems are dict, contains prob_lists, timestamp, scale_values, senzId
+    timezone_offset: int or None
+      see _get_scale_values
+
+    Returns
+    -------
+    statistics: dict
+      'scale_values': np.ndarray, shape(b,), sorted unique scale values
+      'counts': np.ndarray, shape(b,), senz number of each bucket
+      'timestamp_sums': list, shape(1, b)
+      'senz_ids': list, shape(1, b), senzId list of each bucket in input order
+      'senz_positions': list, shape(1, b), index in senz_prob_list of each senzId
+      'probs': dict, {prob_key: (label_codes, sums, presents)}
+        label_codes: np.ndarray, shape(l,), label code of each column
+        sums: np.ndarray, shape(b, l), per-bucket label prob sums
+        presents: np.ndarray, shape(b, l), per-bucket label appearance counts
+      'vocab': LocalLabelVocab, decodes label_codes
+    """
+    scale_values, bucket_ids = np.unique(_get_scale_values(scale_type, senz_prob_list, timezone_offset),
+                                         return_inverse=True)
+    bucket_num = len(scale_values)
+
+    senz_ids = [[] for _ in xrange(bucket_num)]
+    senz_positions = [[] for _ in xrange(bucket_num)]
+    for position, (bucket_id, elem) in enumerate(zip(bucket_ids.tolist(), senz_prob_list)):
+        senz_ids[bucket_id].append(elem['senzId'])
+        senz_positions[bucket_id].append(position)
+    prob_keys = sorted(key for key in senz_prob_list[0].iterkeys() if key not in NOT_PROB_KEYS) if senz_prob_list else []
+    vocab = label_vocab.local()
+
+    # Step 1: partial aggregates of buckets seen before come from cache,
+    #         a digest of probs tells a corrected senz from its cached version
+    senz_keys = [(elem['senzId'], elem['timestamp'], hash(tuple(frozenset(elem[key].iteritems()) for key in prob_keys)))
+                 for elem in senz_prob_list]
+    # sorted senz keys keep how many times a re-sent senz is in the bucket
+    cache_keys = [(scale_type, scale_value, tuple(prob_keys),
+                   tuple(sorted(senz_keys[position] for position in elem_positions)))
+                  for scale_value, elem_positions in zip(scale_values.tolist(), senz_positions)]
+    aggregates = [_bucket_cache.get(cache_key) for cache_key in cache_keys]
+    missed_buckets = [bucket for bucket, aggregate in enumerate(aggregates) if aggregate is None]
+    if missed_buckets:
+        missed_aggregates = _get_bucket_aggregates(senz_prob_list, prob_keys,
+                                                   [senz_positions[bucket] for bucket in missed_buckets], vocab)
+        for bucket, aggregate in zip(missed_buckets, missed_aggregates):
+            aggregates[bucket] = aggregate
+            # local label codes mean nothing to later requests
+            if not len(vocab):
+                _bucket_cache.put(cache_keys[bucket], aggregate)
+
+    # Step 2: recombine partial aggregates into dense label matrices
+    probs = {}
+    for key in prob_keys:
+        label_codes = [aggregate['probs'][key][0] for aggregate in aggregates]
+        label_codes, columns = np.unique(np.concatenate(label_codes), return_inverse=True)
+        rows = np.repeat(np.arange(bucket_num), [len(aggregate['probs'][key][0]) for aggregate in aggregates])
+        sums = np.zeros((bucket_num, len(label_codes)), dtype=np.float64)
+        sums[rows, columns] = np.concatenate([aggregate['probs'][key][1] for aggregate in aggregates])
+        presents = np.zeros((bucket_num, len(label_codes)), dtype=np.int64)
+        presents[rows, columns] = np.concatenate([aggregate['probs'][key][2] for aggregate in aggregates])
+        probs[key] = (label_codes, sums, presents)
+
+    return {
+        'scale_values': scale_values,
+        'counts': np.bincount(bucket_ids, minlength=bucket_num),
+        'timestamp_sums': [aggregate['timestamp_sum'] for aggregate in aggregates],
+        'senz_ids': senz_ids,
+        'senz_positions': senz_positions,
+        'probs': probs,
+        'vocab': vocab,
+    }
+
+
+def get_bucket_cache_stats():
+    """Return size, capacity, hits and misses of the bucket partial aggregate cache
+    """
+    return _bucket_cache.stats()
+
+
+def _rollup_bucket_statistics(statistics, factor):
+    """Merge bucket statistics into coarser buckets of factor fine buckets each
+
+    E.g. per-minute statistics rolled up with factor 10 are the same as
+    statistics grouped by tenMinScale, without visiting senz again.
+
+    Parameters
+    ----------
+    statistics: dict
+      result of _get_bucket_statistics
+    factor: int
+      coarse scale value is fine scale value // factor
+
+    Returns
+    -------
+    statistics: dict, see _get_bucket_statistics
+    """
+    if factor == 1:
+        return statistics
+
+    scale_values, bucket_ids = np.unique(statistics['scale_values'] // factor, return_inverse=True)
+    bucket_num = len(scale_values)
+
+    counts = np.zeros(bucket_num, dtype=np.int64)
+    np.add.at(counts, bucket_ids, statistics['counts'])
+
+    timestamp_sums = [0] * bucket_num
+    senz_members = [[] for _ in xrange(bucket_num)]
+    for fine_bucket, bucket_id in enumerate(bucket_ids.tolist()):
+        timestamp_sums[bucket_id] += statistics['timestamp_sums'][fine_bucket]
+        senz_members[bucket_id].extend(zip(statistics['senz_positions'][fine_bucket], statistics['senz_ids'][fine_bucket]))
+    for members in senz_members:
+        members.sort(key=lambda member: member[0])  # keep input order of senz
+
+    probs = {}
+    for key, (label_codes, fine_sums, fine_presents) in statistics['probs'].iteritems():
+        sums = np.zeros((bucket_num, len(label_codes)), dtype=np.float64)
+        np.add.at(sums, bucket_ids, fine_sums)
+        presents = np.zeros((bucket_num, len(label_codes)), dtype=np.int64)
+        np.add.at(presents, bucket_ids, fine_presents)
+        probs[key] = (label_codes, sums, presents)
+
+    return {
+        'scale_values': scale_values,
+        'counts': counts,
+        'timestamp_sums': timestamp_sums,
+        'senz_ids': [[senz_id for _, senz_id in members] for members in senz_members],
+        'senz_positions': [[position for position, _ in members] for members in senz_members],
+        'probs': probs,
+        'vocab': statistics['vocab'],
+    }
+
+
 def _check_blank_condition(start, end, my_list, max_blank_num=2):
     """Check my_list's blank condition.
 
@@ -179,14 +371,129 @@ def _check_blank_condition(start, end, my_list, max_blank_num=2):
     if my_list[0] - start >= max_blank_num or end - my_list[-1] >= max_blank_num:
         return False
 
-    for index in xrange(len(my_list) - 1):
-        if abs(my_list[index] - my_list[index+1]) > max_blank_num:
-            return False
+    return not (np.abs(np.diff(my_list)) > max_blank_num).any()
+
+
+def _fill_linear(left_distances, right_distances, left_counts, right_counts):
+    return left_distances / (left_distances + right_distances)
+
+
+def _fill_nearest(left_distances, right_distances, left_counts, right_counts):
+    return (right_distances < left_distances).astype(np.float64)
+
+
+def _fill_weighted(left_distances, right_distances, left_counts, right_counts):
+    # neighbor weight is its senz number over its distance
+    return right_counts * left_distances / (left_counts * right_distances + right_counts * left_distances)
+
+
+# fill strategies of blank buckets, return the weight of the right neighbor
+# from float distances and senz numbers of both neighbors, all > 0
+FILL_STRATEGIES = {
+    'linear': _fill_linear,
+    'nearest': _fill_nearest,
+    'weighted': _fill_weighted,
+}
+
+
+def _refine_window(statistics, scale_type, start_scale_value, end_scale_value,
+                   max_gap=MAX_GAP_DEFAULT, fill_strategy=FILL_STRATEGY_DEFAULT):
+    """Generate a refined senz prob list of one window from bucket statistics
+
+    Parameters
+    ----------
+    statistics: dict
+      result of _get_bucket_statistics
+    scale_type: string
+    start_scale_value: int
+    end_scale_value: int
+      if start_scale_value > end_scale_value, the window crosses midnight
+    max_gap: int, default MAX_GAP_DEFAULT
+      max continuous blank buckets filled, window with a longer gap is unvalid
+    fill_strategy: string, default FILL_STRATEGY_DEFAULT
+      must in FILL_STRATEGIES
+
+    Returns
+    -------
+    refined_senz_prob_list: list, see refine_senz_prob_list
+    """
+    start_scale_value = int(start_scale_value)
+    end_scale_value = int(end_scale_value)
+    max_scale_value = MAX_SCALE_VALUE[scale_type]
+    fill = FILL_STRATEGIES[fill_strategy]
+
+    if start_scale_value == end_scale_value:
+        return []
+
+    # Step 0: select buckets of window by their offset from start,
+    # so a window crossing midnight is a plain range of offsets
+    scale_num = max_scale_value + 1
+    window_len = (end_scale_value - start_scale_value) % scale_num
+    offsets = (statistics['scale_values'] - start_scale_value) % scale_num
+    selected = np.flatnonzero(offsets <= window_len)
+    selected = selected[np.argsort(offsets[selected], kind='mergesort')]
+    offsets = offsets[selected]
+
+    # Step 1: check blank condition
+    if not _check_blank_condition(0, window_len, offsets, int(max_gap) + 1):
+        return []
+
+    # Step 2: calculate per scale combined prob
+    counts = statistics['counts'][selected]
+    combined_probs = {}
+    decode = statistics['vocab'].decode
+    for key, (label_codes, sums, presents) in statistics['probs'].iteritems():
+        columns = np.flatnonzero(presents[selected].sum(axis=0) > 0)
+        combined_probs[key] = ([decode(code) for code in label_codes[columns].tolist()],
+                               _combine_bucket_probs(sums[selected][:, columns], counts, k_weight=0.75))
+
+    # Step 3: fill blank buckets from their neighbors in one batch,
+    # edge blanks have one neighbor only, the whole window is covered
+    window_offsets = np.arange(window_len + 1)
+    lefts = np.maximum(np.searchsorted(offsets, window_offsets, side='right') - 1, 0)
+    rights = np.minimum(np.searchsorted(offsets, window_offsets, side='left'), len(offsets) - 1)
+    left_distances = np.abs(window_offsets - offsets[lefts]).astype(np.float64)
+    right_distances = np.abs(offsets[rights] - window_offsets).astype(np.float64)
+    blanks = (offsets[lefts] != window_offsets)
+    inner_blanks = (lefts != rights)
+    right_weights = np.zeros(len(window_offsets), dtype=np.float64)
+    right_weights[inner_blanks] = fill(left_distances[inner_blanks], right_distances[inner_blanks],
+                                       counts[lefts[inner_blanks]].astype(np.float64),
+                                       counts[rights[inner_blanks]].astype(np.float64))
+
+    timestamps = [int(statistics['timestamp_sums'][bucket] / count)
+                  for bucket, count in zip(selected.tolist(), counts.tolist())]
+    filled_probs = {}
+    for key, (labels, bucket_probs) in combined_probs.iteritems():
+        filled_probs[key] = (labels, ((1 - right_weights)[:, np.newaxis] * bucket_probs[lefts] +
+                                      right_weights[:, np.newaxis] * bucket_probs[rights]).tolist())
+
+    refined_senz_prob_list = []
+    for index, (left, right, is_blank) in enumerate(zip(lefts.tolist(), rights.tolist(), blanks.tolist())):
+        if is_blank and left != right:
+            timestamp = timestamps[left] + (timestamps[right] - timestamps[left]) * int(index - offsets[left]) \
+                // int(offsets[right] - offsets[left])
+            senz_ids = []
+        elif is_blank:
+            timestamp = timestamps[left]
+            senz_ids = []
+        else:
+            timestamp = timestamps[left]
+            senz_ids = list(statistics['senz_ids'][selected[left]])
+        refined_senz_prob_list_elem = {
+            'timestamp': timestamp,
+            scale_type: (start_scale_value + index) % scale_num,
+            'senzId': senz_ids
+        }
+        for key, (labels, probs) in filled_probs.iteritems():
+            refined_senz_prob_list_elem[key] = dict(zip(labels, probs[index]))
+        refined_senz_prob_list.append(refined_senz_prob_list_elem)
 
-    return True
+    return refined_senz_prob_list
 
 
-def refine_senz_prob_list(scale_type, start_scale_value, end_scale_value, senz_prob_list):
+def refine_senz_prob_list(scale_type, start_scale_value, end_scale_value, senz_prob_list,
+                          max_gap=MAX_GAP_DEFAULT, fill_strategy=FILL_STRATEGY_DEFAULT, timezone_offset=None):
     """ Generate a refined senz prob list according to the scale type and scale values
 
     如果 senz_prob_list 按照scale_type切割出来的小格子中连续出现了 max_blank_senz_prob (default 2)个,
@@ -200,143 +507,326 @@ def refine_senz_prob_list(scale_type, start_scale_value, end_scale_value, senz_p
     start_scale_value: int
       senz_prob_list[index][scale_type] start value
     end_scale_value: int
-      senz_prob_list[index][scale_type] end value
+      senz_prob_list[index][scale_type] end value,
+      if start_scale_value > end_scale_value, the window crosses midnight
     senz_prob_list: list, shape(1, n)
-      elems are dict, contains prob_lists, timestamp, scale_values, senzId
+      elems are dict, contains prob_lists, timestamp, scale_values, senzId,
+      never modified
+    max_gap: int, default MAX_GAP_DEFAULT
+      max continuous blank buckets filled, see _refine_window
+    fill_strategy: string, default FILL_STRATEGY_DEFAULT
+      must in FILL_STRATEGIES
+    timezone_offset: int or None, default None
+      minutes of local time ahead of UTC, if given scale values are derived
+      from timestamp instead of read from senz, see _get_scale_values
 
     Returns
     -------
     refined_senz_prob_list: list, shape(1, m)
       m <= n
     """
+    return _refine_window(_get_bucket_statistics(scale_type, senz_prob_list, timezone_offset),
+                          scale_type, start_scale_value, end_scale_value, max_gap, fill_strategy)
+
+
+def refine_senz_prob_windows(scale_type, scale_windows, senz_prob_list,
+                             max_gap=MAX_GAP_DEFAULT, fill_strategy=FILL_STRATEGY_DEFAULT, timezone_offset=None):
+    """Generate refined senz prob lists of many windows over one senz_prob_list
+
+    senz_prob_list is grouped by scale_type only once, every window is then
+    reduced from the per-bucket sums and counts.
+
+    Parameters
+    ----------
+    scale_type: string
+      must in ['perMinScale', 'tenMinScale', 'halfHourScale', 'perHourScale']
+    scale_windows: list, shape(1, w)
+      elems are [start_scale_value, end_scale_value]
+    senz_prob_list: list, shape(1, n)
+      elems are dict, contains prob_lists, timestamp, scale_values, senzId
+    max_gap: int, default MAX_GAP_DEFAULT
+      max continuous blank buckets filled, see _refine_window
+    fill_strategy: string, default FILL_STRATEGY_DEFAULT
+      must in FILL_STRATEGIES
+    timezone_offset: int or None, default None
+      minutes of local time ahead of UTC, if given scale values are derived
+      from timestamp instead of read from senz, see _get_scale_values
+
+    Returns
+    -------
+    refined_senz_prob_lists: list, shape(1, w)
+      elems are refined_senz_prob_list of each window, see refine_senz_prob_list
+    """
+    statistics = _get_bucket_statistics(scale_type, senz_prob_list, timezone_offset)
+    return [_refine_window(statistics, scale_type, start_scale_value, end_scale_value, max_gap, fill_strategy)
+            for start_scale_value, end_scale_value in scale_windows]
+
+
+def refine_senz_prob_pyramid(start_scale_value, end_scale_value, senz_prob_list,
+                             max_gap=MAX_GAP_DEFAULT, fill_strategy=FILL_STRATEGY_DEFAULT, timezone_offset=None):
+    """Generate refined senz prob lists of every scale type in one pass
+
+    senz_prob_list is grouped by perMinScale only once, tenMinScale,
+    halfHourScale and perHourScale buckets are rolled up from the per-minute
+    sums and counts, so senz only need to carry perMinScale.
+
+    Parameters
+    ----------
+    start_scale_value: int
+      perMinScale start value
+    end_scale_value: int
+      perMinScale end value
+    senz_prob_list: list, shape(1, n)
+      elems are dict, contains prob_lists, timestamp, perMinScale, senzId
+    max_gap: int, default MAX_GAP_DEFAULT
+      max continuous blank buckets filled, see _refine_window
+    fill_strategy: string, default FILL_STRATEGY_DEFAULT
+      must in FILL_STRATEGIES
+    timezone_offset: int or None, default None
+      minutes of local time ahead of UTC, if given scale values are derived
+      from timestamp instead of read from senz, see _get_scale_values
+
+    Returns
+    -------
+    refined_senz_prob_lists: dict, {scale_type: refined_senz_prob_list}
+      keys are in SCALE_MINUTES, window of each scale type is
+      [start_scale_value // minutes, end_scale_value // minutes]
+    """
     start_scale_value = int(start_scale_value)
     end_scale_value = int(end_scale_value)
+    minute_statistics = _get_bucket_statistics('perMinScale', senz_prob_list, timezone_offset)
 
-    max_blank_senz_prob = 2
-    refined_senz_prob_list = []
+    refined_senz_prob_lists = {}
+    for scale_type, minutes in SCALE_MINUTES.iteritems():
+        statistics = _rollup_bucket_statistics(minute_statistics, minutes)
+        refined_senz_prob_lists[scale_type] = _refine_window(statistics, scale_type,
+                                                             start_scale_value // minutes, end_scale_value // minutes,
+                                                             max_gap, fill_strategy)
 
-    if start_scale_value == end_scale_value:
-        return []
+    return refined_senz_prob_lists
 
-    # Step 0: check start, end
-    checked_senz_prob_list = []
-    for elem in senz_prob_list:
-        if start_scale_value < end_scale_value and start_scale_value <= elem[scale_type] <= end_scale_value:
-            checked_senz_prob_list.append(elem)
-        if start_scale_value > end_scale_value:
-            if elem[scale_type] <= end_scale_value:
-                elem[scale_type] += (MAX_SCALE_VALUE[scale_type] + 1)
-            checked_senz_prob_list.append(elem)
-
-    if start_scale_value > end_scale_value:
-        shadow_end_scale_values = end_scale_value
-        end_scale_value += MAX_SCALE_VALUE[scale_type]
-
-    senz_prob_list = checked_senz_prob_list
-
-    # Step 1: process scale
-    scaled_senz_prob_list = []
-    scaled_senz_prob_dict = {}
-    for elem in senz_prob_list:
-        elem_scale_value = elem[scale_type]
-        if elem_scale_value in scaled_senz_prob_dict:
-            scaled_senz_prob_dict[elem_scale_value].append(elem)
-        else:
-            scaled_senz_prob_dict[elem_scale_value] = [elem]
 
-    for sorted_key in sorted(scaled_senz_prob_dict):
-        scaled_senz_prob_list.append(scaled_senz_prob_dict[sorted_key])
+def _new_day_ring():
+    """Create an empty day ring, one slot per perMinScale value
 
-    # Step 2: check blank condition
-    if not _check_blank_condition(start_scale_value, end_scale_value, sorted(scaled_senz_prob_dict), max_blank_senz_prob):
-        return []
+    Returns
+    -------
+    ring: dict
+      'epochs': np.ndarray, shape(1440,), minute since epoch (timestamp // 60000)
+        the slot is holding, -1 if never used
+      'counts', 'timestamp_sums', 'senz_ids', 'senz_positions':
+        per-slot running statistics, see _get_bucket_statistics
+      'probs': dict, {prob_key: {'labels':, 'columns':, 'sums':, 'presents':}}
+        columns maps label to its column in sums and presents, which have
+        room for more columns than labels, see _add_ring_column
+      'sequence': int, arrival number of the next senz
+      'latest_epoch': int, newest minute pushed into the ring
+      'latest_slot': int, slot of latest_epoch
+    """
+    slot_num = MAX_SCALE_VALUE['perMinScale'] + 1
+    return {
+        'lock': threading.Lock(),
+        'epochs': np.full(slot_num, -1, dtype=np.int64),
+        'counts': np.zeros(slot_num, dtype=np.int64),
+        'timestamp_sums': [0] * slot_num,
+        'senz_ids': [[] for _ in xrange(slot_num)],
+        'senz_positions': [[] for _ in xrange(slot_num)],
+        'probs': {},
+        'sequence': 0,
+        'latest_epoch': -1,
+        'latest_slot': -1,
+    }
 
-    # Step 3: calculate per scale combined prob
-    combined_prob_list = []
-
-    total_prob_dict = {}
-    total_prob_keys = [key for key in scaled_senz_prob_list[0][0].iterkeys() if key not in ['timestamp', 'senzId', 'tenMinScale', 'halfHourScale', 'perHourScale', 'perMinScale']]
-    for key in total_prob_keys:
-        total_prob_dict[key] = []
-    for per_scaled_list in scaled_senz_prob_list:
-        for per_dict in per_scaled_list:
-            for key in total_prob_keys:
-                total_prob_dict[key].append(per_dict[key])
-
-    for per_scaled_list in scaled_senz_prob_list:
-        cur_prob_dict = {}
-        for key in total_prob_keys:
-            cur_prob_dict[key] = []
-        cur_average_timestamp = 0
-        cur_scale_value = per_scaled_list[0][scale_type]
-        cur_senz_ids = []
-        for per_dict in per_scaled_list:
-            cur_average_timestamp += per_dict['timestamp']
-            cur_senz_ids.append(per_dict['senzId'])
-            for key in total_prob_keys:
-                cur_prob_dict[key].append(per_dict[key])
-        cur_average_timestamp = int(cur_average_timestamp / len(per_scaled_list))
-        combined_prob_list_elem = {
-            'timestamp': cur_average_timestamp,
-            scale_type: cur_scale_value,
-            'senzId': cur_senz_ids
-        }
-        for key in total_prob_keys:
-            # print('cur_prob_dict[%s]:%s' % (key, cur_prob_dict[key]))
-            # print('total_prob_dict[%s]:%s' % (key, total_prob_dict[key]))
-            combined_prob_list_elem[key] = _collect_probs(cur_prob_dict[key], total_prob_dict[key], k_weight=0.75)
-
-        combined_prob_list.append(combined_prob_list_elem)
-
-    # Step 4: fill blank scales
-    for index in xrange(len(combined_prob_list)):
-        refined_senz_prob_list.append(combined_prob_list[index])
-        if index == len(combined_prob_list) - 1:
-            break
-        if combined_prob_list[index+1][scale_type] - combined_prob_list[index][scale_type] == max_blank_senz_prob:
-            refined_senz_prob_list_elem = {
-                'timestamp': (combined_prob_list[index]['timestamp'] + combined_prob_list[index+1]['timestamp']) / 2,
-                #'motionProb': _collect_probs(combined_prob_list[index]['motionProb'], combined_prob_list[index+1]['motionProb'], k_weight=0.5),
-                scale_type: combined_prob_list[index][scale_type] + 1,
-                'senzId': []
-            }
-            for key in total_prob_keys:
-                refined_senz_prob_list_elem[key] = _collect_probs(combined_prob_list[index][key], combined_prob_list[index+1][key], k_weight=0.5)
-
-            refined_senz_prob_list.append(refined_senz_prob_list_elem)
-
-    if end_scale_value > MAX_SCALE_VALUE[scale_type]:
-        end_scale_value = shadow_end_scale_values
-        tmp_refiend_senz_prob_list = list(refined_senz_prob_list)
-        refined_senz_prob_list = []
-        for refined_senz_prob in tmp_refiend_senz_prob_list:
-            if refined_senz_prob[scale_type] > MAX_SCALE_VALUE[scale_type]:
-                refined_senz_prob[scale_type] -= (MAX_SCALE_VALUE[scale_type] + 1)
-            refined_senz_prob_list.append(refined_senz_prob)
-
-    # 补全开始结尾处的空白
-    if combined_prob_list[0][scale_type] - start_scale_value == 1:
-        refined_senz_prob_list_elem = {
-            'timestamp': combined_prob_list[0]['timestamp'],
-            scale_type: start_scale_value,
-            'senzId': []
-        }
-        for key in total_prob_keys:
-            refined_senz_prob_list_elem[key] = combined_prob_list[0][key]
-        refined_senz_prob_list.insert(0, refined_senz_prob_list_elem)
 
-    if end_scale_value - combined_prob_list[-1][scale_type] == 1:
-        refined_senz_prob_list_elem = {
-            'timestamp': combined_prob_list[-1]['timestamp'],
-            scale_type: end_scale_value,
-            'senzId': []
-        }
-        for key in total_prob_keys:
-            refined_senz_prob_list_elem[key] = combined_prob_list[-1][key]
-        refined_senz_prob_list.append(refined_senz_prob_list_elem)
+def _get_ring_cells(ring):
+    """Return number of slots x label columns allocated by ring, its weight in _rings
+    """
+    return len(ring['epochs']) * (1 + sum(prob['sums'].shape[1] for prob in ring['probs'].itervalues()))
 
-    return refined_senz_prob_list
 
+def _add_ring_column(prob, label):
+    """Add a column of label to a prob of ring, in place
+
+    Allocated columns are doubled when full, so adding labels one by one
+    copies sums and presents O(log(labels)) times.
+
+    Returns
+    -------
+    column: int
+    """
+    column = len(prob['labels'])
+    capacity = prob['sums'].shape[1]
+    if column == capacity:
+        slot_num = prob['sums'].shape[0]
+        capacity = max(RING_MIN_COLUMNS, 2 * capacity)
+        for name, dtype in [('sums', np.float64), ('presents', np.int64)]:
+            grown = np.zeros((slot_num, capacity), dtype=dtype)
+            grown[:, :column] = prob[name]
+            prob[name] = grown
+    prob['columns'][label] = column
+    prob['labels'].append(label)
+    return column
+
+
+def _reset_ring_slot(ring, slot, epoch):
+    ring['epochs'][slot] = epoch
+    ring['counts'][slot] = 0
+    ring['timestamp_sums'][slot] = 0
+    ring['senz_ids'][slot] = []
+    ring['senz_positions'][slot] = []
+    for prob in ring['probs'].itervalues():
+        prob['sums'][slot] = 0
+        prob['presents'][slot] = 0
+
+
+def _push_senz_to_ring(ring, senz_prob_list, timezone_offset=None):
+    """Add senz into the running statistics of their perMinScale slots, in place
+
+    A slot holding an older minute is reset before use, senz older than the
+    minute held by their slot or than one day before the newest senz are
+    dropped, and a senzId already in its slot is ignored.
+
+    Parameters
+    ----------
+    ring: dict, see _new_day_ring
+    senz_prob_list: list, shape(1, n)
+      elems are dict, contains prob_lists, timestamp, perMinScale, senzId
+    timezone_offset: int or None
+      see _get_scale_values
+    """
+    slot_num = len(ring['epochs'])
+    slots = _get_scale_values('perMinScale', senz_prob_list, timezone_offset).tolist()
+    for slot, elem in zip(slots, senz_prob_list):
+        epoch = int(elem['timestamp']) // 60000
+        if epoch < ring['epochs'][slot] or epoch <= ring['latest_epoch'] - slot_num:
+            continue
+        if epoch > ring['epochs'][slot]:
+            _reset_ring_slot(ring, slot, epoch)
+        elif elem['senzId'] in ring['senz_ids'][slot]:
+            continue
+
+        ring['counts'][slot] += 1
+        ring['timestamp_sums'][slot] += elem['timestamp']
+        ring['senz_ids'][slot].append(elem['senzId'])
+        ring['senz_positions'][slot].append(ring['sequence'])
+        ring['sequence'] += 1
+        if epoch > ring['latest_epoch']:
+            ring['latest_epoch'] = epoch
+            ring['latest_slot'] = slot
+
+        for key, prob_list in elem.iteritems():
+            if key in NOT_PROB_KEYS:
+                continue
+            prob = ring['probs'].get(key)
+            if prob is None:
+                prob = {'labels': [], 'columns': {},
+                        'sums': np.zeros((slot_num, 0), dtype=np.float64),
+                        'presents': np.zeros((slot_num, 0), dtype=np.int64)}
+                ring['probs'][key] = prob
+            for label, value in prob_list.iteritems():
+                column = prob['columns'].get(label)
+                if column is None:
+                    column = _add_ring_column(prob, label)
+                prob['sums'][slot, column] += value
+                prob['presents'][slot, column] += 1
+
+
+def _get_ring_statistics(ring, start_minute, end_minute):
+    """Read per-minute bucket statistics of one window out of a day ring
+
+    Only the slots of the window are visited. The window is anchored on the
+    latest occurrence of start_minute at or before the newest senz, a slot
+    is read only if it holds the minute of that occurrence plus its offset
+    in the window, so minutes after the newest senz don't return the
+    buckets of the day before.
+
+    Parameters
+    ----------
+    ring: dict, see _new_day_ring
+    start_minute: int
+    end_minute: int
+      if start_minute > end_minute, the window crosses midnight
+
+    Returns
+    -------
+    statistics: dict, see _get_bucket_statistics
+    """
+    slot_num = len(ring['epochs'])
+    offsets = np.arange((end_minute - start_minute) % slot_num + 1)
+    slots = (start_minute + offsets) % slot_num
+    start_epoch = ring['latest_epoch'] - (ring['latest_slot'] - start_minute) % slot_num
+    fresh = (ring['counts'][slots] > 0) & (ring['epochs'][slots] == start_epoch + offsets)
+    slots = np.sort(slots[fresh])
+    slot_list = slots.tolist()
+    vocab = label_vocab.local()
+    probs = {}
+    for key, prob in ring['probs'].iteritems():
+        label_num = len(prob['labels'])
+        probs[key] = (np.array([vocab.encode(label) for label in prob['labels']], dtype=np.int64),
+                      prob['sums'][slots, :label_num], prob['presents'][slots, :label_num])
+
+    return {
+        'scale_values': slots,
+        'counts': ring['counts'][slots],
+        'timestamp_sums': [ring['timestamp_sums'][slot] for slot in slot_list],
+        'senz_ids': [list(ring['senz_ids'][slot]) for slot in slot_list],
+        'senz_positions': [list(ring['senz_positions'][slot]) for slot in slot_list],
+        'probs': probs,
+        'vocab': vocab,
+    }
+
+
+def refine_senz_prob_stream(user_id, scale_type, start_scale_value, end_scale_value, senz_prob_list,
+                            max_gap=MAX_GAP_DEFAULT, fill_strategy=FILL_STRATEGY_DEFAULT, timezone_offset=None):
+    """Push new senz of a user into its day ring and refine one window
+
+    Every user keeps a ring of per-minute running statistics covering the
+    last day, so only newly arrived senz are sent, and the cost of refining
+    is proportional to the window. Rings live in a LRUStore of RING_CAPACITY
+    per worker process, weighed by _get_ring_cells up to RING_MAX_TOTAL_CELLS,
+    idle for RING_MAX_IDLE seconds they are evicted.
+    Every request of a user must be served by the same process, see the
+    /raw2refine/stream/ API.
+
+    Parameters
+    ----------
+    user_id: string
+    scale_type: string
+      must in ['perMinScale', 'tenMinScale', 'halfHourScale', 'perHourScale']
+    start_scale_value: int
+    end_scale_value: int
+    senz_prob_list: list, shape(1, n)
+      new senz, elems are dict, contains prob_lists, timestamp, perMinScale, senzId
+    max_gap: int, default MAX_GAP_DEFAULT
+      max continuous blank buckets filled, see _refine_window
+    fill_strategy: string, default FILL_STRATEGY_DEFAULT
+      must in FILL_STRATEGIES
+    timezone_offset: int or None, default None
+      minutes of local time ahead of UTC, if given scale values are derived
+      from timestamp instead of read from senz, see _get_scale_values
+
+    Returns
+    -------
+    refined_senz_prob_list: list, see refine_senz_prob_list
+    """
+    start_scale_value = int(start_scale_value)
+    end_scale_value = int(end_scale_value)
+    minutes = SCALE_MINUTES[scale_type]
+
+    with _rings_lock:
+        ring = _rings.get(user_id)
+        if ring is None:
+            ring = _new_day_ring()
+            _rings.put(user_id, ring)
+
+    with ring['lock']:
+        _push_senz_to_ring(ring, senz_prob_list, timezone_offset)
+        statistics = _get_ring_statistics(ring, start_scale_value * minutes, end_scale_value * minutes + minutes - 1)
+    # new labels grow the ring, put it again to weigh it
+    _rings.put(user_id, ring)
+
+    statistics = _rollup_bucket_statistics(statistics, minutes)
+    return _refine_window(statistics, scale_type, start_scale_value, end_scale_value, max_gap, fill_strategy)
 
 
 if __name__ == '__main__':
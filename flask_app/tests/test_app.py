@@ -6,7 +6,10 @@ __author__ = 'jiaying.lu'
 
 from unittest import TestCase
 from flask_app.app import app
+from flask_app import app as app_module
+from flask_app import raw2refine
 import json
+from numpy import log
 
 
 class TestLog2RawsenzAPI(TestCase):
@@ -45,6 +48,17 @@ class TestLog2RawsenzAPI(TestCase):
         self.assertNotEqual(200, rv.status_code)
         result = json.loads(rv.data)
 
+        # case 3
+        data = {
+            'filter': 1,
+            'align_mode': 'quantum',
+            'timelines': {'PK': [{'timestamp': 1}], 'SK': []}
+        }
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(400, rv.status_code)
+        result = json.loads(rv.data)
+        self.assertEqual(103, result['code'])
+
     def test_valid_params(self):
         # case 1
         data = {
@@ -86,6 +100,134 @@ class TestLog2RawsenzAPI(TestCase):
         result = json.loads(rv.data)
         self.assertEqual(0, result['code'])
 
+    def test_streaming_result(self):
+        data = {
+            "primary_key": "HK",
+            "filter": 1,
+            "timelines": {
+                "PK": [{"timestamp": t} for t in xrange(1000)],
+                "SK": [{"timestamp": t} for t in xrange(0, 1000, 2)],
+            }
+        }
+        # case 1: json, spans several chunks
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        result = json.loads(rv.data)
+        self.assertEqual(0, result['code'])
+        self.assertEqual(1000, len(result['result']))
+        self.assertEqual({'PK': {'timestamp': 999}, 'SK': {'timestamp': 998}}, result['result'][-1])
+
+        # case 2: ndjson
+        rv = self.app.post(self.url, data=json.dumps(data), headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('application/x-ndjson', rv.mimetype)
+        lines = rv.data.splitlines()
+        self.assertEqual(1000, len(lines))
+        self.assertEqual(result['result'], [json.loads(line) for line in lines])
+
+        # case 3: columnar
+        rv = self.app.post(self.url, data=json.dumps(data), headers={'Accept': 'application/vnd.senz.columnar+json'})
+        self.assertEqual(200, rv.status_code)
+        result = json.loads(rv.data)
+        self.assertEqual(0, result['code'])
+        self.assertEqual('PK', result['result']['primaryKey'])
+        self.assertEqual(data['timelines']['PK'], result['result']['primary'])
+        self.assertEqual([0, 0, 1, 1], result['result']['matched']['SK'][:4])
+
+
+    def test_session(self):
+        data = {
+            "session_id": "test-app-user",
+            "primary_key": "HK",
+            "filter": 1,
+            "timelines": {"PK": [{"timestamp": t} for t in xrange(4)], "SK": [{"timestamp": t} for t in xrange(0, 6, 2)]}
+        }
+        # sessions only on their own API
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(400, rv.status_code)
+        self.assertEqual(103, json.loads(rv.data)['code'])
+
+        session_url = '/log2rawsenz/session/'
+        rv = self.app.post(session_url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(4, len(json.loads(rv.data)['result']))
+        data['timelines']['PK'].append({"timestamp": 4})
+        rv = self.app.post(session_url, data=json.dumps(data))
+        self.assertEqual([{'PK': {'timestamp': 4}, 'SK': {'timestamp': 4}}], json.loads(rv.data)['result'])
+
+        del data['session_id']
+        rv = self.app.post(session_url, data=json.dumps(data))
+        self.assertEqual(400, rv.status_code)
+
+        # a stateless worker refuses sessions, nginx misrouted them
+        app_module.STATEFUL_WORKER = False
+        try:
+            rv = self.app.post(session_url, data=json.dumps(dict(data, session_id='test-app-user')))
+        finally:
+            app_module.STATEFUL_WORKER = True
+        self.assertEqual(500, rv.status_code)
+        self.assertEqual(1, json.loads(rv.data)['code'])
+
+
+class TestLog2RawsenzBatchAPI(TestCase):
+    url = '/log2rawsenz/batch/'
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+
+    def tearDown(self):
+        app.config['TESTING'] = False
+
+    def test_unvalid_params(self):
+        for data in ['OhMyParams', json.dumps({'job': []}), json.dumps({'jobs': {}})]:
+            rv = self.app.post(self.url, data=data)
+            self.assertEqual(400, rv.status_code)
+            result = json.loads(rv.data)
+            self.assertEqual(103, result['code'])
+
+    def test_valid_params(self):
+        data = {
+            'jobs': [
+                {'filter': 1, 'timelines': {'PK': [{'timestamp': 1}, {'timestamp': 3}], 'SK': [{'timestamp': 3}]}},
+                {'filter': 1, 'timelines': {'PK': [{'timestamp': 1}], 'SK': ['error_key']}},
+                {'timelines': {}},
+            ]
+        }
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        result = json.loads(rv.data)
+        self.assertEqual(0, result['code'])
+        self.assertEqual([0, 1, 103], [job_result['code'] for job_result in result['result']])
+        self.assertEqual({'PK': {'timestamp': 3}, 'SK': {'timestamp': 3}}, result['result'][0]['result'][1])
+
+
+class TestLog2RawsenzNumericAPI(TestCase):
+    url = '/log2rawsenz/numeric/'
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+
+    def tearDown(self):
+        app.config['TESTING'] = False
+
+    def test_unvalid_params(self):
+        for data in ['OhMyParams', json.dumps({'filter': 1, 'primary': []})]:
+            rv = self.app.post(self.url, data=data)
+            self.assertEqual(400, rv.status_code)
+            result = json.loads(rv.data)
+            self.assertEqual(103, result['code'])
+
+    def test_valid_params(self):
+        data = {'filter': 1, 'primary': [1, 4, 5], 'secondary': {'SK': [3, 5], 'EK': []}}
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        result = json.loads(rv.data)
+        self.assertEqual(0, result['code'])
+        self.assertEqual({'SK': {'matched': [-1, 0, 1], 'distance': [0, -1, 0]},
+                          'EK': {'matched': [-1, -1, -1], 'distance': [0, 0, 0]}}, result['result'])
+
 
 class TestRaw2RefineAPI(TestCase):
     url = '/raw2refine/'
@@ -111,6 +253,80 @@ class TestRaw2RefineAPI(TestCase):
         result = json.loads(rv.data)
         self.assertEqual(103, result["code"])
 
+    def test_pyramid_params(self):
+        senz_prob_list = [
+            {"motionProb": {"A": 0.7, "B": 0.3}, "timestamp": 100, "perMinScale": 60, "senzId": 1},
+            {"motionProb": {"A": 0.3, "C": 0.7}, "timestamp": 200, "perMinScale": 75, "senzId": 2},
+            {"motionProb": {"B": 0.7, "C": 0.3}, "timestamp": 300, "perMinScale": 90, "senzId": 3},
+            {"motionProb": {"A": 0.7, "C": 0.3}, "timestamp": 400, "perMinScale": 125, "senzId": 4},
+        ]
+        data = {"scaleType": "pyramid", "startScaleValue": 60, "endScaleValue": 125, "senzList": senz_prob_list}
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        result = json.loads(rv.data)
+        self.assertEqual(0, result["code"])
+        self.assertEqual([[1, 2, 3], [4]], [elem["senzId"] for elem in result["result"]["perHourScale"]])
+
+        data["windows"] = [[60, 125]]
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(400, rv.status_code)
+        self.assertEqual(103, json.loads(rv.data)["code"])
+
+    def test_label_codes(self):
+        labels = json.loads(self.app.get('/labels/').data)["result"]
+        walking, running = str(labels.index("Walking")), str(labels.index("Running"))
+        senz_prob_list = [
+            {"motionProb": {walking: 0.7, "Swimming": 0.3}, "timestamp": 100, "perHourScale": 1, "senzId": 1},
+            {"motionProb": {running: 1.0}, "timestamp": 200, "perHourScale": 2, "senzId": 2},
+        ]
+        data = {"scaleType": "perHourScale", "startScaleValue": 1, "endScaleValue": 2, "senzList": senz_prob_list,
+                "labelCodes": True}
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        result = json.loads(rv.data)["result"]
+        self.assertEqual(sorted([walking, running, "Swimming"]), sorted(result[0]["motionProb"]))
+
+        senz_prob_list[1]["motionProb"] = {str(len(labels)): 1.0}
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(400, rv.status_code)
+        self.assertEqual(103, json.loads(rv.data)["code"])
+
+    def test_cache_stats(self):
+        data = {"scaleType": "perHourScale", "startScaleValue": 1, "endScaleValue": 2, "senzList": [
+            {"motionProb": {"A": 0.7, "B": 0.3}, "timestamp": 100, "perHourScale": 1, "senzId": 901},
+            {"motionProb": {"A": 0.3, "C": 0.7}, "timestamp": 200, "perHourScale": 2, "senzId": 902},
+        ]}
+        before = json.loads(self.app.get('/raw2refine/cache/').data)["result"]
+        self.app.post(self.url, data=json.dumps(data))
+        self.app.post(self.url, data=json.dumps(data))
+        rv = self.app.get('/raw2refine/cache/')
+        self.assertEqual(200, rv.status_code)
+        result = json.loads(rv.data)["result"]
+        self.assertEqual((2, 2, 2), tuple(result[key] - before[key] for key in ["size", "hits", "misses"]))
+
+    def test_fill_params(self):
+        senz_prob_list = [
+            {"motionProb": {"A": 0.7, "B": 0.3}, "timestamp": 100, "perHourScale": 1, "senzId": 1},
+            {"motionProb": {"A": 0.3, "C": 0.7}, "timestamp": 500, "perHourScale": 5, "senzId": 2},
+        ]
+        data = {"scaleType": "perHourScale", "startScaleValue": 1, "endScaleValue": 5, "senzList": senz_prob_list,
+                "maxGap": 3, "fillStrategy": "nearest"}
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual([[1], [], [], [], [2]], [elem["senzId"] for elem in json.loads(rv.data)["result"]])
+
+        # scale values derived from timestamps
+        data["senzList"] = [{"motionProb": elem["motionProb"], "timestamp": elem["perHourScale"] * 3600000,
+                             "senzId": elem["senzId"]} for elem in senz_prob_list]
+        rv = self.app.post(self.url, data=json.dumps(dict(data, timezoneOffset=0)))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual([[1], [], [], [], [2]], [elem["senzId"] for elem in json.loads(rv.data)["result"]])
+
+        for key, value in [("fillStrategy", "cubic"), ("maxGap", -1), ("maxGap", "3"), ("timezoneOffset", "+8")]:
+            rv = self.app.post(self.url, data=json.dumps(dict(data, **{key: value})))
+            self.assertEqual(400, rv.status_code)
+            self.assertEqual(103, json.loads(rv.data)["code"])
+
     def test_valid_params(self):
         # case 1
         scale_type = "perHourScale"
@@ -197,7 +413,108 @@ class TestRaw2RefineAPI(TestCase):
         self.assertEqual(True, result['result'][0].has_key('locationProb'))
         self.assertEqual(True, result['result'][0].has_key('motionProb'))
 
+        # case 3: many windows
+        data = {
+            "scaleType": scale_type,
+            "windows": [[22, 2], [23, 2], [0, 2]],
+            "senzList": senz_prob_list,
+        }
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        windows_result = json.loads(rv.data)
+        self.assertEqual(0, windows_result["code"])
+        self.assertEqual(3, len(windows_result['result']))
+        self.assertEqual(result['result'], windows_result['result'][0])
+        self.assertEqual([[21], [], [41]], [elem['senzId'] for elem in windows_result['result'][2]])
+
+
+
+
+class TestRaw2RefineStreamAPI(TestCase):
+    url = '/raw2refine/stream/'
+
+    def setUp(self):
+        app.config["TESTING"] = True
+        self.app = app.test_client()
+
+    def tearDown(self):
+        app.config["TESTING"] = False
+        raw2refine._rings.clear()
+
+    def test_unvalid_params(self):
+        rv = self.app.post(self.url, data="OhMyParams")
+        self.assertEqual(400, rv.status_code)
+        self.assertEqual(103, json.loads(rv.data)["code"])
+
+        rv = self.app.post(self.url, data=json.dumps({"scaleType": "perMinScale"}))
+        self.assertEqual(400, rv.status_code)
+        self.assertEqual(103, json.loads(rv.data)["code"])
+
+    def test_valid_params(self):
+        senz_prob_list = [
+            {"motionProb": {"A": 0.7, "B": 0.3}, "timestamp": 60000 * 10, "perMinScale": 10, "senzId": 1},
+            {"motionProb": {"A": 0.3, "C": 0.7}, "timestamp": 60000 * 11, "perMinScale": 11, "senzId": 2},
+            {"motionProb": {"B": 0.7, "C": 0.3}, "timestamp": 60000 * 12, "perMinScale": 12, "senzId": 3},
+        ]
+        data = {"userId": "u1", "scaleType": "perMinScale", "startScaleValue": 10, "endScaleValue": 12,
+                "senzList": senz_prob_list[:1]}
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual([], json.loads(rv.data)["result"])
+
+        data["senzList"] = senz_prob_list[1:]
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        result = json.loads(rv.data)
+        self.assertEqual(0, result["code"])
+        self.assertEqual([[1], [2], [3]], [elem["senzId"] for elem in result["result"]])
+
+    def test_stateless_worker(self):
+        app_module.STATEFUL_WORKER = False
+        try:
+            rv = self.app.post(self.url, data=json.dumps({"userId": "u1", "scaleType": "perMinScale", "startScaleValue": 10,
+                                                          "endScaleValue": 12, "senzList": []}))
+        finally:
+            app_module.STATEFUL_WORKER = True
+        self.assertEqual(500, rv.status_code)
+        self.assertEqual(1, json.loads(rv.data)["code"])
+
 
+class TestBehaviorCollectorAPI(TestCase):
+    url = '/behaviorcollector/'
+
+    def setUp(self):
+        app.config["TESTING"] = True
+        self.app = app.test_client()
+
+    def tearDown(self):
+        app.config["TESTING"] = False
+
+    def test_unvalid_params(self):
+        rv = self.app.post(self.url, data="OhMyParams")
+        self.assertEqual(400, rv.status_code)
+        self.assertEqual(103, json.loads(rv.data)["code"])
+
+        for data in [{}, {"senzLists": [[]]}, {"senzLists": [[{"timestamp": 1}]], "strategy": "last"}]:
+            rv = self.app.post(self.url, data=json.dumps(data))
+            self.assertEqual(400, rv.status_code)
+            self.assertEqual(103, json.loads(rv.data)["code"])
+
+    def test_valid_params(self):
+        data = {
+            "strategy": "max_prob",
+            "senzLists": [
+                [{"motionProb": {"A": 0.6, "B": 0.4}, "timestamp": 100},
+                 {"motionProb": {"B": 0.9, "C": 0.1}, "timestamp": 300}],
+                [{"motionProb": {"C": 1.0}, "timestamp": 1000}],
+            ]
+        }
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        result = json.loads(rv.data)
+        self.assertEqual(0, result["code"])
+        self.assertEqual([{"motionProb": {"B": 0.9, "C": 0.1}, "timestamp": 200},
+                          {"motionProb": {"C": 1.0}, "timestamp": 1000}], result["result"])
 
 class TestProb2multiAPI(TestCase):
     """Test prob2multi workflow
@@ -223,6 +540,73 @@ class TestProb2multiAPI(TestCase):
         result = json.loads(rv.data)
         self.assertEqual(103, result['code'])
 
+    def test_select_max_prob(self):
+        data = {
+            "probSenzList": [
+                {"motion": {"Walking": 0.9, "Running": 0.1}, "location": {"resident": 1.0},
+                 "sound": {"talk": 0.6, "sing": 0.4}, "timestamp": 1297923712},
+                {"motion": {"Walking": 0.2, "Running": 0.8}, "location": {"resident": 1.0},
+                 "sound": {"talk": 1.0}, "timestamp": 1297923772},
+            ],
+            "strategy": "SELECT_MAX_PROB",
+            "mutiMaxNum": 2
+        }
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        result = json.loads(rv.data)
+        self.assertEqual(0, result['code'])
+        self.assertEqual([["Walking", "Running"], ["Walking", "Running"]],
+                         [[senz['motion'] for senz in muti_senz['senzList']] for muti_senz in result['result']])
+        self.assertEqual(["talk", "sing"], [muti_senz['senzList'][0]['sound'] for muti_senz in result['result']])
+        self.assertAlmostEqual(log(0.9 * 0.6 * 0.8), result['result'][0]['prob'])
+
+    def test_beam_search(self):
+        data = {
+            "probSenzList": [
+                {"motion": {"Walking": 0.9, "Running": 0.1}, "location": {"resident": 1.0},
+                 "sound": {"talk": 0.6, "sing": 0.4}, "timestamp": 1297923712},
+                {"motion": {"Walking": 0.2, "Running": 0.8}, "location": {"resident": 1.0},
+                 "sound": {"talk": 1.0}, "timestamp": 1297923772},
+            ],
+            "strategy": "SELECT_BEAM_SEARCH",
+            "beamWidth": 4,
+            "mutiMaxNum": 2
+        }
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        result = json.loads(rv.data)['result']
+        self.assertEqual(2, len(result))
+        self.assertEqual(["Walking", "Running"], [senz['motion'] for senz in result[0]['senzList']])
+        self.assertAlmostEqual(log(0.9 * 0.6 * 0.8), result[0]['prob'])
+
+        for beam_width in [0, "4", 1.5]:
+            data['beamWidth'] = beam_width
+            rv = self.app.post(self.url, data=json.dumps(data))
+            self.assertEqual(400, rv.status_code)
+            self.assertEqual(103, json.loads(rv.data)['code'])
+
+    def test_label_codes(self):
+        labels = json.loads(self.app.get('/labels/').data)['result']
+        walking, talk = labels.index('Walking'), labels.index('talk')
+        data = {
+            "probSenzList": [
+                {"motion": {str(walking): 0.9, "Swimming": 0.1}, "location": {"resident": 1.0},
+                 "sound": {str(talk): 1.0}, "timestamp": 1297923712},
+            ],
+            "strategy": "SELECT_MAX_N_PROB",
+            "mutiMaxNum": 1,
+            "labelCodes": True
+        }
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(200, rv.status_code)
+        senz = json.loads(rv.data)['result'][0]['senzList'][0]
+        self.assertEqual([walking, labels.index('resident'), talk], [senz['motion'], senz['location'], senz['sound']])
+
+        data['probSenzList'][0]['sound'] = {str(len(labels)): 1.0}
+        rv = self.app.post(self.url, data=json.dumps(data))
+        self.assertEqual(400, rv.status_code)
+        self.assertEqual(103, json.loads(rv.data)['code'])
+
     '''
     def test_valid_params(self):
         data = {
@@ -406,3 +790,6 @@ class TestProb2multiAPI(TestCase):
         result = json.loads(rv.data)
         self.assertEqual(0, result['code'])
         self.assertEqual(3, len(result['result']))
+        probs = [muti_senz['prob'] for muti_senz in result['result']]
+        self.assertEqual(sorted(probs, reverse=True), probs)
+        self.assertEqual(['Running'] * 4, [senz['motion'] for senz in result['result'][0]['senzList']])
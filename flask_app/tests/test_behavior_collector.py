@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""Unit test for behavior_collector"""
+
+__author__ = 'jiaying.lu'
+
+from unittest import TestCase
+
+from flask_app.behavior_collector import BehaviorCollector, collect_behaviors
+
+
+class TestBehaviorCollector(TestCase):
+
+    def setUp(self):
+        self.senz_tuple_lists = [
+            [
+                {'motionProb': {'A': 0.6, 'B': 0.4}, 'soundProb': {'X': 1.0}, 'timestamp': 100},
+                {'motionProb': {'B': 0.9, 'C': 0.1}, 'soundProb': {'X': 0.5, 'Y': 0.5}, 'timestamp': 201},
+                {'motionProb': {'B': 0.7, 'A': 0.3}, 'soundProb': {'Y': 1.0}, 'timestamp': 300},
+            ],
+            [
+                {'motionProb': {'C': 1.0}, 'soundProb': {'Y': 0.8, 'X': 0.2}, 'timestamp': 1000},
+            ],
+        ]
+
+    def test_first(self):
+        result = collect_behaviors(self.senz_tuple_lists)
+        self.assertEqual([{'motionProb': {'A': 0.6, 'B': 0.4}, 'soundProb': {'X': 1.0}, 'timestamp': 200},
+                          {'motionProb': {'C': 1.0}, 'soundProb': {'Y': 0.8, 'X': 0.2}, 'timestamp': 1000}], result)
+        self.assertEqual(result[0], BehaviorCollector(self.senz_tuple_lists[0]))
+
+    def test_mode(self):
+        result = collect_behaviors(self.senz_tuple_lists, 'mode')
+        self.assertEqual({'A': 1 / 3., 'B': 2 / 3.}, result[0]['motionProb'])
+        self.assertEqual({'C': 1.0}, result[1]['motionProb'])
+        # ties vote for the first seen label
+        self.assertEqual({'X': 2 / 3., 'Y': 1 / 3.}, result[0]['soundProb'])
+
+    def test_mean(self):
+        result = collect_behaviors(self.senz_tuple_lists, 'mean')
+        expected = {'A': 0.9 / 3, 'B': 2.0 / 3, 'C': 0.1 / 3}
+        for label, prob in expected.iteritems():
+            self.assertAlmostEqual(prob, result[0]['motionProb'][label])
+        self.assertEqual(['A', 'B', 'C'], sorted(result[0]['motionProb']))
+        self.assertEqual({'C': 1.0}, result[1]['motionProb'])
+
+    def test_max_prob(self):
+        result = collect_behaviors(self.senz_tuple_lists, 'max_prob')
+        self.assertEqual({'B': 0.9, 'C': 0.1}, result[0]['motionProb'])
+        self.assertEqual({'X': 1.0}, result[0]['soundProb'])
+        self.assertEqual({'Y': 0.8, 'X': 0.2}, result[1]['soundProb'])
+
+    def test_not_prob_fields(self):
+        senz_tuple_lists = [[dict(senz_tuple, objectId='object-%s' % index, perMinScale=10)
+                             for index, senz_tuple in enumerate(senz_tuple_list)]
+                            for senz_tuple_list in self.senz_tuple_lists]
+        del senz_tuple_lists[0][1]['soundProb']
+        result = collect_behaviors(senz_tuple_lists, 'mean')
+        self.assertEqual(['motionProb', 'soundProb', 'timestamp'], sorted(result[0]))
+        self.assertEqual({'X': 1.0 / 3, 'Y': 1.0 / 3}, result[0]['soundProb'])
+
+    def test_unvalid_strategy(self):
+        self.assertEqual([], collect_behaviors([], 'mean'))
+        self.assertRaises(KeyError, collect_behaviors, self.senz_tuple_lists, 'last')
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""Unit test for label_vocab"""
+
+__author__ = 'jiaying.lu'
+
+from unittest import TestCase
+
+from flask_app.label_vocab import LabelVocab, STARTUP_LABELS, label_vocab, encode_prob_dict, decode_prob_dict
+from flask_app.label_vocab import get_prob_matrix
+
+
+class TestLabelVocab(TestCase):
+
+    def test_encode_decode(self):
+        vocab = LabelVocab(['Walking', 'talk'])
+        self.assertEqual(2, vocab.stable_size)
+        self.assertEqual(1, vocab.encode('talk'))
+        self.assertEqual(2, vocab.encode('Swimming'))
+        self.assertEqual(2, vocab.encode('Swimming'))
+        self.assertEqual(3, len(vocab))
+        self.assertEqual('Swimming', vocab.decode(2))
+        self.assertEqual(True, 'Swimming' in vocab)
+        self.assertEqual(['Walking', 'talk'], vocab.stable_labels())
+
+    def test_wire(self):
+        vocab = LabelVocab(['Walking', 'talk'])
+        vocab.encode('Swimming')
+        # runtime codes differ between workers, they never leave the process
+        self.assertEqual([0, 'Swimming', 'Unknown'], [vocab.encode_wire(label) for label in ['Walking', 'Swimming', 'Unknown']])
+        self.assertEqual(['talk', 'talk', 'Swimming'], [vocab.decode_wire(key) for key in ['1', 1, 'Swimming']])
+        self.assertRaises(ValueError, vocab.decode_wire, '2')
+
+    def test_prob_dict(self):
+        self.assertEqual(STARTUP_LABELS, label_vocab.stable_labels())
+        walking = STARTUP_LABELS.index('Walking')
+        self.assertEqual({walking: 0.9, 'Swimming': 0.1}, encode_prob_dict({'Walking': 0.9, 'Swimming': 0.1}))
+        self.assertEqual({'Walking': 0.9, 'Swimming': 0.1}, decode_prob_dict({str(walking): 0.9, 'Swimming': 0.1}))
+
+    def test_max_size(self):
+        vocab = LabelVocab(['Walking'], max_size=2)
+        self.assertEqual(1, vocab.encode('Swimming'))
+        self.assertEqual(None, vocab.encode('Diving'))
+        self.assertEqual(2, len(vocab))
+        # labels the shared vocabulary has no room for get request local codes
+        local = vocab.local()
+        self.assertEqual([0, 1, -1, -2, -1], [local.encode(label) for label in
+                                              ['Walking', 'Swimming', 'Diving', 'Skiing', 'Diving']])
+        self.assertEqual(['Walking', 'Swimming', 'Diving', 'Skiing'], [local.decode(code) for code in [0, 1, -1, -2]])
+        self.assertEqual(2, len(local))
+        self.assertEqual(2, len(vocab))
+
+    def test_get_prob_matrix(self):
+        vocab = LabelVocab(['B'], max_size=2).local()
+        label_codes, prob_matrix, present_matrix = get_prob_matrix([{'A': 0.9, 'B': 0.1}, {'C': 1.0}, {'B': 0.5, 'A': 0.0}],
+                                                                   vocab)
+        labels = [vocab.decode(code) for code in label_codes.tolist()]
+        self.assertEqual(['A', 'B', 'C'], sorted(labels))
+        self.assertEqual([-1, 0, 1], sorted(label_codes.tolist()))
+        columns = [labels.index(label) for label in ['A', 'B', 'C']]
+        self.assertEqual([[0.9, 0.1, 0], [0, 0, 1.0], [0, 0.5, 0]], prob_matrix[:, columns].tolist())
+        self.assertEqual([[True, True, False], [False, False, True], [True, True, False]],
+                         present_matrix[:, columns].tolist())
@@ -5,11 +5,32 @@
 __author__ = 'jiaying.lu'
 
 from unittest import TestCase
+import json
+import threading
 import numpy as np
 
 from flask_app.log2rawsenz import _get_sequence_length, _get_sequence_time_length, _get_time_distribution_params, _get_time_distribution
-from flask_app.log2rawsenz import _find_nearest_node, _generate_senz_collected
-from flask_app.log2rawsenz import generate_sequences_measures, choose_primary_key, collect_senz_lists
+from flask_app.log2rawsenz import _find_nearest_node, _find_nearest_timestamp, _generate_senz_collected
+from flask_app.log2rawsenz import _index_timeline, _bisect_nearest, _align_bisect, _align_numpy
+from flask_app.log2rawsenz import _is_sorted, _align_merge, _index_timestamps, align_timestamps
+from flask_app.log2rawsenz import generate_sequences_measures, choose_primary_key, collect_senz_lists, collect_senz_columns
+from flask_app.log2rawsenz import align_senz_lists
+from flask_app import log2rawsenz
+from flask_app.log2rawsenz import collect_senz_lists_batch, iter_session_senz_lists, _extend_timeline_index
+
+
+
+class RecordingLogger(object):
+    """Stand-in of log2rawsenz.logger keeping error messages"""
+
+    def __init__(self):
+        self.errors = []
+
+    def error(self, msg):
+        self.errors.append(msg)
+
+    def info(self, msg):
+        pass
 
 
 class TestMeasuresMethod(TestCase):
@@ -64,6 +85,13 @@ class TestMeasuresMethod(TestCase):
         sequence = np.array([1, 2, 3, 4, 5, 6, 7])
         self.assertEqual(8, _get_time_distribution(sequence, 1, 2))
 
+        # case 6: unsorted sequence
+        sequence = [6, 1, 4, 3, 7, 2, 5]
+        self.assertEqual(8, _get_time_distribution(sequence, 1, 2))
+
+        # case 7: empty segments
+        self.assertEqual(0, _get_time_distribution([1, 2, 3], 1, 0))
+
 
 class TestCollectMethod(TestCase):
 
@@ -83,6 +111,74 @@ class TestCollectMethod(TestCase):
         node_list = np.array([1, 3, 5, 7, 9, 11])
         self.assertEqual(11, _find_nearest_node(primary_node, node_list))
 
+    def test_index_timeline(self):
+        node_list = [{'timestamp': 5, 'id': 0}, {'timestamp': 1, 'id': 1},
+                     {'timestamp': 5, 'id': 2}, {'timestamp': 3, 'id': 3}]
+        self.assertEqual(([1, 3, 5], [1, 3, 0]), _index_timeline(node_list))
+        self.assertEqual(([], []), _index_timeline([]))
+
+    def test_bisect_nearest(self):
+        timestamps = [1, 3, 5, 8]
+        self.assertEqual(0, _bisect_nearest(timestamps, 0))
+        self.assertEqual(0, _bisect_nearest(timestamps, 2))  # tie goes to the earlier one
+        self.assertEqual(2, _bisect_nearest(timestamps, 5))
+        self.assertEqual(3, _bisect_nearest(timestamps, 7))
+        self.assertEqual(3, _bisect_nearest(timestamps, 12))
+
+    def test_align_bisect(self):
+        # case 1: same nodes as _find_nearest_timestamp
+        node_list = [{'timestamp': t, 'id': i} for i, t in enumerate([9, 3, 14, 3, 20, 7, 11])]
+        primary_timestamps = range(-2, 25)
+        matched = _align_bisect(primary_timestamps, _index_timeline(node_list), 1e9)
+        for primary_timestamp, position in zip(primary_timestamps, matched):
+            self.assertIs(_find_nearest_timestamp(primary_timestamp, node_list), node_list[position])
+
+        # case 2: filter and empty timeline
+        node_list = [{'timestamp': 3}, {'timestamp': 5}, {'timestamp': 8}]
+        self.assertEqual([-1, 0, 1, 2, 2], _align_bisect([1, 4, 5, 7, 9], _index_timeline(node_list), 1))
+        self.assertEqual([-1, -1], _align_bisect([1, 2], _index_timeline([]), 1))
+
+    def test_align_numpy(self):
+        # case 1: same as _align_bisect
+        node_list = [{'timestamp': t} for t in [9, 3, 14, 3, 20, 7, 11]]
+        primary_timestamps = range(-2, 25)
+        for var_filter in [0, 1, 4, 1e9]:
+            timeline_index = _index_timeline(node_list)
+            np.testing.assert_array_equal(_align_bisect(primary_timestamps, timeline_index, var_filter),
+                                          _align_numpy(primary_timestamps, timeline_index, var_filter))
+
+        # case 2: empty timeline
+        np.testing.assert_array_equal([-1, -1], _align_numpy([1, 2], _index_timeline([]), 1))
+
+    def test_is_sorted(self):
+        self.assertEqual(True, _is_sorted([]))
+        self.assertEqual(True, _is_sorted([{'timestamp': 1}, {'timestamp': 1}, {'timestamp': 4}]))
+        self.assertEqual(False, _is_sorted([{'timestamp': 1}, {'timestamp': 4}, {'timestamp': 3}]))
+
+    def test_align_merge(self):
+        # case 1: same as _align_bisect on sorted timelines
+        node_list = [{'timestamp': t} for t in [3, 3, 7, 9, 11, 14, 20]]
+        primary_timestamps = range(-2, 25)
+        for var_filter in [0, 1, 4, 1e9]:
+            self.assertEqual(_align_bisect(primary_timestamps, _index_timeline(node_list), var_filter),
+                             _align_merge(primary_timestamps, _index_timeline(node_list, presorted=True), var_filter))
+
+        # case 2: empty timeline
+        self.assertEqual([-1, -1], _align_merge([1, 2], _index_timeline([], presorted=True), 1))
+
+    def test_index_timestamps(self):
+        timestamps, positions = _index_timestamps([5, 1, 5, 3])
+        np.testing.assert_array_equal([1, 3, 5], timestamps)
+        np.testing.assert_array_equal([1, 3, 0], positions)
+
+    def test_align_timestamps(self):
+        secondary_aligned = align_timestamps([1, 4, 5, 7, 9], {'SK': [9, 8, 5, 3], 'HK': [2, 5], 'EK': []}, 1)
+        np.testing.assert_array_equal([-1, 3, 2, 1, 0], secondary_aligned['SK'][0])
+        np.testing.assert_array_equal([0, -1, 0, 1, 0], secondary_aligned['SK'][1])
+        np.testing.assert_array_equal([0, 1, 1, -1, -1], secondary_aligned['HK'][0])
+        np.testing.assert_array_equal([1, 1, 0, 0, 0], secondary_aligned['HK'][1])
+        np.testing.assert_array_equal([-1] * 5, secondary_aligned['EK'][0])
+
     def test_generate_senz_collected(self):
         # case 1
         primary_sequence = {'PK': np.array([1, 4, 5, 7, 9])}
@@ -130,6 +226,16 @@ class TestInterfaceMethod(TestCase):
         }
         self.assertEqual('key0', choose_primary_key(timelines))
 
+        # every product measure is 0, fall back to sum measure
+        timelines = {
+            "key0": [{'timestamp': 2}],
+            "key1": [{'timestamp': 3}, {'timestamp': 4}],
+        }
+        self.assertEqual('key1', choose_primary_key(timelines))
+
+        # nothing to measure
+        self.assertEqual('', choose_primary_key({"key0": [], "key1": []}))
+
     def test_collect_senz_lists(self):
         # case 1
         data = {
@@ -147,6 +253,13 @@ class TestInterfaceMethod(TestCase):
                   {'SK': {'timestamp': 8}, 'PK': {'timestamp': 7}, 'HK': {'timestamp': 7, 'objectId': 'counterfeitObjectId', 'userRawdataId': 'counterfeitRawdataId'}},
                   {'SK': {'timestamp': 9}, 'PK': {'timestamp': 9}, 'HK': {'timestamp': 9, 'objectId': 'counterfeitObjectId', 'userRawdataId': 'counterfeitRawdataId'}}]
         self.assertEqual(result, collect_senz_lists(data))
+        for align_mode in ['bisect', 'numpy', 'merge']:
+            data['align_mode'] = align_mode
+            self.assertEqual(result, collect_senz_lists(data))
+
+        # unsorted timelines fall back from merge
+        data['timelines']['SK'].reverse()
+        self.assertEqual(result, collect_senz_lists(data))
 
         # case 2
         data = {
@@ -161,3 +274,184 @@ class TestInterfaceMethod(TestCase):
                   {'SK': {'timestamp': 3, 'objectId': 'counterfeitObjectId', 'userRawdataId': 'counterfeitRawdataId'}, 'PK': {'timestamp': 3}},
                   {'SK': {'timestamp': 5, 'objectId': 'counterfeitObjectId', 'userRawdataId': 'counterfeitRawdataId'}, 'PK': {'timestamp': 5}}]
         self.assertEqual(result, collect_senz_lists(data))
+
+    def test_collect_senz_columns(self):
+        data = {
+            'primary_key': 'HK',
+            'filter': 1,
+            'timelines': {
+                'PK': [{'timestamp': 1}, {'timestamp': 4}, {'timestamp': 5}, {'timestamp': 7}, {'timestamp': 9}],
+                'SK': [{'timestamp': 9}, {'timestamp': 8}, {'timestamp': 5}, {'timestamp': 3}],
+                'HK': [{'timestamp': 2}, {'timestamp': 5}],
+                'EK': [],
+            }
+        }
+        senz_columns = {
+            'primaryKey': 'PK',
+            'primary': data['timelines']['PK'],
+            'matched': {'SK': [-1, 3, 2, 1, 0], 'HK': [0, 1, 1, -1, -1], 'EK': [-1, -1, -1, -1, -1]}
+        }
+        self.assertEqual(senz_columns, collect_senz_columns(data))
+
+    def test_align_senz_lists_thread_pool(self):
+        timelines = {'PK': [{'timestamp': t} for t in xrange(0, 300, 3)]}
+        for key in ['motion', 'sound', 'location', 'wifi']:
+            timelines[key] = [{'timestamp': t} for t in np.random.RandomState(len(key)).randint(0, 300, 50)]
+        data = {'filter': 4, 'timelines': timelines, 'align_mode': 'numpy'}
+        expected = align_senz_lists(data)
+
+        default_pool_size, default_min_nodes = log2rawsenz.ALIGN_THREAD_POOL_SIZE, log2rawsenz.ALIGN_THREAD_MIN_NODES
+        log2rawsenz.ALIGN_THREAD_POOL_SIZE, log2rawsenz.ALIGN_THREAD_MIN_NODES = 2, 0
+        try:
+            primary_key, secondary_matched = align_senz_lists(data)
+        finally:
+            log2rawsenz.ALIGN_THREAD_POOL_SIZE, log2rawsenz.ALIGN_THREAD_MIN_NODES = default_pool_size, default_min_nodes
+
+        self.assertEqual(expected[0], primary_key)
+        self.assertEqual(sorted(expected[1]), sorted(secondary_matched))
+        for key in secondary_matched:
+            np.testing.assert_array_equal(expected[1][key], secondary_matched[key])
+            np.testing.assert_array_equal(_align_bisect([t['timestamp'] for t in timelines[primary_key]],
+                                                        _index_timeline(timelines[key]), 4), secondary_matched[key])
+
+    def test_collect_senz_lists_batch(self):
+        jobs = [
+            {'primary_key': 'PK', 'filter': 1,
+             'timelines': {'PK': [{'timestamp': t}], 'SK': [{'timestamp': t+1}]}}
+            for t in xrange(8)
+        ]
+        jobs[3] = {'filter': 1}
+        jobs[5]['timelines']['SK'] = [1, 'error_key']
+
+        default_pool_size = log2rawsenz.BATCH_POOL_SIZE
+        default_logger = log2rawsenz.logger
+        for pool_size in [1, 2]:  # serial and pooled
+            log2rawsenz.BATCH_POOL_SIZE = pool_size
+            log2rawsenz.logger = RecordingLogger()
+            try:
+                job_results = collect_senz_lists_batch(jobs)
+                errors = log2rawsenz.logger.errors
+            finally:
+                log2rawsenz.BATCH_POOL_SIZE = default_pool_size
+                log2rawsenz.logger = default_logger
+
+            self.assertEqual([0, 0, 0, 103, 0, 1, 0, 0], [job_result['code'] for job_result in job_results])
+            # the failed job is logged by the calling process, not returned
+            self.assertNotIn('error', job_results[5])
+            self.assertEqual(1, len(errors))
+            self.assertIn('job 5', errors[0])
+            self.assertIn('Traceback', errors[0])
+            for t in [0, 1, 2, 4, 6, 7]:
+                self.assertEqual([{'PK': {'timestamp': t}, 'SK': {'timestamp': t+1}}], job_results[t]['result'])
+        self.assertEqual([], collect_senz_lists_batch([]))
+
+    def test_collect_senz_lists_batch_after_thread_pool(self):
+        timelines = {'PK': [{'timestamp': t} for t in xrange(0, 300, 3)]}
+        for key in ['motion', 'sound', 'location']:
+            timelines[key] = [{'timestamp': t} for t in np.random.RandomState(len(key)).randint(0, 300, 50)]
+        job = {'primary_key': 'PK', 'filter': 4, 'timelines': timelines, 'align_mode': 'numpy'}
+        expected = collect_senz_lists(job)
+
+        defaults = (log2rawsenz.BATCH_POOL_SIZE, log2rawsenz.ALIGN_THREAD_POOL_SIZE, log2rawsenz.ALIGN_THREAD_MIN_NODES,
+                    log2rawsenz._batch_pool)
+        log2rawsenz.BATCH_POOL_SIZE, log2rawsenz.ALIGN_THREAD_POOL_SIZE, log2rawsenz.ALIGN_THREAD_MIN_NODES = 2, 2, 0
+        log2rawsenz._batch_pool = None
+        job_results = []
+        try:
+            # batch pool processes are forked after the align thread pool exists
+            collect_senz_lists(job)
+            batch = threading.Thread(target=lambda: job_results.extend(collect_senz_lists_batch([job, job])))
+            batch.daemon = True
+            batch.start()
+            batch.join(30)
+            self.assertFalse(batch.is_alive())
+        finally:
+            if log2rawsenz._batch_pool is not None:
+                log2rawsenz._batch_pool.terminate()
+            (log2rawsenz.BATCH_POOL_SIZE, log2rawsenz.ALIGN_THREAD_POOL_SIZE, log2rawsenz.ALIGN_THREAD_MIN_NODES,
+             log2rawsenz._batch_pool) = defaults
+
+        self.assertEqual([0, 0], [job_result['code'] for job_result in job_results])
+        self.assertEqual([expected, expected], [job_result['result'] for job_result in job_results])
+
+    def test_extend_timeline_index(self):
+        timeline_index = ([], [])
+        _extend_timeline_index(timeline_index, [{'timestamp': 5, 'id': 0}, {'timestamp': 1, 'id': 1}])
+        _extend_timeline_index(timeline_index, [{'timestamp': 5, 'id': 2}, {'timestamp': 3, 'id': 3},
+                                                {'timestamp': 9, 'id': 4}])
+        self.assertEqual([1, 3, 5, 9], timeline_index[0])
+        self.assertEqual([1, 3, 0, 4], [json.loads(node)['id'] for node in timeline_index[1]])
+
+        # only keep the newest nodes
+        _extend_timeline_index(timeline_index, [{'timestamp': 11}], max_events=3)
+        self.assertEqual([5, 9, 11], timeline_index[0])
+
+        # nodes before min_timestamp are dropped or not indexed
+        _extend_timeline_index(timeline_index, [{'timestamp': 6}, {'timestamp': 10}], min_timestamp=9)
+        self.assertEqual([9, 10, 11], timeline_index[0])
+        self.assertEqual([{'timestamp': 10}], [json.loads(node) for node in timeline_index[1][1:2]])
+
+    def test_iter_session_senz_lists(self):
+        data = {
+            'primary_key': 'HK',
+            'filter': 1,
+            'timelines': {
+                'PK': [{'timestamp': 1}, {'timestamp': 4}, {'timestamp': 5}],
+                'SK': [{'timestamp': 3}, {'timestamp': 5}],
+            }
+        }
+        result = [{'SK': {'timestamp': 1, 'objectId': 'counterfeitObjectId', 'userRawdataId': 'counterfeitRawdataId'}, 'PK': {'timestamp': 1}},
+                  {'SK': {'timestamp': 3}, 'PK': {'timestamp': 4}},
+                  {'SK': {'timestamp': 5}, 'PK': {'timestamp': 5}}]
+        self.assertEqual(result, list(iter_session_senz_lists('test-user', data)))
+
+        # overlapping re-upload, only new primary nodes are aligned against whole index
+        data['timelines'] = {
+            'PK': [{'timestamp': 5}, {'timestamp': 7}, {'timestamp': 9}],
+            'SK': [{'timestamp': 5}, {'timestamp': 8}],
+        }
+        result = [{'SK': {'timestamp': 8}, 'PK': {'timestamp': 7}},
+                  {'SK': {'timestamp': 8}, 'PK': {'timestamp': 9}}]
+        self.assertEqual(result, list(iter_session_senz_lists('test-user', data)))
+        self.assertEqual([], list(iter_session_senz_lists('test-user', data)))
+
+        # SK nodes farther than sqrt(filter) before the latest primary node can't be matched any more
+        self.assertEqual([[8]], [timestamps for timestamps, _ in log2rawsenz._sessions.get('test-user')['timelines'].values()])
+        data['timelines'] = {'PK': [{'timestamp': 10}], 'SK': [{'timestamp': 4}, {'timestamp': 11}]}
+        self.assertEqual([{'SK': {'timestamp': 11}, 'PK': {'timestamp': 10}}],
+                         list(iter_session_senz_lists('test-user', data)))
+        self.assertEqual([[11]], [timestamps for timestamps, _ in log2rawsenz._sessions.get('test-user')['timelines'].values()])
+
+    def test_concurrent_session_requests(self):
+        data = {'primary_key': 'PK', 'filter': 100,
+                'timelines': {'PK': [{'timestamp': t} for t in xrange(0, 2000, 2)],
+                              'SK': [{'timestamp': t} for t in xrange(1, 2000, 2)]}}
+        results = []
+
+        def request():
+            results.extend(iter_session_senz_lists('concurrent-user', data))
+
+        threads = [threading.Thread(target=request) for _ in xrange(8)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            log2rawsenz._sessions.pop('concurrent-user')
+        # one request creates the session and aligns every primary node, the others see its watermark
+        self.assertEqual(range(0, 2000, 2), sorted(senz_tuple['PK']['timestamp'] for senz_tuple in results))
+
+    def test_session_max_total_events(self):
+        default_sessions = log2rawsenz._sessions
+        log2rawsenz._sessions = log2rawsenz.LRUStore(10, weigh=log2rawsenz._get_session_events, max_weight=5)
+        try:
+            for session_id in ['user-0', 'user-1']:
+                data = {'primary_key': 'PK', 'filter': 100,
+                        'timelines': {'PK': [{'timestamp': t} for t in xrange(4)], 'SK': [{'timestamp': t} for t in xrange(3)]}}
+                list(iter_session_senz_lists(session_id, data))
+            # 'user-0' is evicted to keep indexed nodes of all sessions under max weight
+            self.assertEqual(False, 'user-0' in log2rawsenz._sessions)
+            self.assertEqual(3, log2rawsenz._sessions.weight)
+        finally:
+            log2rawsenz._sessions = default_sessions
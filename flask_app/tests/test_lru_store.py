@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""Unit test for lru_store"""
+
+__author__ = 'jiaying.lu'
+
+from unittest import TestCase
+
+from flask_app import lru_store
+from flask_app.lru_store import LRUStore
+
+
+class TestLRUStore(TestCase):
+
+    def test_get_put(self):
+        store = LRUStore(2)
+        store.put('a', 1)
+        store.put('b', 2)
+        self.assertEqual(1, store.get('a'))
+        self.assertEqual(None, store.get('c'))
+        self.assertEqual(0, store.get('c', 0))
+
+        # 'b' is least recently used now
+        store.put('c', 3)
+        self.assertEqual(2, len(store))
+        self.assertEqual(False, 'b' in store)
+        self.assertEqual(True, 'a' in store)
+
+    def test_stats(self):
+        store = LRUStore(2)
+        store.put('a', 1)
+        store.get('a')
+        store.get('b')
+        store.get('a')
+        self.assertEqual({'size': 1, 'capacity': 2, 'hits': 2, 'misses': 1}, store.stats())
+        store.clear()
+        self.assertEqual({'size': 0, 'capacity': 2, 'hits': 0, 'misses': 0}, store.stats())
+
+    def test_pop_clear(self):
+        store = LRUStore(2)
+        store.put('a', 1)
+        self.assertEqual(1, store.pop('a'))
+        self.assertEqual(None, store.pop('a'))
+        store.put('b', 2)
+        store.clear()
+        self.assertEqual(0, len(store))
+
+    def test_max_weight(self):
+        store = LRUStore(10, weigh=len, max_weight=5)
+        store.put('a', [1, 2])
+        store.put('b', [1, 2])
+        store.get('a')
+        # 'b' is least recently used
+        store.put('c', [1, 2])
+        self.assertEqual(['a', 'c'], sorted(key for key in 'abc' if key in store))
+        self.assertEqual(4, store.stats()['weight'])
+
+        # weight is taken again on put
+        value = store.get('a')
+        value.extend([3, 4])
+        store.put('a', value)
+        self.assertEqual(False, 'c' in store)
+        self.assertEqual(4, store.weight)
+
+        # a single heavy key is kept
+        store.put('d', range(8))
+        self.assertEqual(['d'], [key for key in 'abcd' if key in store])
+        self.assertEqual(8, store.weight)
+        store.pop('d')
+        self.assertEqual(0, store.weight)
+
+    def test_max_idle(self):
+        class FakeTime(object):
+            now = 100.0
+
+            def time(self):
+                return self.now
+
+        fake_time = FakeTime()
+        origin_time = lru_store.time
+        lru_store.time = fake_time
+        try:
+            store = LRUStore(10, max_idle=60)
+            store.put('a', 1)
+            store.put('b', 2)
+            fake_time.now = 150.0
+            self.assertEqual(1, store.get('a'))
+            fake_time.now = 200.0
+            # 'b' idle for 100s, 'a' only for 50s
+            self.assertEqual(None, store.get('b'))
+            self.assertEqual(1, len(store))
+            fake_time.now = 300.0
+            store.put('c', 3)
+            self.assertEqual(False, 'a' in store)
+            self.assertEqual(3, store.get('c'))
+        finally:
+            lru_store.time = origin_time
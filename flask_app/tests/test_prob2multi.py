@@ -1,7 +1,11 @@
 __author__ = 'lu'
 
 from unittest import TestCase
-from flask_app.prob2multi import _probSenz_zip, _probSenz_zip_top_N
+from flask_app.prob2multi import _probSenz_zip, _probSenz_zip_top_N, _fold_k_best, _get_suffix_bounds
+from flask_app.prob2multi import _unlink_senz_list
+from flask_app.prob2multi import prob2muti, prob2muti_top_k, prob2muti_quick, prob2muti_beam
+import copy
+import itertools
 from numpy import log
 
 
@@ -67,8 +71,159 @@ class TestBasicMethods(TestCase):
         #self.assertEqual(senzList_elem_candidate, result)
         self.assertEqual('Walking', result[0]['motion'])
         self.assertEqual('talk', result[0]['sound'])
-        self.assertEqual('Driving', result[2]['motion'])
-        self.assertEqual('restaurant', result[2]['location'])
+        self.assertEqual(('Walking', 'restaurant'), (result[1]['motion'], result[1]['location']))
+        self.assertEqual(('Running', 'resident'), (result[2]['motion'], result[2]['location']))
+        self.assertAlmostEqual(log(0.08163265323813619 * 0.235434542 * 0.234234523454), result[2]['prob'])
+        self.assertEqual(1297923712, result[2]['timestamp'])
 
         self.assertEqual([], _probSenz_zip_top_N(probSenzList_elem, 3, 0))
 
+    def test_fold_k_best(self):
+        score_lists = [[-1.0, -0.5, -2.0], [-3.0, -1.0], [-0.5, -0.5]]
+        result = [(total, _unlink_senz_list(node)) for total, node in _fold_k_best(score_lists, 100, -100)]
+        self.assertEqual(12, len(result))
+        self.assertEqual((-2.0, [1, 1, 0]), result[0])
+        # ties keep the order of original indexes
+        self.assertEqual((-2.0, [1, 1, 1]), result[1])
+        self.assertEqual([total for total, _ in result], sorted([total for total, _ in result], reverse=True))
+        expected = sorted(((sum(scores), list(indexes)) for indexes, scores in
+                           zip(itertools.product(*[range(len(scores)) for scores in score_lists]),
+                               itertools.product(*score_lists))),
+                          key=lambda (total, indexes): (-total, indexes))
+        self.assertEqual(expected, result)
+        self.assertEqual(result[:5], [(total, _unlink_senz_list(node)) for total, node
+                                      in _fold_k_best(score_lists, 5, -100)])
+        # prefixes <= lower bound are dropped
+        self.assertEqual([(-2.0, [1, 1, 0]), (-2.0, [1, 1, 1])],
+                         [(total, _unlink_senz_list(node)) for total, node in _fold_k_best(score_lists, 100, -2.1)])
+        self.assertEqual([], _fold_k_best([[-1.0], []], 3, -100))
+        self.assertEqual([], _fold_k_best(score_lists, 0, -100))
+
+
+    def test_get_suffix_bounds(self):
+        probSenzList_zip = [[{'prob': -1.0}, {'prob': -3.0}], [{'prob': -2.0}], [{'prob': -0.5}, {'prob': 0.5}]]
+        self.assertEqual([-2.5, -1.5, 0.5, 0.0], _get_suffix_bounds(probSenzList_zip))
+        self.assertEqual([float('-inf'), float('-inf'), 0.0], _get_suffix_bounds([[{'prob': -1.0}], []]))
+
+
+    def test_unlink_senz_list(self):
+        first, second, third = {'motion': 'Walking'}, {'motion': 'Running'}, {'motion': 'Sitting'}
+        parent = (second, (first, None))
+        self.assertEqual([first, second, third], _unlink_senz_list((third, parent)))
+        self.assertEqual([first, second], _unlink_senz_list(parent))
+        self.assertEqual([], _unlink_senz_list(None))
+
+
+class TestInterfaceMethods(TestCase):
+
+    def test_prob2muti_top_k(self):
+        prob_senz_list = [
+            {
+                'motion': {'Riding': 0.2457, 'Walking': 0.2863, 'Running': 0.3112, 'Driving': 0.1, 'Sitting': 0.0577},
+                'location': {'restaurant': 0.621, 'resident': 0.379},
+                'sound': {'talk': 0.2342, 'shot': 0.4321, 'sing': 0.3337},
+            },
+            {
+                'motion': {'Walking': 0.5, 'Running': 0.5},
+                'location': {'school': 3.14},
+                'sound': {'talk': 1e-20, 'sing': 0.9},
+            },
+            {
+                'motion': {'Riding': 0.9, 'Sitting': 0.1},
+                'location': {'restaurant': 0.5, 'resident': 0.5},
+                'sound': {'talk': 1.0},
+            },
+        ]
+        for prob_lower_bound in [log(1e-30), log(1e-3)]:
+            muti_senz_list = sorted(prob2muti(prob_senz_list, prob_lower_bound), key=lambda elem: elem['prob'], reverse=True)
+            for top_k in [0, 1, 5, 100, 1000]:
+                self.assertEqual(muti_senz_list[:top_k], prob2muti_top_k(prob_senz_list, top_k, prob_lower_bound))
+        self.assertEqual([], prob2muti_top_k([], 3))
+
+    def test_prob2muti_quick(self):
+        prob_senz_list = [
+            {
+                'motion': {'Riding': 0.2457, 'Walking': 0.2863, 'Running': 0.3112, 'Driving': 0.1, 'Sitting': 0.0577},
+                'location': {'restaurant': 0.621, 'resident': 0.379},
+                'sound': {'talk': 0.2342, 'shot': 0.4321, 'sing': 0.3337},
+                'timestamp': 1297923712,
+            },
+            {
+                'motion': {'Walking': 1e-40},
+                'location': {'school': 1.0},
+                'sound': {'talk': 1.0},
+                'timestamp': 1297923772,
+            },
+            {
+                'motion': {'Riding': 0.9, 'Sitting': 0.1},
+                'location': {'restaurant': 0.5, 'resident': 0.5},
+                'sound': {'talk': 1.0},
+                'timestamp': 1297923832,
+            },
+        ]
+        origin = copy.deepcopy(prob_senz_list)
+        # joint probs of every senz list, elems without candidate skipped
+        candidate_lists = [_probSenz_zip(elem, log(1e-30)) for elem in prob_senz_list]
+        joint_probs = sorted((sum(candidate['prob'] for candidate in candidates)
+                              for candidates in itertools.product(*[elem for elem in candidate_lists if elem])),
+                             reverse=True)
+        for top_N in [1, 3, 40]:
+            result = prob2muti_quick(prob_senz_list, top_N)
+            self.assertEqual(min(top_N, len(joint_probs)), len(result))
+            for expected_prob, muti_senz in zip(joint_probs, result):
+                self.assertAlmostEqual(expected_prob, muti_senz['prob'])
+                self.assertEqual([1297923712, 1297923832], [senz['timestamp'] for senz in muti_senz['senzList']])
+                self.assertNotIn('prob', muti_senz['senzList'][0])
+        self.assertEqual(['Running', 'Riding'], [senz['motion'] for senz in result[0]['senzList']])
+        self.assertEqual(origin, prob_senz_list)
+        self.assertEqual([], prob2muti_quick(prob_senz_list, 3, 0))
+
+    def test_prob2muti_beam(self):
+        prob_senz_list = [
+            {
+                'motion': {'Riding': 0.2457, 'Walking': 0.2863, 'Running': 0.3112, 'Driving': 0.1, 'Sitting': 0.0577},
+                'location': {'restaurant': 0.621, 'resident': 0.379},
+                'sound': {'talk': 0.2342, 'shot': 0.4321, 'sing': 0.3337},
+            },
+            {
+                'motion': {'Walking': 0.6, 'Running': 0.4},
+                'location': {'school': 1.0},
+                'sound': {'talk': 0.1, 'sing': 0.9},
+            },
+            {
+                'motion': {'Riding': 0.9, 'Sitting': 0.1},
+                'location': {'restaurant': 0.6, 'resident': 0.4},
+                'sound': {'talk': 1.0},
+            },
+        ]
+        muti_senz_list = sorted(prob2muti(prob_senz_list), key=lambda elem: elem['prob'], reverse=True)
+        # a beam keeping everything is the exhaustive search
+        self.assertEqual(muti_senz_list, prob2muti_beam(prob_senz_list, len(muti_senz_list)))
+        # beam of 1 is greedy, best elem by elem
+        result = prob2muti_beam(prob_senz_list, 1)
+        self.assertEqual(1, len(result))
+        self.assertEqual([('Running', 'restaurant', 'shot'), ('Walking', 'school', 'sing'), ('Riding', 'restaurant', 'talk')],
+                         [(senz['motion'], senz['location'], senz['sound']) for senz in result[0]['senzList']])
+        self.assertEqual(muti_senz_list[0]['prob'], result[0]['prob'])
+        result = prob2muti_beam(prob_senz_list, 5)
+        self.assertEqual(5, len(result))
+        for expected, muti_senz in zip(muti_senz_list, result):
+            self.assertGreaterEqual(expected['prob'], muti_senz['prob'])
+        self.assertEqual([], prob2muti_beam(prob_senz_list, 5, log(0.03)))
+        self.assertEqual([], prob2muti_beam([], 5))
+
+    def test_prob2muti_pruned_stats(self):
+        prob_senz_list = [
+            {'motion': {'Walking': 0.5, 'Running': 1e-20}, 'location': {'school': 1.0}, 'sound': {'talk': 1.0}},
+            {'motion': {'Walking': 1e-15}, 'location': {'school': 1.0}, 'sound': {'talk': 1.0}},
+        ]
+        stats = {}
+        result = prob2muti(prob_senz_list, log(1e-30), stats)
+        # Running can't reach the bound with the best prob of the 2nd elem, it is pruned at once
+        self.assertEqual(1, stats['pruned'])
+        self.assertEqual(['Walking', 'Walking'], [senz['motion'] for senz in result[0]['senzList']])
+        self.assertEqual(1, len(result))
+
+        stats = {}
+        self.assertEqual([], prob2muti(prob_senz_list, log(1e-10), stats))
+        self.assertEqual(1, stats['pruned'])
@@ -3,10 +3,16 @@
 __author__ = 'jiaying.lu'
 
 from unittest import TestCase
+import copy
+import threading
 import numpy as np
 
 from flask_app.raw2refine import _collect_probs, _get_arithmetic_average, _check_blank_condition
-from flask_app.raw2refine import refine_senz_prob_list
+from flask_app.raw2refine import _combine_bucket_probs, _get_scale_values
+from flask_app.label_vocab import label_vocab, get_prob_matrix
+from flask_app import raw2refine
+from flask_app.raw2refine import refine_senz_prob_list, refine_senz_prob_windows, refine_senz_prob_pyramid
+from flask_app.raw2refine import refine_senz_prob_stream
 
 
 class MyTestCase(TestCase):
@@ -84,6 +90,29 @@ class TestInnerMethod(MyTestCase):
         result = {'A': 0.46, 'B': 0.44, 'C': 0.1}
         self.assertDeepAlmostEqual(result, _collect_probs(cur_prob_list, other_prob_list, k_weight))
 
+    def test_combine_bucket_probs(self):
+        prob_list = [{'A': 0.9, 'B': 0.1}, {'A': 0.1, 'B': 0.9}, {'A': 0.4, 'C': 0.6}, {'A': 0.2, 'B': 0.4, 'C': 0.4}]
+        vocab = label_vocab.local()
+        label_codes, prob_matrix, _ = get_prob_matrix(prob_list, vocab)
+        labels = [vocab.decode(code) for code in label_codes.tolist()]
+        bucket_sums = np.array([prob_matrix[0] + prob_matrix[2], prob_matrix[1], prob_matrix[3]])
+        for k_weight in [0.5, 0.75, 2]:
+            result = [_collect_probs([prob_list[0], prob_list[2]], prob_list, k_weight),
+                      _collect_probs([prob_list[1]], prob_list, k_weight),
+                      _collect_probs([prob_list[3]], prob_list, k_weight)]
+            bucket_probs = _combine_bucket_probs(bucket_sums, [2, 1, 1], k_weight)
+            self.assertDeepAlmostEqual(result, [dict(zip(labels, row)) for row in bucket_probs.tolist()])
+
+    def test_get_scale_values(self):
+        # 1970-01-01 23:59 and 1970-01-02 01:30 UTC
+        senz_prob_list = [{'timestamp': 1439 * 60000 + 59999, 'perHourScale': 7}, {'timestamp': 1530 * 60000}]
+        self.assertEqual([1439, 90], _get_scale_values('perMinScale', senz_prob_list, 0).tolist())
+        self.assertEqual([23, 1], _get_scale_values('perHourScale', senz_prob_list, 0).tolist())
+        # UTC+8 and UTC-2
+        self.assertEqual([15, 19], _get_scale_values('halfHourScale', senz_prob_list, 480).tolist())
+        self.assertEqual([131, 141], _get_scale_values('tenMinScale', senz_prob_list, -120).tolist())
+        self.assertEqual([7], _get_scale_values('perHourScale', senz_prob_list[:1]).tolist())
+
     def test_check_blank_condition(self):
         # case 1
         my_list = [1, 3, 5, 7]
@@ -281,6 +310,242 @@ class TestInterfaceMethod(MyTestCase):
         self.assertEqual([11, 12], result[1]['senzId'])
         self.assertEqual([], result[3]['senzId'])
 
+    def test_refine_senz_prob_list_wrap_window(self):
+        senz_prob_list = [
+            {'motionProb': {'A': 0.7, 'B': 0.3}, 'timestamp': 100, 'perHourScale': 22, 'senzId': 11},
+            {'motionProb': {'A': 0.3, 'C': 0.7}, 'timestamp': 200, 'perHourScale': 0, 'senzId': 12},
+            {'motionProb': {'B': 0.7, 'C': 0.3}, 'timestamp': 300, 'perHourScale': 1, 'senzId': 21},
+            {'motionProb': {'D': 1.0}, 'timestamp': 400, 'perHourScale': 12, 'senzId': 31},
+        ]
+        origin_senz_prob_list = copy.deepcopy(senz_prob_list)
+        result = refine_senz_prob_list('perHourScale', 22, 2, senz_prob_list)
+
+        # inputs are never mutated
+        self.assertEqual(origin_senz_prob_list, senz_prob_list)
+        # bucket 12 is out of window, 23 is filled, 2 is filled from 1
+        self.assertEqual([22, 23, 0, 1, 2], [elem['perHourScale'] for elem in result])
+        self.assertEqual([[11], [], [12], [21], []], [elem['senzId'] for elem in result])
+        self.assertEqual(['A', 'B', 'C'], sorted(result[0]['motionProb']))
+
+    def test_refine_senz_prob_list_fill_strategies(self):
+        senz_prob_list = [
+            {'motionProb': {'A': 1.0}, 'timestamp': 1000, 'perHourScale': 2, 'senzId': 1},
+            {'motionProb': {'A': 1.0}, 'timestamp': 1000, 'perHourScale': 2, 'senzId': 2},
+            {'motionProb': {'B': 1.0}, 'timestamp': 5000, 'perHourScale': 6, 'senzId': 3},
+        ]
+        # 3 blank buckets, tolerated only with max_gap >= 3
+        self.assertEqual([], refine_senz_prob_list('perHourScale', 0, 8, senz_prob_list))
+        result = refine_senz_prob_list('perHourScale', 0, 8, senz_prob_list, max_gap=3)
+        self.assertEqual(range(9), [elem['perHourScale'] for elem in result])
+        self.assertEqual([[], [], [1, 2], [], [], [], [3], [], []], [elem['senzId'] for elem in result])
+        self.assertEqual([1000, 1000, 1000, 2000, 3000, 4000, 5000, 5000, 5000], [elem['timestamp'] for elem in result])
+        # combined probs of present buckets: A 0.75 + 0.25 * 2 / 3, B 0.75 + 0.25 * 1 / 3
+        prob_a, prob_b = result[2]['motionProb'], result[6]['motionProb']
+        self.assertAlmostEqual(0.75 + 0.25 * 2 / 3., prob_a['A'])
+        self.assertAlmostEqual(0.75 + 0.25 / 3., prob_b['B'])
+        self.assertDeepAlmostEqual(prob_a, result[0]['motionProb'])
+        self.assertDeepAlmostEqual(prob_b, result[8]['motionProb'])
+        self.assertAlmostEqual(0.5 * (prob_a['A'] + prob_b['A']), result[4]['motionProb']['A'])
+        self.assertAlmostEqual(0.75 * prob_a['A'] + 0.25 * prob_b['A'], result[3]['motionProb']['A'])
+
+        result = refine_senz_prob_list('perHourScale', 0, 8, senz_prob_list, max_gap=3, fill_strategy='nearest')
+        self.assertDeepAlmostEqual([prob_a, prob_a, prob_b], [elem['motionProb'] for elem in result[3:6]])
+
+        # left neighbor has 2 senz, right neighbor 1
+        result = refine_senz_prob_list('perHourScale', 0, 8, senz_prob_list, max_gap=3, fill_strategy='weighted')
+        self.assertAlmostEqual((2 * prob_a['A'] + 1 * prob_b['A']) / 3., result[4]['motionProb']['A'])
+        self.assertAlmostEqual((2 / 1. * prob_a['A'] + 1 / 3. * prob_b['A']) / (2 / 1. + 1 / 3.),
+                               result[3]['motionProb']['A'])
+
+    def test_refine_senz_prob_list_timezone_offset(self):
+        senz_prob_list = [
+            {'motionProb': {'A': 0.7, 'B': 0.3}, 'timestamp': 1300 * 60000, 'perHourScale': 21, 'senzId': 1},
+            {'motionProb': {'A': 0.3, 'C': 0.7}, 'timestamp': 1400 * 60000, 'perHourScale': 23, 'senzId': 2},
+            {'motionProb': {'B': 0.7, 'C': 0.3}, 'timestamp': 1450 * 60000, 'perHourScale': 0, 'senzId': 3},
+        ]
+        derived = [dict((key, value) for key, value in elem.iteritems() if key != 'perHourScale')
+                   for elem in senz_prob_list]
+        self.assertDeepAlmostEqual(refine_senz_prob_list('perHourScale', 21, 0, senz_prob_list),
+                                   refine_senz_prob_list('perHourScale', 21, 0, derived, timezone_offset=0))
+        # one hour ahead of UTC
+        self.assertEqual([[1], [], [2], [3]],
+                         [elem['senzId'] for elem in refine_senz_prob_list('perHourScale', 22, 1, derived,
+                                                                           timezone_offset=60)])
+
+    def test_bucket_cache(self):
+        senz_prob_list = [
+            {'motionProb': {'A': 0.7, 'B': 0.3}, 'timestamp': 100, 'perHourScale': 9, 'senzId': 911},
+            {'motionProb': {'A': 0.3, 'C': 0.7}, 'timestamp': 200, 'perHourScale': 10, 'senzId': 912},
+            {'motionProb': {'B': 0.7, 'C': 0.3}, 'timestamp': 300, 'perHourScale': 10, 'senzId': 921},
+            {'motionProb': {'D': 1.0}, 'timestamp': 400, 'perHourScale': 11, 'senzId': 931},
+            {'motionProb': {'A': 0.5, 'D': 0.5}, 'timestamp': 500, 'perHourScale': 12, 'senzId': 941},
+        ]
+        raw2refine._bucket_cache.clear()
+        result = refine_senz_prob_list('perHourScale', 9, 11, senz_prob_list[:4])
+        self.assertEqual({'size': 3, 'hits': 0, 'misses': 3}, dict((key, value) for key, value in
+                         raw2refine.get_bucket_cache_stats().iteritems() if key != 'capacity'))
+
+        # sliding window, buckets 10 and 11 are recombined from cache with a new prior
+        slided_result = refine_senz_prob_list('perHourScale', 10, 12, senz_prob_list[1:])
+        stats = raw2refine.get_bucket_cache_stats()
+        self.assertEqual((2, 4), (stats['hits'], stats['misses']))
+        raw2refine._bucket_cache.clear()
+        self.assertDeepAlmostEqual(refine_senz_prob_list('perHourScale', 10, 12, senz_prob_list[1:]), slided_result)
+        self.assertDeepAlmostEqual(refine_senz_prob_list('perHourScale', 9, 11, senz_prob_list[:4]), result)
+
+        # bucket 10 without senz 21 is another bucket
+        misses = raw2refine.get_bucket_cache_stats()['misses']
+        refine_senz_prob_list('perHourScale', 9, 11, senz_prob_list[:2] + senz_prob_list[3:4])
+        self.assertEqual(misses + 1, raw2refine.get_bucket_cache_stats()['misses'])
+
+        # a corrected senz with the same senzId and timestamp is another bucket
+        corrected = [dict(elem) for elem in senz_prob_list[:4]]
+        corrected[0]['motionProb'] = {'A': 0.1, 'B': 0.9}
+        misses = raw2refine.get_bucket_cache_stats()['misses']
+        corrected_result = refine_senz_prob_list('perHourScale', 9, 11, corrected)
+        self.assertEqual(misses + 1, raw2refine.get_bucket_cache_stats()['misses'])
+        self.assertNotAlmostEqual(result[0]['motionProb']['B'], corrected_result[0]['motionProb']['B'])
+        raw2refine._bucket_cache.clear()
+        self.assertDeepAlmostEqual(refine_senz_prob_list('perHourScale', 9, 11, corrected), corrected_result)
+
+        # re-sent senz count in their bucket, [a, a, b] and [a, b, b] are different buckets
+        resent = refine_senz_prob_list('perHourScale', 9, 10, senz_prob_list[:2] + senz_prob_list[1:3])
+        other_resent = refine_senz_prob_list('perHourScale', 9, 10, senz_prob_list[:3] + senz_prob_list[2:3])
+        self.assertNotAlmostEqual(resent[1]['motionProb']['B'], other_resent[1]['motionProb']['B'])
+        raw2refine._bucket_cache.clear()
+        self.assertDeepAlmostEqual(refine_senz_prob_list('perHourScale', 9, 10, senz_prob_list[:3] + senz_prob_list[2:3]),
+                                   other_resent)
+
+    def test_refine_senz_prob_windows(self):
+        senz_prob_list = [
+            {'motionProb': {'A': 0.7, 'B': 0.3}, 'timestamp': 100, 'perHourScale': 23, 'senzId': 11},
+            {'motionProb': {'A': 0.3, 'C': 0.7}, 'timestamp': 200, 'perHourScale': 23, 'senzId': 12},
+            {'motionProb': {'B': 0.7, 'C': 0.3}, 'timestamp': 300, 'perHourScale': 0, 'senzId': 21},
+            {'motionProb': {'A': 0.7, 'C': 0.3}, 'timestamp': 400, 'perHourScale': 2, 'senzId': 41},
+            {'motionProb': {'D': 1.0}, 'timestamp': 500, 'perHourScale': 10, 'senzId': 51},
+            {'motionProb': {'D': 0.5, 'A': 0.5}, 'timestamp': 600, 'perHourScale': 11, 'senzId': 52},
+        ]
+        scale_windows = [[9, 11], [10, 12], [5, 7], [22, 2]]
+        results = refine_senz_prob_windows('perHourScale', scale_windows, senz_prob_list)
+
+        self.assertEqual(len(scale_windows), len(results))
+        self.assertEqual([[51], [52], []], [elem['senzId'] for elem in results[1]])
+        self.assertEqual([], results[2])
+        for (start, end), result in zip(scale_windows, results):
+            window_senz_prob_list = [elem for elem in senz_prob_list
+                                     if start <= elem['perHourScale'] <= end or start > end]
+            self.assertDeepAlmostEqual(refine_senz_prob_list('perHourScale', start, end, window_senz_prob_list), result)
+        # labels only seen out of window are left out
+        self.assertEqual(['A', 'D'], sorted(results[0][1]['motionProb']))
+
+    def test_refine_senz_prob_pyramid(self):
+        labels = ['A', 'B', 'C']
+        senz_prob_list = []
+        for senz_id, minute in enumerate(range(780, 590, -7)):
+            senz_prob_list.append({
+                'motionProb': {labels[senz_id % 3]: 0.6, labels[(senz_id + 1) % 3]: 0.4},
+                'timestamp': minute * 60000,
+                'perMinScale': minute,
+                'tenMinScale': minute // 10,
+                'halfHourScale': minute // 30,
+                'perHourScale': minute // 60,
+                'senzId': senz_id,
+            })
+        results = refine_senz_prob_pyramid(600, 780, senz_prob_list)
+
+        self.assertEqual(['halfHourScale', 'perHourScale', 'perMinScale', 'tenMinScale'], sorted(results))
+        for scale_type, minutes in [('perMinScale', 1), ('tenMinScale', 10), ('halfHourScale', 30), ('perHourScale', 60)]:
+            expected = refine_senz_prob_list(scale_type, 600 // minutes, 780 // minutes, senz_prob_list)
+            self.assertDeepAlmostEqual(expected, results[scale_type])
+        self.assertEqual([10, 11, 12, 13], [elem['perHourScale'] for elem in results['perHourScale']])
+        # senzIds of a rolled up bucket keep input order
+        self.assertEqual([elem['senzId'] for elem in senz_prob_list if elem['perHourScale'] == 12],
+                         results['perHourScale'][2]['senzId'])
+
+    def test_refine_senz_prob_stream(self):
+        day = 24 * 60 * 60000
+        senz_prob_list = []
+        for senz_id, minute in enumerate([1400, 1405, 1418, 1432, 3, 9, 21, 35]):
+            timestamp = 10 * day + minute * 60000 + (day if minute < 600 else 0)
+            senz_prob_list.append({
+                'motionProb': {'A': 0.2 + 0.1 * (senz_id % 3), 'B': 0.8 - 0.1 * (senz_id % 3)},
+                'timestamp': timestamp,
+                'perMinScale': minute,
+                'tenMinScale': minute // 10,
+                'senzId': senz_id,
+            })
+        try:
+            self.assertEqual([], refine_senz_prob_stream('u1', 'tenMinScale', 139, 3, senz_prob_list[:3]))
+            result = refine_senz_prob_stream('u1', 'tenMinScale', 139, 3, senz_prob_list[3:])
+            self.assertDeepAlmostEqual(refine_senz_prob_list('tenMinScale', 139, 3, senz_prob_list), result)
+            # re-sent senz are ignored
+            self.assertDeepAlmostEqual(result, refine_senz_prob_stream('u1', 'tenMinScale', 139, 3, senz_prob_list))
+            self.assertDeepAlmostEqual(refine_senz_prob_list('perMinScale', 1400, 35, senz_prob_list),
+                                       refine_senz_prob_stream('u1', 'perMinScale', 1400, 35, []))
+
+            # one day after the newest senz, all other slots are stale
+            next_day_senz = dict(senz_prob_list[-1], timestamp=senz_prob_list[-1]['timestamp'] + day, senzId=100)
+            self.assertEqual([], refine_senz_prob_stream('u1', 'tenMinScale', 139, 3, [next_day_senz]))
+            self.assertEqual([], refine_senz_prob_stream('u2', 'tenMinScale', 139, 3, []))
+        finally:
+            raw2refine._rings.clear()
+
+    def test_refine_senz_prob_stream_window_after_newest_senz(self):
+        day = 24 * 60 * 60000
+
+        def make_senz(day_index, minute, prob_a, prefix):
+            return {'motionProb': {'A': prob_a, 'B': 1 - prob_a}, 'timestamp': (10 + day_index) * day + minute * 60000,
+                    'perMinScale': minute, 'senzId': '%s%s' % (prefix, minute)}
+
+        yesterday_senz = [make_senz(0, minute, 0.775, 'y') for minute in xrange(590, 610)]
+        today_senz = [make_senz(1, minute, 0.175, 'x') for minute in xrange(598, 603)]
+        try:
+            refine_senz_prob_stream('u1', 'perMinScale', 590, 609, yesterday_senz)
+            result = refine_senz_prob_stream('u1', 'perMinScale', 598, 605, today_senz)
+        finally:
+            raw2refine._rings.clear()
+        # minutes 603 - 605 are after the newest senz, yesterday's buckets are not theirs
+        self.assertDeepAlmostEqual(refine_senz_prob_list('perMinScale', 598, 605, today_senz), result)
+        self.assertEqual([], [senz_id for elem in result for senz_id in elem['senzId'] if senz_id.startswith('y')])
+
+    def test_refine_senz_prob_stream_ring_weight(self):
+        # a new label in every minute, label columns grow to 4 then 8
+        senz_prob_list = [{'motionProb': dict(('L%s' % label, 1.0 / (minute + 1)) for label in xrange(minute + 1)),
+                           'timestamp': 10 * 24 * 60 * 60000 + minute * 60000, 'perMinScale': minute, 'senzId': minute}
+                          for minute in xrange(6)]
+        default_max_weight = raw2refine._rings.max_weight
+        try:
+            result = refine_senz_prob_stream('u1', 'perMinScale', 0, 5, senz_prob_list)
+            self.assertDeepAlmostEqual(refine_senz_prob_list('perMinScale', 0, 5, senz_prob_list), result)
+            self.assertEqual(1440 * (1 + 8), raw2refine._rings.stats()['weight'])
+
+            # rings over max weight are evicted, least recently used first
+            raw2refine._rings.max_weight = 1440 * (1 + 8) + 1440
+            refine_senz_prob_stream('u2', 'perMinScale', 0, 5, senz_prob_list[:1])
+            self.assertNotIn('u1', raw2refine._rings)
+            self.assertIn('u2', raw2refine._rings)
+        finally:
+            raw2refine._rings.max_weight = default_max_weight
+            raw2refine._rings.clear()
+
+    def test_refine_senz_prob_stream_concurrent_requests(self):
+        senz_prob_list = [{'motionProb': {'A': 0.1 * (minute % 9 + 1), 'B': 1 - 0.1 * (minute % 9 + 1)},
+                           'timestamp': 10 * 24 * 60 * 60000 + minute * 60000, 'perMinScale': minute, 'senzId': minute}
+                          for minute in xrange(80)]
+        threads = [threading.Thread(target=refine_senz_prob_stream,
+                                    args=('u1', 'perMinScale', 0, 79, senz_prob_list[start::8]))
+                   for start in xrange(8)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # the first requests of a user share one ring
+            self.assertDeepAlmostEqual(refine_senz_prob_list('perMinScale', 0, 79, senz_prob_list),
+                                       refine_senz_prob_stream('u1', 'perMinScale', 0, 79, []))
+        finally:
+            raw2refine._rings.clear()
+
     def test_unvalid_refine_senz_prob_list(self):
         # case 1
         senz_prob_list = [
@@ -7,6 +7,9 @@ import multiprocessing
 bind = "unix:/app/run/gunicorn.sock"
 #
 workers = multiprocessing.cpu_count() * 2 + 1
+# lets the app share the cores out among workers, see log2rawsenz.BATCH_POOL_SIZE,
+# stateful APIs are served by gunicorn_stateful_conf.py, see config.STATEFUL_WORKER
+raw_env = ['GUNICORN_WORKERS=%s' % workers, 'STATEFUL_WORKER=0']
 # should save some memory:
 preload_app = True
 
@@ -0,0 +1,22 @@
+# Serves the APIs keeping per user state in memory, see flask_app/config.py STATEFUL_WORKER.
+# A single worker, so every request of a user finds its state. nginx routes these APIs here.
+# Its threads keep one large upload from stalling the other users, but they share one core.
+import multiprocessing
+
+bind = "unix:/app/run/gunicorn_stateful.sock"
+workers = 1
+raw_env = ['GUNICORN_WORKERS=1', 'STATEFUL_WORKER=1']
+preload_app = True
+
+worker_class = 'gthread'
+threads = multiprocessing.cpu_count() * 2 + 1
+
+# logging:
+accesslog = '/app/logs/gunicorn_stateful.access.log'
+errorlog = '/app/logs/gunicorn_stateful.error.log'
+loglevel = 'info'
+
+pidfile = '/app/run/gunicorn_stateful.pid'
+
+# for performance:
+keepalive = 3